@@ -2,6 +2,7 @@ from ruamel.yaml import YAML
 from kubessh.authentication.github import GitHubAuthenticator
 from kubessh.authentication.gitlab import GitLabAuthenticator
 from kubessh.authentication.dummy import DummyAuthenticator
+from kubessh.authentication.keystore import KeyStoreAuthenticator
 
 yaml = YAML()
 
@@ -21,6 +22,13 @@ elif config['auth']['type'] == 'gitlab':
 
 elif config['auth']['type'] == 'dummy':
     c.KubeSSH.authenticator_class = DummyAuthenticator
+elif config['auth']['type'] == 'keystore':
+    c.KubeSSH.authenticator_class = KeyStoreAuthenticator
+    keystore = config['auth'].get('keystore', {})
+    if 'dbPath' in keystore:
+        c.KeyStore.db_path = keystore['dbPath']
+    if 'syncUrl' in keystore:
+        c.KeyStore.sync_url = keystore['syncUrl']
 
 if 'defaultNamespace' in config:
     c.KubeSSH.default_namespace = config['defaultNamespace']
@@ -30,3 +38,32 @@ if 'podTemplate' in config:
 
 if 'pvcTemplates' in config:
     c.UserPod.pvc_templates = config['pvcTemplates']
+
+if 'forwardMode' in config:
+    c.BaseServer.forward_mode = config['forwardMode']
+
+if 'warmPool' in config:
+    c.WarmPool.enabled = config['warmPool'].get('enabled', False)
+    c.WarmPool.size = config['warmPool'].get('size', 0)
+    c.WarmPool.schedule = config['warmPool'].get('schedule', [])
+
+if 'pvcDataSources' in config:
+    c.UserPod.pvc_data_sources = config['pvcDataSources']
+
+if 'rootMode' in config:
+    c.UserPod.root_mode = config['rootMode']
+
+if 'persistentPaths' in config:
+    c.UserPod.persistent_paths = config['persistentPaths']
+
+if 'admission' in config:
+    c.AdmissionController.enabled = config['admission'].get('enabled', True)
+    c.AdmissionController.rate = config['admission'].get('rate', 5)
+    c.AdmissionController.burst = config['admission'].get('burst', 10)
+    c.AdmissionController.max_starting = config['admission'].get('maxStarting', 20)
+
+if 'loadShedding' in config:
+    c.LoadShedder.max_handshakes = config['loadShedding'].get('maxHandshakes', 100)
+    c.LoadShedder.max_sessions = config['loadShedding'].get('maxSessions', 1000)
+    c.LoadShedder.max_sessions_per_user = config['loadShedding'].get('maxSessionsPerUser', 20)
+    c.LoadShedder.max_loop_lag = config['loadShedding'].get('maxLoopLag', 0.5)
@@ -0,0 +1,183 @@
+"""
+Admission control for cold starts.
+
+When a whole class logs in at once, every login that needs a new pod would
+otherwise create its PVC & pod at the same moment, and some fail on quota
+or API server throttling. Logins that have to create a pod instead ask for
+admission first: creates are rate limited with a token bucket, only so
+many pods may be starting at once, and logins waiting for their turn are
+served round robin per user, so one user opening many sessions can't push
+everyone else back. Logins to pods that are already running (or claimed
+from the warm pool) never wait here. The warm pool's own creates go through
+here too, as background work only admitted while no login is waiting.
+"""
+import asyncio
+import collections
+import time
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool, Float, Integer
+
+from kubessh import metrics
+
+
+class AdmissionTicket:
+    """
+    One login's place in the admission queue.
+    """
+    def __init__(self, user, background=False):
+        self.user = user
+        self.background = background
+        self.admitted = asyncio.get_event_loop().create_future()
+        self.queued_at = time.perf_counter()
+        self.released = False
+
+
+class AdmissionController(SingletonConfigurable):
+    """
+    Token bucket, concurrency limit & per-user fair queue for creating user pods.
+    """
+    enabled = Bool(
+        True,
+        help="""
+        Queue logins that need a new pod, rather than creating all pods at once.
+        """,
+        config=True
+    )
+
+    rate = Float(
+        5,
+        help="""
+        Pod creates allowed per second, on average. 0 disables the rate limit.
+        """,
+        config=True
+    )
+
+    burst = Integer(
+        10,
+        help="""
+        Pod creates allowed right away after a quiet period, before rate applies.
+        """,
+        config=True
+    )
+
+    max_starting = Integer(
+        20,
+        help="""
+        Maximum number of user pods being created & started at the same time. 0 means no limit.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # user -> list of their waiting tickets, users in the order they are next served
+        self._queues = collections.OrderedDict()
+        # tickets of background work, admitted in order once no login is waiting
+        self._background = []
+        self.starting = 0
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._timer = None
+
+        metrics.gauge(
+            'kubessh_admission_queued',
+            'Logins waiting for their turn to create a user pod',
+            func=lambda: sum(len(queue) for queue in self._queues.values()) + len(self._background)
+        )
+        metrics.gauge(
+            'kubessh_admission_starting',
+            'User pods being created or started, out of max_starting',
+            func=lambda: self.starting
+        )
+        self.wait_time = metrics.summary(
+            'kubessh_admission_wait_seconds',
+            'Time logins waited for their turn to create a user pod'
+        )
+
+    def request(self, user, background=False):
+        """
+        Return an AdmissionTicket for user, whose admitted future resolves once they may create their pod
+
+        background tickets are only admitted while no other ticket is waiting.
+        """
+        ticket = AdmissionTicket(user, background)
+        if not self.enabled:
+            ticket.released = True
+            ticket.admitted.set_result(True)
+            return ticket
+        if background:
+            self._background.append(ticket)
+        else:
+            self._queues.setdefault(user, []).append(ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket):
+        """
+        Return the number of tickets that will be admitted before ticket
+        """
+        if ticket.admitted.done():
+            return 0
+        if ticket.background:
+            return sum(len(queue) for queue in self._queues.values()) + self._background.index(ticket)
+        queue = self._queues.get(ticket.user)
+        if queue is None:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        before = True
+        for user, other in self._queues.items():
+            if user == ticket.user:
+                before = False
+                continue
+            # Round robin: users ahead in line get one more turn than those behind
+            ahead += min(len(other), index + 1 if before else index)
+        return ahead
+
+    def release(self, ticket):
+        """
+        Give up ticket, whether it was admitted (the pod has started or failed) or is still waiting
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted.done():
+            self.starting -= 1
+        else:
+            ticket.admitted.cancel()
+            queue = self._background if ticket.background else self._queues.get(ticket.user)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue and not ticket.background:
+                    del self._queues[ticket.user]
+        self._dispatch()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        while (self._queues or self._background) and (self.max_starting <= 0 or self.starting < self.max_starting):
+            if self.rate > 0 and self._tokens < 1:
+                # Come back when the next token is there
+                self._timer = asyncio.get_event_loop().call_later((1 - self._tokens) / self.rate, self._dispatch)
+                return
+            if self._queues:
+                user, queue = next(iter(self._queues.items()))
+                ticket = queue.pop(0)
+                if queue:
+                    self._queues.move_to_end(user)
+                else:
+                    del self._queues[user]
+            else:
+                ticket = self._background.pop(0)
+            self._tokens -= 1
+            self.starting += 1
+            self.wait_time.observe(time.perf_counter() - ticket.queued_at)
+            ticket.admitted.set_result(True)
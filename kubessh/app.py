@@ -4,6 +4,7 @@ import logging
 import asyncio
 import argparse
 import os
+import signal
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import itertools
@@ -12,9 +13,19 @@ from traitlets import Unicode, Bool, Integer, Type, default
 
 import asyncssh
 
-from kubessh.pod import UserPod, PodState
+from kubessh.pod import UserPod, PodState, PodStartError, username_from_login
+from kubessh.informer import PodInformer
+from kubessh.pool import WarmPool
+from kubessh.kubeapi import KubeApi
+from kubessh.streams import KubeStreams
+from kubessh.broker import ExecBroker
+from kubessh.sessions import SessionTracker
+from kubessh.admission import AdmissionController
+from kubessh.overload import LoadShedder
+from kubessh import metrics
 from kubessh.authentication import Authenticator
 from kubessh.authentication.github import GitHubAuthenticator
+from kubessh.authentication.keystore import KeyStore, KeyStoreAuthenticator
 
 
 class KubeSSH(Application):
@@ -71,6 +82,17 @@ class KubeSSH(Application):
         config=True
     )
 
+    metrics_port = Integer(
+        None,
+        allow_none=True,
+        help="""
+        Port to serve Prometheus style metrics on, at /metrics.
+
+        If set to None, no metrics endpoint is started.
+        """,
+        config=True
+    )
+
     @default('default_namespace')
     def _populate_default_namespace(self):
         # If no namespace to spawn into is specified, use current pod's namespace by default
@@ -82,23 +104,48 @@ class KubeSSH(Application):
             return 'default'
 
     async def handle_client(self, process):
-        username = process.channel.get_extra_info('username').split('-')
-        if username and username[0] == 'dcucode':
-            username = '-'.join(username[1:])
-        else:
-            username = '-'.join(username)
+        username = username_from_login(process.channel.get_extra_info('username'))
         print(username) 
+        shedder = LoadShedder.instance()
+        refusal = shedder.admit_session(username)
+        if refusal is not None:
+            self.log.info(f'Refusing session for {username}: {refusal}')
+            process.stderr.write(f'\r\n{refusal}\r\n'.encode('utf-8'))
+            process.exit(1)
+            return
+        try:
+            await self._handle_session(process, username)
+        finally:
+            shedder.session_done(username)
+
+    async def _handle_session(self, process, username):
         pod = UserPod(parent=self, username=username, namespace=self.default_namespace)
 
 
         spinner = itertools.cycle(['-', '/', '|', '\\'])
-
-        async for status in pod.ensure_running():
-            if status == PodState.RUNNING:
-                process.stdout.write('\r\033[K'.encode('ascii'))
-            elif status == PodState.STARTING:
-                process.stdout.write('\b'.encode('ascii'))
-                process.stdout.write(next(spinner).encode('ascii'))
+        queued = False
+
+        try:
+            async for status in pod.ensure_running():
+                if status == PodState.RUNNING:
+                    process.stdout.write('\r\033[K'.encode('ascii'))
+                elif status == PodState.QUEUED:
+                    queued = True
+                    process.stdout.write(
+                        f'\r\033[KWaiting to start your environment, {pod.queue_position} ahead of you {next(spinner)}'.encode('ascii')
+                    )
+                elif status == PodState.STARTING:
+                    if queued:
+                        # Our turn, back to the bare spinner
+                        queued = False
+                        process.stdout.write('\r\033[K '.encode('ascii'))
+                    process.stdout.write('\b'.encode('ascii'))
+                    process.stdout.write(next(spinner).encode('ascii'))
+        except PodStartError as e:
+            self.log.error(f'Could not start pod for {username}: {e}')
+            process.stderr.write(f'\r\nCould not start your environment: {e}\r\nPlease try again later.\r\n'.encode('utf-8'))
+            process.exit(1)
+            return
 
         await pod.execute(process)
 
@@ -120,6 +167,13 @@ class KubeSSH(Application):
         super().initialize(*args, **kwargs)
         self.load_config_file(self.config_file)
         self.init_logging()
+        # Create the shared Kubernetes API client early, so it picks up our config
+        KubeApi.instance(parent=self)
+        KubeStreams.instance(parent=self)
+        ExecBroker.instance(parent=self)
+        SessionTracker.instance(parent=self)
+        AdmissionController.instance(parent=self)
+        LoadShedder.instance(parent=self)
 
         if self.host_key_path is None:
             # We'll generate a temporary key in-memory key for this run only
@@ -130,7 +184,38 @@ class KubeSSH(Application):
                 self.ssh_host_key = asyncssh.import_private_key(f.read())
             self.log.info(f'Loaded host key from {self.host_key_path}')
 
+    def reload_config(self):
+        """
+        Re-read the config file, applying new load shedding & admission limits.
+
+        Open connections are not affected. Settings removed from the file
+        keep their current value.
+        """
+        self.log.info(f'Reloading config from {self.config_file}')
+        try:
+            self.load_config_file(self.config_file)
+        except Exception:
+            self.log.exception(f'Could not reload {self.config_file}, keeping the current config')
+            return
+        for configurable in (LoadShedder.instance(), AdmissionController.instance()):
+            configurable.update_config(self.config)
+
     async def start(self):
+        # Keep an in-memory index of user pods, so logins don't need to hit the API
+        PodInformer.instance_for(self.default_namespace, parent=self).start()
+        # Keep pre-started pods ready for first logins, if configured
+        WarmPool.instance_for(self.default_namespace, parent=self).start()
+        # Keep the local copy of public keys in sync, if logins use it
+        if issubclass(self.authenticator_class, KeyStoreAuthenticator):
+            KeyStore.instance(parent=self).start()
+
+        # Refuse new work early when overloaded, rather than slowing down everyone
+        LoadShedder.instance().start()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.reload_config)
+
+        if self.metrics_port is not None:
+            await metrics.serve(self.metrics_port, self.log)
+
         await asyncssh.listen(
             host='',
             port=self.port,
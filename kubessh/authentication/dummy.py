@@ -1,36 +1,154 @@
 from kubessh.authentication import Authenticator
-import requests
-import json
+from kubessh.authentication.gateway import AuthGateway, BackendError, BackendUnavailable
+from kubessh import metrics
+from kubessh.cache import LRUCache
+import asyncio
+import functools
+import hashlib
+import hmac
+import os
+import time
+import aiohttp
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
+from traitlets import Unicode, Float, Integer
 import base64
 
+VERDICT_CACHE_HITS = metrics.counter(
+    'kubessh_auth_verdict_cache_hits_total',
+    'Password logins accepted from the verdict cache, each saving a call to the backend'
+)
+VERDICT_CACHE_MISSES = metrics.counter(
+    'kubessh_auth_verdict_cache_misses_total',
+    'Password logins that had to be checked with the backend while the verdict cache was enabled'
+)
+
 
 class DummyAuthenticator(Authenticator):
     """
     Dummy SSH Authenticator.
 
-    Allows ssh logins where the username is the same as the password.
+    Checks passwords (or dcucode access tokens) against the dcucode backend.
+
+    One authenticator is created per ssh connection, so the HTTP session &
+    the backend's public key are kept on the class, & shared by all of them.
     """
+    public_key_url = Unicode(
+        'http://203.250.33.85/api/get_public_key',
+        help="""
+        URL to fetch the RSA public key passwords are encrypted with from.
+        """,
+        config=True
+    )
+
+    login_url = Unicode(
+        'http://203.250.33.85/api/login',
+        help="""
+        URL to check usernames & encrypted passwords against.
+        """,
+        config=True
+    )
+
+    token_auth_url = Unicode(
+        'http://203.250.33.85/api/token_auth',
+        help="""
+        URL to check dcucode access tokens against, for 'dcucode-{username}' logins.
+        """,
+        config=True
+    )
+
+    request_timeout = Float(
+        5,
+        help="""
+        Seconds to wait for the backend to answer a request, before failing the login.
+        """,
+        config=True
+    )
+
+    public_key_ttl = Float(
+        300,
+        help="""
+        Seconds to keep using a fetched public key before fetching it again.
+        """,
+        config=True
+    )
+
+    verdict_cache_ttl = Float(
+        0,
+        help="""
+        Seconds to remember successful logins for, so repeated logins skip the backend.
+
+        Tools like VS Code & scp reconnect many times a minute with the same
+        credentials. Only a salted scrypt hash of each password is kept in
+        memory, and a user's entry is dropped as soon as a login with other
+        credentials fails. 0 (the default) disables the cache.
+        """,
+        config=True
+    )
+
+    verdict_cache_size = Integer(
+        1024,
+        help="""
+        Maximum number of users whose successful logins are remembered.
+
+        Least recently used entries are dropped first.
+        """,
+        config=True
+    )
+
+    _session = None
+    # (imported RSA key, time it was fetched)
+    _public_key = None
+    _public_key_lock = None
+    # username -> hash of the password last accepted for them
+    _verdicts = None
+    # Random per process, so hashes are useless outside of it
+    _salt = os.urandom(16)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gateway = AuthGateway.instance_for('dcucode', parent=self.parent)
+
     def password_auth_supported(self):
         return True
 
-    def get_public_key(self):
-        try:
-            #response = requests.get('http://203.250.33.87:31320/api/get_public_key')
-            response = requests.get('http://203.250.33.85/api/get_public_key')
-            if response.status_code == 200:
-                return response.json()['data']['public_key']
-            else:
-                self.log.error(f"Failed to get public key: {response.status_code}")
+    @property
+    def session(self):
+        # Created lazily, since it must be created from inside the event loop.
+        # Keeps connections to the backend alive between logins.
+        cls = DummyAuthenticator
+        if cls._session is None or cls._session.closed:
+            cls._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        return cls._session
+
+    async def get_public_key(self):
+        """
+        Return the backend's public key as an RSA key object, or None if it can't be fetched
+        """
+        cls = DummyAuthenticator
+        if cls._public_key_lock is None:
+            cls._public_key_lock = asyncio.Lock()
+        # Logins arriving together wait for a single fetch
+        async with cls._public_key_lock:
+            if cls._public_key is not None and time.monotonic() - cls._public_key[1] < self.public_key_ttl:
+                return cls._public_key[0]
+            async def fetch():
+                async with self.session.get(self.public_key_url) as response:
+                    if response.status != 200:
+                        raise BackendError(f"Failed to get public key: {response.status}")
+                    response_data = await response.json(content_type=None)
+                return RSA.import_key(response_data['data']['public_key'])
+
+            try:
+                public_key = await self.gateway.call(fetch, hedge=True)
+            except BackendUnavailable as e:
+                self.log.error(f"Error fetching public key: {str(e)}")
                 return None
-        except Exception as e:
-            self.log.error(f"Error fetching public key: {str(e)}")
-            return None
+            cls._public_key = (public_key, time.monotonic())
+            return public_key
 
-    def encrypt_password(self, public_key_str, password):
+    def encrypt_password(self, public_key, password):
         try:
-            public_key = RSA.import_key(public_key_str)
             cipher = PKCS1_v1_5.new(public_key)
             encrypted_password = cipher.encrypt(password.encode())
             return base64.b64encode(encrypted_password).decode('utf-8')
@@ -38,56 +156,88 @@ class DummyAuthenticator(Authenticator):
             self.log.error(f"Error encrypting password: {str(e)}")
             return None
 
-    def validate_password(self, username, password):
-        self.log.info(f"Login attempted by {username}")
-        
-        public_key = self.get_public_key()
-        if not public_key:
+    async def _post(self, url, data):
+        """
+        Post data to the backend, returning True if it accepted the login
+        """
+        async def post():
+            async with self.session.post(url, json=data) as response:
+                if response.status >= 500:
+                    raise BackendError(f"{url} answered {response.status}")
+                if response.status != 200:
+                    self.log.info(f"Login rejected by {url}: {response.status}")
+                    return None
+                return await response.json(content_type=None)
+
+        try:
+            response_data = await self.gateway.call(post)
+        except BackendUnavailable as e:
+            self.log.error(f"Error checking login with {url}: {e}")
             return False
-        
-        encrypted_password = self.encrypt_password(public_key, password)
-        if not encrypted_password:
+        if response_data is None:
             return False
 
+        self.log.info(response_data['data'])
+        return response_data['error'] is None
+
+    @property
+    def verdicts(self):
+        cls = DummyAuthenticator
+        if cls._verdicts is None:
+            cls._verdicts = LRUCache(self.verdict_cache_size, ttl=self.verdict_cache_ttl)
+            metrics.gauge(
+                'kubessh_auth_verdict_cache_size',
+                'Users with a remembered successful login',
+                # The cache can be reset to None, as the tests do between runs
+                func=lambda: len(cls._verdicts or ())
+            )
+        return cls._verdicts
+
+    async def _hash_credentials(self, username, password):
+        # scrypt is slow on purpose, so keep it off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(
+            hashlib.scrypt,
+            password.encode(), salt=self._salt + username.encode(), n=2**12, r=8, p=1
+        ))
+
+    async def validate_password(self, username, password):
+        if self.verdict_cache_ttl <= 0:
+            return await self._validate_password(username, password)
+
+        credentials_hash = await self._hash_credentials(username, password)
+        cached = self.verdicts.get(username)
+        if cached is not None and hmac.compare_digest(cached, credentials_hash):
+            self.log.info(f"Login by {username} accepted from verdict cache")
+            VERDICT_CACHE_HITS.inc()
+            return True
+
+        VERDICT_CACHE_MISSES.inc()
+        if await self._validate_password(username, password):
+            self.verdicts[username] = credentials_hash
+            return True
+        # Password might have been changed, so stop trusting the old one
+        self.verdicts.pop(username)
+        return False
+
+    async def _validate_password(self, username, password):
+        self.log.info(f"Login attempted by {username}")
+
         if username.split('-')[0] == 'dcucode':
-            tokenLoginUrl = 'http://203.250.33.85/api/token_auth'
-            # tokenLoginUrl = 'http://203.250.33.87:30481/api/token_auth' # dcucode dev
-            # tokenLoginUrl = 'http://203.250.33.87:31617/api/token_auth' # dcucode test
             real_username = username.split('-', 1)[1]
-            data = {
+            return await self._post(self.token_auth_url, {
                 'token': password,
                 'username': real_username
-            }
-            response = requests.post(tokenLoginUrl, json=data)
-            if response.status_code == 200:
-                response_data = json.loads(response.text)
-
-                self.log.info(response_data['data'])
-    
-                if response_data['error'] == None:
-                    return True
-            return False
-        else:
-            #url = 'http://203.250.33.87:30481/api/login' # dcucode dev
-            url = 'http://203.250.33.85/api/login'
-            data = {
-                'username': username,
-                'password': encrypted_password
-            }
-            response = requests.post(url, json=data)
-            print("HTTP response status code :", response.status_code)
-
-            if response.status_code == 200:
-                response_data = json.loads(response.text)
-
-                self.log.info(response_data['data'])
-    
-                if response_data['error'] == None:
-                    return True
-            #print("Response text:\n", response.text)
+            })
+
+        public_key = await self.get_public_key()
+        if not public_key:
             return False
-        
-        
 
-        
+        encrypted_password = self.encrypt_password(public_key, password)
+        if not encrypted_password:
+            return False
 
+        return await self._post(self.login_url, {
+            'username': username,
+            'password': encrypted_password
+        })
@@ -0,0 +1,235 @@
+"""
+Guard calls from authenticators to their backends.
+
+Every ssh handshake waits on its authenticator, so a slow authentication
+backend makes handshakes pile up until asyncssh's login timeout drops them
+all. Calls to a backend go through an AuthGateway instead, which
+
+- limits how many requests are in flight to the backend at once,
+- gives each request a deadline, including time spent waiting for a slot,
+- stops sending requests for a while after repeated failures (a circuit
+  breaker), failing logins immediately instead, and
+- optionally sends a second copy of slow idempotent requests (hedging),
+  using whichever answers first.
+"""
+import asyncio
+import time
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Float, Integer, Unicode
+
+from kubessh import metrics
+
+
+class BackendError(Exception):
+    """
+    Raised by gateway calls when the backend misbehaves without an exception
+    of its own, for example by answering with a 5xx status.
+    """
+
+
+class BackendUnavailable(Exception):
+    """
+    Raised when the backend could not be asked - it failed, was too slow,
+    or has been failing so often that the circuit breaker is open.
+    """
+
+
+class AuthGateway(LoggingConfigurable):
+    """
+    Concurrency limit, deadlines, circuit breaker & hedging for one authentication backend.
+    """
+    max_concurrency = Integer(
+        16,
+        help="""
+        Maximum number of requests in flight to the backend at the same time.
+
+        Further requests wait for a free slot, within their timeout.
+        """,
+        config=True
+    )
+
+    timeout = Float(
+        5,
+        help="""
+        Seconds each request may take, including waiting for a free slot.
+        """,
+        config=True
+    )
+
+    failure_threshold = Integer(
+        5,
+        help="""
+        Number of failed requests in a row after which the backend is considered unhealthy.
+
+        While it is, logins needing the backend fail immediately.
+        """,
+        config=True
+    )
+
+    reset_timeout = Float(
+        30,
+        help="""
+        Seconds to wait after the backend was found unhealthy before trying it again.
+
+        A single trial request is then let through. If it succeeds, the
+        backend is considered healthy again.
+        """,
+        config=True
+    )
+
+    hedge_delay = Float(
+        0,
+        help="""
+        Seconds after which a second copy of a slow idempotent request is sent.
+
+        Whichever copy answers first is used. 0 disables hedging.
+        """,
+        config=True
+    )
+
+    name = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Name of the backend, used in log messages & metric names.
+        """,
+    )
+
+    _instances = {}
+
+    @classmethod
+    def instance_for(cls, name, **kwargs):
+        """
+        Return the shared gateway for backend name, creating it if needed.
+        """
+        if name not in cls._instances:
+            cls._instances[name] = cls(name=name, **kwargs)
+        return cls._instances[name]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        # monotonic time until which the circuit is open, or None if closed
+        self.open_until = None
+        self._trial_running = False
+
+        prefix = f'kubessh_auth_{self.name}'
+        self.requests = metrics.counter(
+            f'{prefix}_requests_total',
+            f'Requests made to the {self.name} authentication backend'
+        )
+        self.failures = metrics.counter(
+            f'{prefix}_failures_total',
+            f'Requests to the {self.name} authentication backend that failed or timed out'
+        )
+        self.short_circuited = metrics.counter(
+            f'{prefix}_short_circuited_total',
+            f'Requests to the {self.name} authentication backend failed right away, because it is unhealthy'
+        )
+        self.hedges = metrics.counter(
+            f'{prefix}_hedged_total',
+            f'Requests to the {self.name} authentication backend that were sent a second time for being slow'
+        )
+        self.latency = metrics.summary(
+            f'{prefix}_request_duration_seconds',
+            f'Time taken by requests to the {self.name} authentication backend, including waiting for a slot'
+        )
+        metrics.gauge(
+            f'{prefix}_in_flight',
+            f'Requests to the {self.name} authentication backend waiting or in progress',
+            func=lambda: self.in_flight
+        )
+        metrics.gauge(
+            f'{prefix}_circuit_open',
+            f'1 if the {self.name} authentication backend is considered unhealthy, 0 otherwise',
+            func=lambda: int(self.open_until is not None)
+        )
+
+    def _admit(self):
+        """
+        Return True if this request is the trial after an open circuit, raise if it may not be made
+        """
+        if self.open_until is None:
+            return False
+        if time.monotonic() < self.open_until or self._trial_running:
+            self.short_circuited.inc()
+            raise BackendUnavailable(f'{self.name} authentication backend is unhealthy')
+        self._trial_running = True
+        return True
+
+    def _record(self, succeeded):
+        if succeeded:
+            if self.open_until is not None:
+                self.log.info(f'{self.name} authentication backend is healthy again')
+            self.consecutive_failures = 0
+            self.open_until = None
+            return
+        self.failures.inc()
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            if self.open_until is None:
+                self.log.warning(
+                    f'{self.name} authentication backend failed {self.consecutive_failures} times in a row, '
+                    f'failing logins that need it for {self.reset_timeout}s'
+                )
+            self.open_until = time.monotonic() + self.reset_timeout
+
+    async def call(self, func, hedge=False):
+        """
+        Return result of awaiting func(), guarded by this gateway.
+
+        func should raise for backend failures (BackendError if there is no
+        more specific exception), and return normally for any proper
+        answer - including the backend turning the login down. Pass
+        hedge=True only if func is safe to call twice at the same time.
+
+        Raises BackendUnavailable if the backend failed or was not asked.
+        """
+        trial = self._admit()
+        self.requests.inc()
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self._attempt(func, hedge), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(False)
+            if isinstance(e, asyncio.TimeoutError):
+                e = f'no answer within {self.timeout}s'
+            raise BackendUnavailable(f'{self.name} authentication backend failed: {e}')
+        else:
+            self._record(True)
+            return result
+        finally:
+            if trial:
+                self._trial_running = False
+            self.in_flight -= 1
+            self.latency.observe(time.perf_counter() - start)
+
+    async def _attempt(self, func, hedge):
+        async with self._semaphore:
+            if not hedge or self.hedge_delay <= 0:
+                return await func()
+
+            pending = {asyncio.ensure_future(func())}
+            try:
+                done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+                if not done:
+                    self.hedges.inc()
+                    pending.add(asyncio.ensure_future(func()))
+                error = None
+                while True:
+                    for attempt in done:
+                        if attempt.exception() is None:
+                            return attempt.result()
+                        error = attempt.exception()
+                    if not pending:
+                        raise error
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for attempt in pending:
+                    attempt.cancel()
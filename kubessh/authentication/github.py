@@ -1,10 +1,7 @@
-from kubessh.authentication import Authenticator
-import async_timeout
-import aiohttp
-import asyncssh
+from kubessh.authentication.keys import KeysURLAuthenticator
 from traitlets import List
 
-class GitHubAuthenticator(Authenticator):
+class GitHubAuthenticator(KeysURLAuthenticator):
     """
     Authenticate with GitHub SSH keys
     """
@@ -18,11 +15,10 @@ class GitHubAuthenticator(Authenticator):
         """
     )
 
-    def connection_made(self, conn):
-        self.conn = conn
+    backend_name = 'github'
 
-    def public_key_auth_supported(self):
-        return True
+    def keys_url(self, username):
+        return f'https://github.com/{username}.keys'
 
     async def begin_auth(self, username):
         """
@@ -32,11 +28,4 @@ class GitHubAuthenticator(Authenticator):
             # Deny all users not explicitly allowed
             self.log.info(f"User {username} not in allowed_users, authentication denied")
             return True
-        url = f'https://github.com/{username}.keys'
-        async with aiohttp.ClientSession() as session, async_timeout.timeout(5):
-            async with session.get(url) as response:
-                keys = await response.text()
-        if keys:
-            self.conn.set_authorized_keys(asyncssh.import_authorized_keys(keys))
-        # Return true to indicate we always *must* authenticate
-        return True
+        return await super().begin_auth(username)
@@ -1,11 +1,12 @@
-from kubessh.authentication import Authenticator
-import async_timeout
-import aiohttp
+from kubessh.authentication.keys import KeysURLAuthenticator
 import asyncssh
 import re
 from traitlets import Unicode, List
 
-class GitLabAuthenticator(Authenticator):
+# Key type & key data of each key, leaving out the comment
+KEY_RE = re.compile("^[^ ]+ [^ ]+", flags=re.M)
+
+class GitLabAuthenticator(KeysURLAuthenticator):
     """
     Authenticate with GitLab SSH keys
     """
@@ -29,11 +30,14 @@ class GitLabAuthenticator(Authenticator):
         """
     )
 
-    def connection_made(self, conn):
-        self.conn = conn
+    backend_name = 'gitlab'
+
+    def keys_url(self, username):
+        return f'{self.instance_url}/{username}.keys'
 
-    def public_key_auth_supported(self):
-        return True
+    def parse_keys(self, text):
+        # Remove comment fields from SSH keys, as asyncssh seems to choke on those
+        return asyncssh.import_authorized_keys("\n".join(KEY_RE.findall(text)))
 
     async def begin_auth(self, username):
         """
@@ -43,13 +47,4 @@ class GitLabAuthenticator(Authenticator):
             # Deny all users not explicitly allowed
             self.log.info(f"User {username} not in allowed_users, authentication denied")
             return True
-        url = f'{self.instance_url}/{username}.keys'
-        async with aiohttp.ClientSession() as session, async_timeout.timeout(5):
-            async with session.get(url) as response:
-                keys = await response.text()
-        if keys:
-            # Remove comment fields from SSH keys, as asyncssh seems to choke on those
-            keys = "\n".join(re.findall("^[^ ]+ [^ ]+", keys, flags=re.M))
-            self.conn.set_authorized_keys(asyncssh.import_authorized_keys(keys))
-        # Return true to indicate we always *must* authenticate
-        return True
+        return await super().begin_auth(username)
@@ -0,0 +1,178 @@
+"""
+Authenticate against public keys users publish at a URL, like github.com/{username}.keys
+
+Fetched keys are parsed once & cached per user. Once they are older than
+keys_cache_ttl they are revalidated with If-None-Match, which usually just
+gets a '304 Not Modified' back. If the keys can't be fetched at all, the
+last keys we have are used for up to keys_max_stale seconds, so an outage
+of the key server doesn't lock everyone out.
+"""
+import time
+
+import aiohttp
+import asyncssh
+from traitlets import Float, Integer
+
+from kubessh import metrics
+from kubessh.authentication import Authenticator
+from kubessh.authentication.gateway import AuthGateway, BackendError, BackendUnavailable
+from kubessh.cache import LRUCache
+
+KEYS_CACHE_HITS = metrics.counter(
+    'kubessh_auth_keys_cache_hits_total',
+    'Public key lookups answered from the keys cache'
+)
+KEYS_FETCHES = metrics.counter(
+    'kubessh_auth_keys_fetches_total',
+    'Public key lookups that had to ask the key server'
+)
+KEYS_NOT_MODIFIED = metrics.counter(
+    'kubessh_auth_keys_not_modified_total',
+    'Key server answers saying the cached keys are still current'
+)
+KEYS_STALE = metrics.counter(
+    'kubessh_auth_keys_stale_total',
+    'Public key lookups answered with outdated keys, because the key server could not be reached'
+)
+
+
+class _CachedKeys:
+    def __init__(self, keys, etag):
+        # Parsed asyncssh.SSHAuthorizedKeys, or None if the user has none
+        self.keys = keys
+        self.etag = etag
+        self.fetched = time.monotonic()
+
+
+class KeysURLAuthenticator(Authenticator):
+    """
+    Base class for authenticators using public keys published at a per-user URL.
+
+    Subclasses implement keys_url, and set backend_name.
+    """
+    keys_cache_ttl = Float(
+        300,
+        help="""
+        Seconds to use fetched public keys for, before checking with the key server again.
+        """,
+        config=True
+    )
+
+    keys_max_stale = Float(
+        24 * 60 * 60,
+        help="""
+        Seconds to keep using outdated keys for, while the key server can't be reached.
+        """,
+        config=True
+    )
+
+    keys_cache_size = Integer(
+        4096,
+        help="""
+        Maximum number of users whose public keys are kept in memory.
+        """,
+        config=True
+    )
+
+    # Name of the AuthGateway guarding requests to the key server
+    backend_name = None
+
+    # class -> aiohttp.ClientSession / LRUCache of username -> _CachedKeys
+    _sessions = {}
+    _caches = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gateway = AuthGateway.instance_for(self.backend_name, parent=self.parent)
+
+    def public_key_auth_supported(self):
+        return True
+
+    def keys_url(self, username):
+        """
+        Return URL at which username's public keys are published
+        """
+        raise NotImplementedError()
+
+    def parse_keys(self, text):
+        """
+        Return asyncssh.SSHAuthorizedKeys from the key server's response
+        """
+        return asyncssh.import_authorized_keys(text)
+
+    @property
+    def session(self):
+        # Created lazily, since it must be created from inside the event loop.
+        # One per authenticator class, keeping connections to the key server alive.
+        cls = type(self)
+        session = self._sessions.get(cls)
+        if session is None or session.closed:
+            session = self._sessions[cls] = aiohttp.ClientSession()
+        return session
+
+    @property
+    def keys_cache(self):
+        cls = type(self)
+        if cls not in self._caches:
+            self._caches[cls] = LRUCache(self.keys_cache_size)
+        return self._caches[cls]
+
+    async def _fetch_keys(self, username, cached):
+        url = self.keys_url(username)
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                KEYS_NOT_MODIFIED.inc()
+                return _CachedKeys(cached.keys, cached.etag)
+            if response.status == 404:
+                # No such user
+                return _CachedKeys(None, None)
+            if response.status != 200:
+                # Rate limits (403, 429) & outages, not an answer about the user's keys
+                raise BackendError(f'{url} answered {response.status}')
+            text = await response.text()
+
+        keys = None
+        etag = response.headers.get('ETag')
+        if text.strip():
+            try:
+                keys = self.parse_keys(text)
+            except (asyncssh.KeyImportError, ValueError) as e:
+                self.log.error(f'Could not parse keys from {url}: {e}')
+                # Don't let 304s keep answering with keys we couldn't parse
+                etag = None
+        return _CachedKeys(keys, etag)
+
+    async def get_authorized_keys(self, username):
+        """
+        Return asyncssh.SSHAuthorizedKeys for username, or None if they have none
+        """
+        cached = self.keys_cache.get(username)
+        if cached is not None and time.monotonic() - cached.fetched < self.keys_cache_ttl:
+            KEYS_CACHE_HITS.inc()
+            return cached.keys
+
+        KEYS_FETCHES.inc()
+        try:
+            fetched = await self.gateway.call(lambda: self._fetch_keys(username, cached), hedge=True)
+        except BackendUnavailable as e:
+            if cached is not None and time.monotonic() - cached.fetched < self.keys_max_stale:
+                self.log.warning(f'Using outdated keys for {username}, could not fetch new ones: {e}')
+                KEYS_STALE.inc()
+                return cached.keys
+            self.log.error(f'Could not fetch keys for {username}: {e}')
+            return None
+        self.keys_cache[username] = fetched
+        return fetched.keys
+
+    async def begin_auth(self, username):
+        """
+        Fetch and save user's keys for comparison later
+        """
+        keys = await self.get_authorized_keys(username)
+        if keys:
+            self.conn.set_authorized_keys(keys)
+        # Return true to indicate we always *must* authenticate
+        return True
@@ -0,0 +1,257 @@
+"""
+Public key logins for dcucode users, without asking the backend at login.
+
+Password logins cost an RSA encryption & a round trip to the dcucode
+backend each time. Instead, the public keys users registered with dcucode
+are copied into a local SQLite database, which is kept in sync in the
+background by asking the backend only for what changed since the last
+sync. At login, the user's keys come from an in-memory dict loaded from
+that database, so checking them needs no network at all. Users without
+keys still log in with their password.
+"""
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import asyncssh
+from traitlets.config import SingletonConfigurable
+from traitlets import Float, Integer, Unicode
+
+from kubessh import metrics
+from kubessh.authentication.dummy import DummyAuthenticator
+from kubessh.authentication.gateway import AuthGateway, BackendError, BackendUnavailable
+from kubessh.cache import LRUCache
+
+KEYSTORE_LOOKUPS = metrics.counter(
+    'kubessh_keystore_lookups_total',
+    'Logins that looked up public keys in the local key store'
+)
+KEYSTORE_HITS = metrics.counter(
+    'kubessh_keystore_hits_total',
+    'Logins that found public keys for the user in the local key store'
+)
+KEYSTORE_SYNC_FAILURES = metrics.counter(
+    'kubessh_keystore_sync_failures_total',
+    'Syncs of the local key store with the backend that failed'
+)
+KEYSTORE_SYNC_DURATION = metrics.summary(
+    'kubessh_keystore_sync_duration_seconds',
+    'Time taken to sync the local key store with the backend'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS public_keys (username TEXT PRIMARY KEY, keys TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class KeyStore(SingletonConfigurable):
+    """
+    Local copy of the public keys registered with the dcucode backend.
+    """
+    db_path = Unicode(
+        'kubessh_keys.sqlite',
+        help="""
+        Path to the SQLite database public keys are kept in.
+
+        Keeping it on persistent storage lets KubeSSH restart without
+        fetching every key again.
+        """,
+        config=True
+    )
+
+    sync_url = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        URL to fetch changed public keys from.
+
+        If None (the default), keys already in db_path are used, but never synced.
+
+        It is called with a 'since' query parameter holding the cursor from
+        the last answer (empty at first), and should answer with
+
+            {"data": {"users": [{"username": ..., "public_keys": ...}, ...],
+                      "cursor": ..., "more": false},
+             "error": null}
+
+        public_keys is in authorized_keys format. Users whose public_keys
+        are empty or null are removed. If more is true, the next page is
+        fetched right away.
+        """,
+        config=True
+    )
+
+    sync_interval = Float(
+        60,
+        help="""
+        Seconds between syncs with the backend.
+        """,
+        config=True
+    )
+
+    parsed_cache_size = Integer(
+        4096,
+        help="""
+        Maximum number of users whose parsed public keys are kept around.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # username -> authorized_keys text
+        self.keys = {}
+        # username -> asyncssh.SSHAuthorizedKeys, parsed on first use
+        self._parsed = LRUCache(self.parsed_cache_size)
+        self.cursor = ''
+        self.last_synced = None
+        self._db = None
+        # SQLite connections are used from one thread at a time
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='keystore')
+        self._session = None
+        self._task = None
+        # Not the 'dcucode' gateway, so failing syncs don't fail password logins
+        self.gateway = AuthGateway.instance_for('dcucode-keys', parent=self.parent)
+
+        metrics.gauge(
+            'kubessh_keystore_users',
+            'Users with public keys in the local key store',
+            func=lambda: len(self.keys)
+        )
+        metrics.gauge(
+            'kubessh_keystore_sync_age_seconds',
+            'Seconds since the local key store was last synced with the backend',
+            func=lambda: time.monotonic() - self.last_synced if self.last_synced is not None else -1
+        )
+
+    def load(self):
+        """
+        Open the database & load all keys from it into memory
+        """
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self.keys = dict(self._db.execute('SELECT username, keys FROM public_keys'))
+        row = self._db.execute("SELECT value FROM sync_state WHERE name = 'cursor'").fetchone()
+        self.cursor = row[0] if row else ''
+        self._parsed.clear()
+        self.log.info(f'Loaded public keys of {len(self.keys)} users from {self.db_path}')
+
+    def get(self, username):
+        """
+        Return asyncssh.SSHAuthorizedKeys for username, or None if they have none
+        """
+        KEYSTORE_LOOKUPS.inc()
+        keys = self._parsed.get(username)
+        if keys is None:
+            text = self.keys.get(username)
+            if text is None:
+                return None
+            try:
+                keys = asyncssh.import_authorized_keys(text)
+            except (asyncssh.KeyImportError, ValueError) as e:
+                self.log.error(f'Could not parse public keys of {username}: {e}')
+                return None
+            self._parsed[username] = keys
+        KEYSTORE_HITS.inc()
+        return keys
+
+    def _save(self, users, cursor):
+        with self._db:
+            for username, keys in users.items():
+                if keys:
+                    self._db.execute('INSERT OR REPLACE INTO public_keys VALUES (?, ?)', (username, keys))
+                else:
+                    self._db.execute('DELETE FROM public_keys WHERE username = ?', (username,))
+            self._db.execute("INSERT OR REPLACE INTO sync_state VALUES ('cursor', ?)", (cursor,))
+
+    async def _fetch_changes(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+
+        async def fetch():
+            async with self._session.get(self.sync_url, params={'since': self.cursor}) as response:
+                if response.status >= 500:
+                    raise BackendError(f'{self.sync_url} answered {response.status}')
+                if response.status != 200:
+                    # The backend is up, but won't sync - not a reason to stop asking it
+                    return response.status, None
+                return response.status, await response.json(content_type=None)
+
+        status, response_data = await self.gateway.call(fetch)
+        if response_data is None:
+            raise BackendError(f'{self.sync_url} answered {status}')
+        if response_data['error'] is not None:
+            raise BackendError(f"{self.sync_url} answered {response_data['error']}")
+        return response_data['data']
+
+    async def sync(self):
+        """
+        Fetch keys changed since the last sync from the backend, & store them
+        """
+        start = time.perf_counter()
+        more = True
+        while more:
+            data = await self._fetch_changes()
+            users = {user['username']: (user.get('public_keys') or '').strip() for user in data['users']}
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._save, users, data['cursor'])
+            for username, keys in users.items():
+                if keys:
+                    self.keys[username] = keys
+                else:
+                    self.keys.pop(username, None)
+                self._parsed.pop(username)
+            self.cursor = data['cursor']
+            more = data.get('more', False)
+            if users:
+                self.log.info(f'Synced public keys of {len(users)} users')
+        self.last_synced = time.monotonic()
+        KEYSTORE_SYNC_DURATION.observe(time.perf_counter() - start)
+
+    def start(self, loop=None):
+        """
+        Load keys, and start keeping them in sync in the background
+        """
+        if self._task is not None:
+            return
+        self.load()
+        if self.sync_url is None:
+            self.log.warning('KeyStore.sync_url is not set, public keys will not be synced')
+            return
+        loop = loop or asyncio.get_event_loop()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except (BackendError, BackendUnavailable) as e:
+                KEYSTORE_SYNC_FAILURES.inc()
+                self.log.error(f'Could not sync public keys: {e}')
+            except Exception:
+                KEYSTORE_SYNC_FAILURES.inc()
+                self.log.exception('Could not sync public keys')
+            await asyncio.sleep(self.sync_interval)
+
+
+class KeyStoreAuthenticator(DummyAuthenticator):
+    """
+    Authenticate dcucode users with their public keys from the local KeyStore.
+
+    Users without public keys, or whose key doesn't match, can still log in
+    with their password.
+    """
+    def public_key_auth_supported(self):
+        return True
+
+    async def begin_auth(self, username):
+        """
+        Save user's keys for comparison later
+        """
+        keys = KeyStore.instance(parent=self.parent).get(username)
+        if keys:
+            self.conn.set_authorized_keys(keys)
+        # Return true to indicate we always *must* authenticate
+        return True
@@ -0,0 +1,253 @@
+"""
+Run short non-interactive commands through a per-pod exec broker.
+
+Opening an exec stream costs an API server round trip, a kubelet round
+trip and a process start inside the container - hundreds of milliseconds.
+Tools like VS Code run dozens of tiny commands over ssh, so instead we
+start kubessh.brokerd once per pod over a single exec stream, and multiplex
+every later command over it, each with its own stdio & exit status.
+"""
+import asyncio
+import itertools
+import json
+import os
+import struct
+import time
+
+import aiohttp
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool, Integer, List
+
+from kubessh import metrics
+from kubessh import brokerd
+from kubessh.streams import KubeStreams, STDIN_CHANNEL, STDOUT_CHANNEL, STDERR_CHANNEL
+
+with open(os.path.join(os.path.dirname(__file__), 'brokerd.py')) as f:
+    BROKERD_SOURCE = f.read()
+
+
+class BrokerUnavailable(Exception):
+    """
+    Raised when the broker could not be started in a pod.
+
+    Callers should fall back to a regular exec.
+    """
+
+
+class BrokerConnection:
+    """
+    Client side of one broker, multiplexing many commands.
+
+    Transport agnostic: bytes the broker wrote are fed in with feed(), and
+    write is an async callable sending bytes to the broker's stdin.
+    """
+    def __init__(self, write):
+        self._write = write
+        self._buffer = bytearray()
+        self._ids = itertools.count(1)
+        self.requests = {}
+        self.ready = asyncio.get_event_loop().create_future()
+        self.closed = False
+
+    def feed(self, data):
+        self._buffer += data
+        header_size = brokerd.HEADER.size
+        while len(self._buffer) >= header_size:
+            type, request_id, length = brokerd.HEADER.unpack_from(self._buffer)
+            if len(self._buffer) < header_size + length:
+                break
+            payload = bytes(self._buffer[header_size:header_size + length])
+            del self._buffer[:header_size + length]
+            if type == brokerd.HELLO:
+                if not self.ready.done():
+                    self.ready.set_result(True)
+            elif request_id in self.requests:
+                self.requests[request_id].put_nowait((type, payload))
+
+    def connection_lost(self):
+        self.closed = True
+        if not self.ready.done():
+            self.ready.set_exception(BrokerUnavailable('Broker exited before it was ready'))
+        for queue in self.requests.values():
+            queue.put_nowait((None, None))
+
+    async def send(self, type, request_id, payload=b''):
+        await self._write(brokerd.frame(type, request_id, payload))
+
+    async def exec(self, ssh_process, command):
+        """
+        Run command through the broker, connected to ssh_process. Returns exit status.
+        """
+        request_id = next(self._ids)
+        queue = asyncio.Queue()
+        self.requests[request_id] = queue
+        send_stdin = None
+        exit_status = None
+        try:
+            await self.send(brokerd.START, request_id, json.dumps({'argv': command}).encode())
+            send_stdin = asyncio.ensure_future(self._send_stdin(ssh_process, request_id))
+            while True:
+                type, payload = await queue.get()
+                if type == brokerd.STDOUT:
+                    ssh_process.stdout.write(payload)
+                    await ssh_process.stdout.drain()
+                elif type == brokerd.STDERR:
+                    ssh_process.stderr.write(payload)
+                    await ssh_process.stderr.drain()
+                elif type == brokerd.EXIT:
+                    exit_status = struct.unpack('!i', payload)[0]
+                    return exit_status
+                else:
+                    # Broker went away mid-command
+                    return 255
+        finally:
+            if send_stdin is not None:
+                send_stdin.cancel()
+            del self.requests[request_id]
+            if exit_status is None and not self.closed:
+                await self.send(brokerd.KILL, request_id)
+
+    async def _send_stdin(self, ssh_process, request_id):
+        while True:
+            data = await ssh_process.stdin.read(65536)
+            if not data:
+                break
+            await self.send(brokerd.STDIN, request_id, data)
+        await self.send(brokerd.STDIN_EOF, request_id)
+
+
+class ExecBroker(SingletonConfigurable):
+    """
+    Keep one broker running per user pod & send non-interactive commands to it.
+    """
+    enabled = Bool(
+        False,
+        help="""
+        Run non-interactive ssh commands through a long running broker in each pod.
+
+        Requires a python3 interpreter inside the user's shell container. If
+        the broker can not be started, commands are run with a regular exec.
+        """,
+        config=True
+    )
+
+    command = List(
+        ['python3', '-u', '-c', '{brokerd}'],
+        help="""
+        Command used to start the broker inside the shell container.
+
+        '{brokerd}' is replaced with the source of kubessh.brokerd.
+        """,
+        config=True
+    )
+
+    start_timeout = Integer(
+        5,
+        help="""
+        Seconds to wait for a new broker to report it is ready.
+        """,
+        config=True
+    )
+
+    retry_interval = Integer(
+        300,
+        help="""
+        Seconds to wait before trying to start a broker again in a pod where it failed.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (namespace, pod_name) -> future resolving to BrokerConnection
+        self.connections = {}
+        # (namespace, pod_name) -> time the broker last failed to start
+        self.failed = {}
+        self.hits = metrics.counter(
+            'kubessh_exec_broker_commands_total',
+            'Commands run through an exec broker'
+        )
+        self.fallbacks = metrics.counter(
+            'kubessh_exec_broker_fallbacks_total',
+            'Commands that could not use an exec broker and fell back to a regular exec'
+        )
+        self.duration = metrics.summary(
+            'kubessh_exec_broker_command_duration_seconds',
+            'Time taken by commands run through an exec broker'
+        )
+
+    async def _start(self, key, namespace, pod_name, container):
+        command = [arg.replace('{brokerd}', BROKERD_SOURCE) for arg in self.command]
+        ws = await KubeStreams.instance().connect(namespace, pod_name, 'exec', {
+            'container': container,
+            'command': command,
+            'stdin': 'true',
+            'stdout': 'true',
+            'stderr': 'true',
+            'tty': 'false',
+        }, KubeStreams.protocols)
+
+        async def write(data):
+            await ws.send_bytes(bytes([STDIN_CHANNEL]) + data)
+
+        connection = BrokerConnection(write)
+
+        async def read():
+            try:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.BINARY or len(msg.data) < 2:
+                        continue
+                    if msg.data[0] == STDOUT_CHANNEL:
+                        connection.feed(msg.data[1:])
+                    elif msg.data[0] == STDERR_CHANNEL:
+                        self.log.debug(f'Broker in {pod_name}: {msg.data[1:]!r}')
+            finally:
+                connection.connection_lost()
+                if self.connections.get(key) is connection_future:
+                    del self.connections[key]
+                await ws.close()
+
+        connection_future = self.connections[key]
+        asyncio.ensure_future(read())
+        try:
+            await asyncio.wait_for(asyncio.shield(connection.ready), self.start_timeout)
+        except (asyncio.TimeoutError, BrokerUnavailable):
+            await ws.close()
+            raise BrokerUnavailable(f'Could not start exec broker in {pod_name}')
+        self.log.info(f'Started exec broker in {pod_name}')
+        return connection
+
+    async def get_connection(self, namespace, pod_name, container):
+        key = (namespace, pod_name)
+        if time.monotonic() - self.failed.get(key, -self.retry_interval) < self.retry_interval:
+            raise BrokerUnavailable(f'Exec broker recently failed in {pod_name}')
+        if key not in self.connections:
+            self.connections[key] = asyncio.ensure_future(self._start(key, namespace, pod_name, container))
+        future = self.connections[key]
+        try:
+            return await asyncio.shield(future)
+        except Exception as e:
+            if self.connections.get(key) is future:
+                del self.connections[key]
+                self.failed[key] = time.monotonic()
+                self.log.info(f'Exec broker unavailable in {pod_name}: {e}')
+            raise BrokerUnavailable(str(e))
+
+    async def exec(self, ssh_process, namespace, pod_name, container, command):
+        """
+        Run command through the pod's broker. Returns exit status.
+
+        Raises BrokerUnavailable before touching ssh_process if the
+        broker can't be used, so the caller can do a regular exec.
+        """
+        try:
+            connection = await self.get_connection(namespace, pod_name, container)
+        except BrokerUnavailable:
+            self.fallbacks.inc()
+            raise
+        self.hits.inc()
+        start = time.perf_counter()
+        try:
+            return await connection.exec(ssh_process, command)
+        finally:
+            self.duration.observe(time.perf_counter() - start)
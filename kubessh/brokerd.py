@@ -0,0 +1,148 @@
+"""
+Exec broker daemon, run inside user pods.
+
+KubeSSH starts this once per pod over a single long-lived exec stream, and
+then runs many short, non-interactive commands through it without paying
+for a new exec stream each time. It only uses the standard library, since
+it runs with whatever python3 the user's image has.
+
+Requests and responses are framed on stdin / stdout as:
+
+    type (1 byte) | request id (4 bytes) | payload length (4 bytes) | payload
+"""
+import asyncio
+import json
+import os
+import struct
+import sys
+
+HEADER = struct.Struct('!BII')
+
+# Broker -> client
+HELLO = 0
+STDOUT = 5
+STDERR = 6
+EXIT = 7
+# Client -> broker
+START = 1
+STDIN = 2
+STDIN_EOF = 3
+KILL = 4
+
+
+def frame(type, request_id, payload=b''):
+    return HEADER.pack(type, request_id, len(payload)) + payload
+
+
+class Request:
+    def __init__(self, broker, request_id, argv):
+        self.broker = broker
+        self.request_id = request_id
+        self.argv = argv
+        self.stdin = asyncio.Queue()
+        self.process = None
+
+    async def run(self):
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.argv,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+        except OSError as e:
+            self.broker.send(STDERR, self.request_id, '{}: {}\n'.format(self.argv[0], e.strerror).encode())
+            self.broker.send(EXIT, self.request_id, struct.pack('!i', 127))
+            return
+
+        feed = asyncio.ensure_future(self.feed_stdin())
+        await asyncio.gather(
+            self.pump(self.process.stdout, STDOUT),
+            self.pump(self.process.stderr, STDERR),
+        )
+        returncode = await self.process.wait()
+        feed.cancel()
+        if returncode < 0:
+            # Killed by a signal, report it the way shells do
+            returncode = 128 - returncode
+        self.broker.send(EXIT, self.request_id, struct.pack('!i', returncode))
+
+    async def feed_stdin(self):
+        try:
+            while True:
+                data = await self.stdin.get()
+                if data is None:
+                    break
+                self.process.stdin.write(data)
+                await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.process.stdin.close()
+
+    async def pump(self, stream, type):
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                break
+            self.broker.send(type, self.request_id, data)
+            await self.broker.writer.drain()
+
+
+class Broker:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.requests = {}
+
+    def send(self, type, request_id, payload=b''):
+        self.writer.write(frame(type, request_id, payload))
+
+    def _finished(self, request_id, task):
+        self.requests.pop(request_id, None)
+
+    async def serve(self):
+        self.send(HELLO, 0)
+        while True:
+            try:
+                header = await self.reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError:
+                # KubeSSH went away, take everything down with us
+                break
+            type, request_id, length = HEADER.unpack(header)
+            payload = await self.reader.readexactly(length) if length else b''
+
+            if type == START:
+                request = Request(self, request_id, json.loads(payload.decode())['argv'])
+                self.requests[request_id] = request
+                task = asyncio.ensure_future(request.run())
+                task.add_done_callback(lambda t, r=request_id: self._finished(r, t))
+            elif request_id in self.requests:
+                request = self.requests[request_id]
+                if type == STDIN:
+                    request.stdin.put_nowait(payload)
+                elif type == STDIN_EOF:
+                    request.stdin.put_nowait(None)
+                elif type == KILL and request.process is not None:
+                    request.process.kill()
+
+        for request in self.requests.values():
+            if request.process is not None and request.process.returncode is None:
+                request.process.kill()
+
+
+async def main():
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(sys.stdin.fileno(), 'rb', 0))
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    )
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    await Broker(reader, writer).serve()
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
@@ -0,0 +1,48 @@
+"""
+Small in-memory caches.
+"""
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Dict-like cache holding at most maxsize items, evicting the least recently used.
+
+    If ttl is set, items older than ttl seconds are treated as missing.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (time stored, value)
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            stored, value = self._items[key]
+        except KeyError:
+            return default
+        if self.ttl is not None and time.monotonic() - stored > self.ttl:
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = (time.monotonic(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._items.clear()
@@ -2,15 +2,70 @@
 Standalone daemon to clean up finished shell pods.
 
 User pods can mark themselves as 'completed' by killing their
-pid 1 (kill 1)d
+pid 1 (kill 1). Pods that have completed or failed are deleted as soon as
+the pod watch tells us about them, so they don't keep holding on to node
+resources. Pods stuck Terminating for too long (for example on a node
+that went away) are force deleted. If idle_timeout is set, pods nobody
+has had an ssh session to for that long are deleted too (see
+kubessh.sessions) - their PVCs stay, so users get their files back in a
+new pod at their next login.
 
+Deletes are made concurrently by a few workers, and retried with
+exponential backoff if they fail.
 """
-import kubernetes
-import time
+import asyncio
+import datetime
 import logging
 import os
+import time
+
+import kubernetes
+from kubernetes import client as k
+from aiohttp import web
 from traitlets.config import Application
-from traitlets import Unicode, default, Bool
+from traitlets import Unicode, default, Bool, Integer, Float
+
+from kubessh import metrics
+from kubessh.informer import PodInformer
+from kubessh.kubeapi import KubeApi
+from kubessh.pool import POOL_LABEL
+from kubessh.sessions import last_active
+from kubessh.storage import StorageCollector
+
+DELETIONS = metrics.counter(
+    'kubessh_cleanup_deletions_total',
+    'Finished user pods deleted'
+)
+IDLE_DELETIONS = metrics.counter(
+    'kubessh_cleanup_idle_deletions_total',
+    'User pods deleted for having had no ssh sessions for idle_timeout'
+)
+FORCE_DELETIONS = metrics.counter(
+    'kubessh_cleanup_force_deletions_total',
+    'User pods force deleted after being stuck Terminating'
+)
+DELETE_FAILURES = metrics.counter(
+    'kubessh_cleanup_delete_failures_total',
+    'Pod deletes that failed, & will be retried'
+)
+RECONCILE_LAG = metrics.summary(
+    'kubessh_cleanup_lag_seconds',
+    'Time from a pod finishing (or its grace period or idle_timeout running out) to it being deleted'
+)
+
+
+def _finished_at(pod):
+    """
+    Return the time the last container of pod stopped, or None if unknown
+    """
+    finished = [
+        status.state.terminated.finished_at
+        for status in (pod.status.container_statuses or [])
+        if status.state is not None and status.state.terminated is not None
+        and status.state.terminated.finished_at is not None
+    ]
+    return max(finished) if finished else None
+
 
 class KubeSanitation(Application):
     config_file = Unicode(
@@ -35,6 +90,71 @@ class KubeSanitation(Application):
         config=True
     )
 
+    max_concurrent_deletes = Integer(
+        8,
+        help="""
+        Maximum number of pod deletes in flight at the same time.
+        """,
+        config=True
+    )
+
+    terminating_timeout = Float(
+        300,
+        help="""
+        Seconds a pod may stay Terminating past its grace period before it is force deleted.
+        """,
+        config=True
+    )
+
+    idle_timeout = Float(
+        0,
+        help="""
+        Seconds after the last ssh session to a pod ends before the pod is deleted.
+
+        Must be comfortably longer than SessionTracker.heartbeat_interval of
+        KubeSSH. Pods without a last-active annotation (created before
+        KubeSSH tracked sessions) count as idle since they were created.
+        0 disables deleting idle pods.
+        """,
+        config=True
+    )
+
+    retry_delay = Float(
+        1,
+        help="""
+        Seconds to wait before retrying a failed delete. Doubles with every failure.
+        """,
+        config=True
+    )
+
+    max_retry_delay = Float(
+        60,
+        help="""
+        Maximum seconds to wait before retrying a failed delete.
+        """,
+        config=True
+    )
+
+    resync_interval = Float(
+        30,
+        help="""
+        Seconds between checks of all cached pods, catching pods stuck Terminating.
+        """,
+        config=True
+    )
+
+    metrics_port = Integer(
+        None,
+        allow_none=True,
+        help="""
+        Port to serve Prometheus style metrics on, at /metrics.
+
+        Per-user storage use is served as JSON at /storage. If set to
+        None, neither endpoint is started.
+        """,
+        config=True
+    )
+
     @default('namespace')
     def _populate_default_namespace(self):
         # If no namespace to spawn into is specified, use current pod's namespace by default
@@ -45,31 +165,188 @@ class KubeSanitation(Application):
         else:
             return 'default'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = None
+        # pod name -> number of failed deletes, for pods queued or waiting to be retried
+        self.pending = {}
+        # pod name -> monotonic time it was first seen finished
+        self._first_seen = {}
+        # pod name -> uid of the pod we last deleted with that name
+        self._deleted = {}
+        metrics.gauge(
+            'kubessh_cleanup_pending',
+            'Pods waiting to be deleted, including failed deletes waiting to be retried',
+            func=lambda: len(self.pending)
+        )
+
     def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
         self.load_config_file(self.config_file)
         self.log.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        self.kube = KubeApi.instance(parent=self)
+
+    def stuck_since(self, pod, now=None):
+        """
+        Return seconds pod has been Terminating past its grace period, or None if it isn't
+        """
+        if pod.metadata.deletion_timestamp is None:
+            return None
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return (now - pod.metadata.deletion_timestamp).total_seconds()
+
+    def idle_for(self, pod, now=None):
+        """
+        Return seconds since pod's last ssh session ended (or it was created), or None if it isn't idle
+        """
+        if self.idle_timeout <= 0 or pod.metadata.deletion_timestamp is not None:
+            return None
+        if pod.status is None or pod.status.phase not in ('Pending', 'Running'):
+            return None
+        active = last_active(pod) or pod.metadata.creation_timestamp
+        if active is None:
+            return None
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return (now - active).total_seconds()
+
+    def needs_delete(self, pod):
+        """
+        Return True if pod should be (force) deleted
+        """
+        if (pod.metadata.labels or {}).get(POOL_LABEL) == 'available':
+            # The warm pool cleans up its own pods, along with their PVCs
+            return False
+        stuck = self.stuck_since(pod)
+        if stuck is not None:
+            return stuck > self.terminating_timeout
+        if pod.status is not None and pod.status.phase in ('Succeeded', 'Failed'):
+            return True
+        idle = self.idle_for(pod)
+        return idle is not None and idle > self.idle_timeout
+
+    def on_pod_change(self, pod_name, pod):
+        if pod is None:
+            self.pending.pop(pod_name, None)
+            self._first_seen.pop(pod_name, None)
+            self._deleted.pop(pod_name, None)
+            return
+        if pod.metadata.deletion_timestamp is None and self._deleted.get(pod_name) == pod.metadata.uid:
+            # Deleted already, the watch just hasn't caught up yet
+            return
+        if pod_name not in self.pending and self.needs_delete(pod):
+            self.pending[pod_name] = 0
+            self._first_seen.setdefault(pod_name, time.monotonic())
+            self.queue.put_nowait(pod_name)
+
+    def resync(self):
+        for pod_name, pod in list(self.informer.pods.items()):
+            self.on_pod_change(pod_name, pod)
+
+    def _lag(self, pod_name, pod):
+        stuck = self.stuck_since(pod)
+        if stuck is not None:
+            return stuck - self.terminating_timeout
+        idle = self.idle_for(pod)
+        if idle is not None:
+            return idle - self.idle_timeout
+        finished = _finished_at(pod)
+        if finished is not None:
+            return (datetime.datetime.now(datetime.timezone.utc) - finished).total_seconds()
+        return time.monotonic() - self._first_seen[pod_name]
+
+    async def delete(self, pod_name):
+        """
+        Delete pod if it still needs deleting, re-queueing it with backoff if that fails
+        """
+        pod = self.informer.get(pod_name)
+        if pod is None or not self.needs_delete(pod):
+            self.pending.pop(pod_name, None)
+            return
+
+        force = pod.metadata.deletion_timestamp is not None
+        idle = self.idle_for(pod) is not None
+        if idle:
+            # Fails if a session started (& refreshed last-active) since we looked
+            preconditions = k.V1Preconditions(resource_version=pod.metadata.resource_version)
+        else:
+            preconditions = k.V1Preconditions(uid=pod.metadata.uid)
+        options = k.V1DeleteOptions(preconditions=preconditions)
+        if force:
+            options.grace_period_seconds = 0
         try:
-            kubernetes.config.load_incluster_config()
-        except kubernetes.config.ConfigException:
-            kubernetes.config.load_kube_config()
+            await self.kube.run(self.kube.v1.delete_namespaced_pod, pod_name, self.namespace, body=options)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status in (404, 409):
+                # Already gone, replaced by a new pod with the same name, or changed since we
+                # looked. The watch will tell us if there is anything left to do.
+                self.pending.pop(pod_name, None)
+            else:
+                self._retry(pod_name, e)
+            return
+        except Exception as e:
+            self._retry(pod_name, e)
+            return
+
+        if force:
+            self.log.info(f'Force deleted pod {pod_name}, stuck Terminating')
+            FORCE_DELETIONS.inc()
+        elif idle:
+            self.log.info(f'Deleted pod {pod_name}, without ssh sessions for over {self.idle_timeout}s')
+            IDLE_DELETIONS.inc()
+        else:
+            self.log.info(f'Deleted {pod.status.phase.lower()} pod {pod_name}')
+            DELETIONS.inc()
+        RECONCILE_LAG.observe(max(0, self._lag(pod_name, pod)))
+        self.pending.pop(pod_name, None)
+        self._deleted[pod_name] = pod.metadata.uid
+
+    def _retry(self, pod_name, error):
+        DELETE_FAILURES.inc()
+        failures = self.pending.get(pod_name, 0) + 1
+        self.pending[pod_name] = failures
+        delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+        self.log.warning(f'Could not delete pod {pod_name}, retrying in {delay}s: {error}')
+        asyncio.get_event_loop().call_later(delay, self.queue.put_nowait, pod_name)
 
-    def start(self):
-        v1 = kubernetes.client.CoreV1Api()
+    async def _worker(self):
         while True:
-            pods = v1.list_namespaced_pod(self.namespace, field_selector="status.phase=Succeeded")
-            if len(pods.items):
-                for pod in pods.items:
-                    self.log.info(f"Deleting pod {pod.metadata.name}...")
-                    v1.delete_namespaced_pod(pod.metadata.name, self.namespace)
-            else:
-                self.log.info("No completed pods found")
-            time.sleep(30)
+            pod_name = await self.queue.get()
+            try:
+                await self.delete(pod_name)
+            except Exception:
+                self.log.exception(f'Unexpected error deleting pod {pod_name}')
+
+    async def _handle_storage(self, request):
+        return web.json_response(self.storage.report())
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.informer = PodInformer.instance_for(self.namespace, parent=self)
+        self.informer.add_listener(self.on_pod_change)
+        self.informer.start()
+        workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_concurrent_deletes)]
+        self.storage = StorageCollector(self.informer, parent=self, namespace=self.namespace)
+        workers.append(asyncio.ensure_future(self.storage.run()))
+
+        if self.metrics_port is not None:
+            # Per-user storage use, too detailed for metrics
+            await metrics.serve(self.metrics_port, self.log, {'/storage': self._handle_storage})
+
+        try:
+            while True:
+                await asyncio.sleep(self.resync_interval)
+                # Pods becoming stuck Terminating don't change, so there is no event for them
+                if self.informer.synced:
+                    self.resync()
+        finally:
+            for worker in workers:
+                worker.cancel()
 
 
 def main():
     app = KubeSanitation()
     app.initialize()
-    app.start()
+    asyncio.get_event_loop().run_until_complete(app.start())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,313 @@
+"""
+Process wide, watch backed cache of user pods.
+
+Instead of asking the Kubernetes API about a user's pod on every login,
+we list all user pods once, then keep watching for changes. Lookups are
+answered from an in-memory index keyed by pod name and by username.
+
+The kubernetes python client's watch is blocking, so it runs in its own
+thread. All changes to the index are handed over to the asyncio event loop
+with call_soon_threadsafe, so the index is only ever touched from the loop
+thread and needs no locking.
+"""
+import asyncio
+import threading
+import time
+
+import kubernetes
+from traitlets.config import LoggingConfigurable
+from traitlets import Bool, Integer, Unicode
+
+from kubessh import metrics
+from kubessh.kubeapi import KubeApi
+
+USERNAME_LABEL = 'kubessh.yuvi.in/username'
+
+
+def _uid_matches(pod, uid):
+    return uid is None or pod.metadata.uid == uid
+
+
+class PodInformer(LoggingConfigurable):
+    """
+    List & watch user pods in a namespace, keeping an index of them in memory.
+
+    Until the initial list has completed the informer is not `synced`, and
+    callers should fall back to asking the API directly.
+    """
+    enabled = Bool(
+        True,
+        help="""
+        Answer pod lookups from a watch backed in-memory cache.
+
+        If disabled, every login reads the user's pod from the Kubernetes API.
+        """,
+        config=True
+    )
+
+    label_selector = Unicode(
+        'kubessh=userpods',
+        help="""
+        Label selector matching the pods that should be cached.
+        """,
+        config=True
+    )
+
+    watch_timeout = Integer(
+        300,
+        help="""
+        Seconds after which each watch request is ended & restarted.
+
+        The API server might silently drop long running watches, so we
+        restart them periodically from the last seen resourceVersion.
+        """,
+        config=True
+    )
+
+    retry_delay = Integer(
+        5,
+        help="""
+        Seconds to wait before re-listing after an unexpected watch error.
+        """,
+        config=True
+    )
+
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace to watch pods in.
+        """,
+    )
+
+    _instances = {}
+
+    @classmethod
+    def instance_for(cls, namespace, **kwargs):
+        """
+        Return the shared informer for namespace, creating it if needed.
+        """
+        if namespace not in cls._instances:
+            cls._instances[namespace] = cls(namespace=namespace, **kwargs)
+        return cls._instances[namespace]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # pod name -> V1Pod
+        self.pods = {}
+        # username label -> set of pod names
+        self.pods_by_user = {}
+        self.synced = False
+        self.resource_version = None
+
+        # pod name -> list of (predicate, future) waiting for that pod to change
+        self._waiters = {}
+        # callables called with (pod name, pod or None) on every change
+        self._listeners = []
+
+        self.loop = None
+        self._thread = None
+        self._watch = None
+        self._stopped = False
+
+        self.hits = metrics.counter(
+            'kubessh_pod_cache_hits_total',
+            'Pod lookups answered from the pod cache'
+        )
+        self.misses = metrics.counter(
+            'kubessh_pod_cache_misses_total',
+            'Pod lookups that had to go to the Kubernetes API'
+        )
+        self.relists = metrics.counter(
+            'kubessh_pod_cache_relists_total',
+            'Number of times the pod cache was rebuilt from a full list'
+        )
+        metrics.gauge(
+            'kubessh_pod_cache_size',
+            'Number of pods currently in the pod cache',
+            func=lambda: len(self.pods)
+        )
+
+    def start(self, loop=None):
+        """
+        Start listing & watching pods in a background thread
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        self.loop = loop or asyncio.get_event_loop()
+        self._thread = threading.Thread(target=self._run, name=f'pod-informer-{self.namespace}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._watch is not None:
+            self._watch.stop()
+
+    def get(self, pod_name):
+        """
+        Return cached pod with given name, or None if there is no such pod
+        """
+        return self.pods.get(pod_name)
+
+    def get_by_username(self, username):
+        """
+        Return list of cached pods belonging to given (escaped) username
+        """
+        return [self.pods[name] for name in self.pods_by_user.get(username, ()) if name in self.pods]
+
+    def wait_for(self, pod_name, predicate, uid=None):
+        """
+        Return a future resolving to the pod once predicate(pod) is true.
+
+        predicate is called with the cached pod whenever it changes, and
+        with None if the pod is deleted. Must be called from the event loop.
+
+        If uid is set, only the pod with that uid counts - older or newer
+        pods of the same name, and their deletion, are ignored.
+        """
+        future = asyncio.get_event_loop().create_future()
+        pod = self.pods.get(pod_name)
+        if pod is not None and _uid_matches(pod, uid) and predicate(pod):
+            future.set_result(pod)
+        else:
+            self._waiters.setdefault(pod_name, []).append((predicate, future, uid))
+        return future
+
+    def add_listener(self, callback):
+        """
+        Call callback(pod_name, pod) on the event loop whenever a pod changes.
+
+        pod is None if it was deleted. After every (re)list, callback is
+        called for all pods in the cache, and with None for pods that
+        disappeared since the last list.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, pod_name, pod, deleted_uid=None):
+        """
+        Tell listeners & waiters pod_name changed to pod, or was deleted if pod is None
+
+        deleted_uid is the uid of the deleted pod, if known.
+        """
+        for callback in self._listeners:
+            callback(pod_name, pod)
+        waiters = self._waiters.pop(pod_name, None)
+        if not waiters:
+            return
+        pending = []
+        for predicate, future, uid in waiters:
+            if future.done():
+                # Caller gave up waiting
+                continue
+            if pod is None:
+                relevant = uid is None or deleted_uid is None or deleted_uid == uid
+            else:
+                relevant = _uid_matches(pod, uid)
+            if relevant and predicate(pod):
+                future.set_result(pod)
+            else:
+                pending.append((predicate, future, uid))
+        if pending:
+            self._waiters[pod_name] = pending
+
+    def _index_add(self, pod):
+        self.pods[pod.metadata.name] = pod
+        username = (pod.metadata.labels or {}).get(USERNAME_LABEL)
+        if username:
+            self.pods_by_user.setdefault(username, set()).add(pod.metadata.name)
+
+    def _index_remove(self, pod_name):
+        pod = self.pods.pop(pod_name, None)
+        if pod is None:
+            return
+        username = (pod.metadata.labels or {}).get(USERNAME_LABEL)
+        names = self.pods_by_user.get(username)
+        if names is not None:
+            names.discard(pod_name)
+            if not names:
+                del self.pods_by_user[username]
+
+    def _replace(self, pods):
+        """
+        Replace entire index with given list of pods. Runs on the event loop.
+        """
+        old_pods = self.pods
+        self.pods = {}
+        self.pods_by_user = {}
+        for pod in pods:
+            self._index_add(pod)
+        self.synced = True
+        # Pods we had, but that are gone from the list, were deleted while we weren't watching
+        for pod_name, pod in old_pods.items():
+            if pod_name not in self.pods:
+                self._notify(pod_name, None, pod.metadata.uid)
+        # Pods we never had might just not have been created yet when we
+        # listed, so only wake up their waiters once they show up
+        for pod_name, pod in self.pods.items():
+            self._notify(pod_name, pod)
+
+    def _apply(self, event_type, pod):
+        """
+        Apply a single watch event to the index. Runs on the event loop.
+        """
+        if event_type == 'DELETED':
+            self._index_remove(pod.metadata.name)
+            self._notify(pod.metadata.name, None, pod.metadata.uid)
+        else:
+            # Labels might have changed, so remove & re-add
+            self._index_remove(pod.metadata.name)
+            self._index_add(pod)
+            self._notify(pod.metadata.name, pod)
+
+    def _relist(self, v1):
+        pods = v1.list_namespaced_pod(self.namespace, label_selector=self.label_selector)
+        self.resource_version = pods.metadata.resource_version
+        self.relists.inc()
+        self.loop.call_soon_threadsafe(self._replace, pods.items)
+        self.log.info(f'Pod cache listed {len(pods.items)} pods in {self.namespace} at resourceVersion {self.resource_version}')
+
+    def _run(self):
+        v1 = KubeApi.instance().watch_v1
+        while not self._stopped:
+            try:
+                if self.resource_version is None:
+                    self._relist(v1)
+                self._watch = kubernetes.watch.Watch()
+                for event in self._watch.stream(
+                    v1.list_namespaced_pod,
+                    self.namespace,
+                    label_selector=self.label_selector,
+                    resource_version=self.resource_version,
+                    timeout_seconds=self.watch_timeout,
+                    allow_watch_bookmarks=True
+                ):
+                    if event['type'] == 'ERROR':
+                        # Older clients hand us the error instead of raising
+                        if event['raw_object'].get('code') == 410:
+                            self.resource_version = None
+                            break
+                        raise kubernetes.client.rest.ApiException(status=event['raw_object'].get('code'))
+                    if event['type'] == 'BOOKMARK':
+                        self.resource_version = self._watch.resource_version
+                        continue
+                    pod = event['object']
+                    self.resource_version = pod.metadata.resource_version
+                    self.loop.call_soon_threadsafe(self._apply, event['type'], pod)
+            except kubernetes.client.rest.ApiException as e:
+                if e.status == 410:
+                    # resourceVersion too old, we missed events. Start over with a fresh list
+                    self.log.info('Pod cache watch expired, relisting')
+                    self.resource_version = None
+                else:
+                    self.log.exception('Pod cache watch failed, relisting')
+                    self._desync()
+            except Exception:
+                self.log.exception('Pod cache watch failed, relisting')
+                self._desync()
+
+    def _desync(self):
+        # Until we have listed again the cache might be missing events,
+        # so make lookups go to the API in the meantime
+        self.resource_version = None
+        self.loop.call_soon_threadsafe(setattr, self, 'synced', False)
+        time.sleep(self.retry_delay)
@@ -0,0 +1,100 @@
+"""
+Shared access to the Kubernetes API.
+
+The kubernetes python client is blocking, so API calls are made from
+threads. Rather than every UserPod starting threads of its own, all calls
+go through one bounded threadpool, with an HTTP connection pool sized to
+match so threads never wait on (or throw away) connections.
+"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import kubernetes.config
+from kubernetes import client as k
+from traitlets.config import SingletonConfigurable
+from traitlets import Integer
+
+from kubessh import metrics
+
+try:
+    kubernetes.config.load_incluster_config()
+except kubernetes.config.ConfigException:
+    kubernetes.config.load_kube_config()
+
+
+class KubeApi(SingletonConfigurable):
+    """
+    Process wide Kubernetes API client & threadpool to make calls from.
+    """
+    max_concurrency = Integer(
+        32,
+        help="""
+        Maximum number of Kubernetes API requests in flight at the same time.
+
+        Requests beyond this are queued. The HTTP connection pool is sized
+        to match, so each thread always has a connection available.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix='kube-api')
+
+        configuration = k.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = self.max_concurrency
+        self.api_client = k.ApiClient(configuration)
+        self.v1 = k.CoreV1Api(self.api_client)
+
+        # Watches hold on to their connection for a long time, so they get
+        # their own client & must not be run from the bounded executor
+        self.watch_v1 = k.CoreV1Api(k.ApiClient(k.Configuration.get_default_copy()))
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        metrics.gauge(
+            'kubessh_kube_api_queue_depth',
+            'Kubernetes API requests waiting for a free thread',
+            func=lambda: self.queued
+        )
+        metrics.gauge(
+            'kubessh_kube_api_in_flight',
+            'Kubernetes API requests currently being made',
+            func=lambda: self.in_flight
+        )
+        self.queue_wait = metrics.summary(
+            'kubessh_kube_api_queue_wait_seconds',
+            'Time Kubernetes API requests spent waiting for a free thread'
+        )
+        self.request_duration = metrics.summary(
+            'kubessh_kube_api_request_duration_seconds',
+            'Time taken by Kubernetes API requests, excluding queueing'
+        )
+
+    def _call(self, submitted, func):
+        started = time.perf_counter()
+        self.queue_wait.observe(started - submitted)
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.request_duration.observe(time.perf_counter() - started)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) in the shared threadpool, returning a future
+        """
+        with self._lock:
+            self.queued += 1
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor,
+            self._call, time.perf_counter(), functools.partial(func, *args, **kwargs)
+        )
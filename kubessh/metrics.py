@@ -0,0 +1,184 @@
+"""
+Minimal in-process metrics for KubeSSH.
+
+We don't want to pull in a metrics library just to count things, so this
+keeps a process wide registry of counters, gauges and latency summaries.
+The registry can be rendered in the Prometheus text exposition format,
+which is what the optional metrics endpoint started by serve() exposes.
+"""
+import threading
+from collections import deque
+
+from aiohttp import web
+
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down.
+
+    If func is passed, it is called to get the current value whenever
+    the gauge is read. This is useful for exposing sizes of queues or
+    caches without having to keep a second copy of the number around.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self._value = 0
+        self.func = func
+
+    @property
+    def value(self):
+        if self.func is not None:
+            return self.func()
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Summary(Metric):
+    """
+    Count, sum and quantiles of observed values (usually durations in seconds).
+
+    Quantiles are computed over the most recent `window` observations only,
+    so memory use stays bounded no matter how long we run.
+    """
+    kind = 'summary'
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, name, help, window=1024):
+        super().__init__(name, help)
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self._recent.append(value)
+
+    def quantile(self, q):
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return 0.0
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+    def samples(self):
+        samples = [
+            (f'{self.name}{{quantile="{q}"}}', self.quantile(q))
+            for q in self.quantiles
+        ]
+        samples.append((f'{self.name}_count', self.count))
+        samples.append((f'{self.name}_sum', self.sum))
+        return samples
+
+
+def _get_or_create(cls, name, help, **kwargs):
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, help, **kwargs)
+        metric = REGISTRY[name]
+    if not isinstance(metric, cls):
+        raise ValueError(f'Metric {name} already registered as a {metric.kind}')
+    return metric
+
+
+def counter(name, help):
+    return _get_or_create(Counter, name, help)
+
+
+def gauge(name, help, func=None):
+    gauge = _get_or_create(Gauge, name, help)
+    if func is not None:
+        # Last registration wins, so re-created objects report their own state
+        gauge.func = func
+    return gauge
+
+
+def summary(name, help, window=1024):
+    return _get_or_create(Summary, name, help, window=window)
+
+
+def render():
+    """
+    Render all registered metrics in Prometheus text exposition format
+    """
+    lines = []
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for sample_name, value in metric.samples():
+            lines.append(f'{sample_name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain')
+
+
+async def serve(port, log, extra_routes=None):
+    """
+    Serve the registry at /metrics on port, until the process exits.
+
+    extra_routes maps more paths to aiohttp GET handlers, for
+    process-specific endpoints served next to the metrics.
+    """
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', _handle_metrics)
+    for path, handler in (extra_routes or {}).items():
+        metrics_app.router.add_get(path, handler)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    log.info(f'Serving metrics on port {port}')
+    return runner
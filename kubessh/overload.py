@@ -0,0 +1,175 @@
+"""
+Load shedding for the ssh front end.
+
+Every connection costs an ssh handshake (with its key exchange), and
+every session an exec stream (or a kubectl process & a PTY) to the user's
+pod. Under a login storm or a brute force scan, taking on all of them
+slows everything down for everyone, including users already working.
+Instead, new work is refused early, with a clear message, once
+
+- max_handshakes connections are still handshaking or authenticating,
+- a user has max_sessions_per_user sessions, or there are max_sessions in total,
+- or the event loop is running more than max_loop_lag seconds behind.
+
+Sessions that were let in are never touched. All limits can be changed
+without a restart, by editing the config file & sending KubeSSH a SIGHUP.
+"""
+import asyncio
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Float, Integer
+
+from kubessh import metrics
+
+
+class LoadShedder(SingletonConfigurable):
+    """
+    Limits on concurrent handshakes & sessions, and event loop lag.
+    """
+    max_handshakes = Integer(
+        100,
+        help="""
+        Maximum number of connections handshaking or authenticating at the same time.
+
+        Further connections are disconnected right away. 0 means no limit.
+        """,
+        config=True
+    )
+
+    max_sessions = Integer(
+        1000,
+        help="""
+        Maximum number of ssh sessions (shells & commands) open at the same time. 0 means no limit.
+        """,
+        config=True
+    )
+
+    max_sessions_per_user = Integer(
+        20,
+        help="""
+        Maximum number of ssh sessions (shells & commands) one user may have open. 0 means no limit.
+        """,
+        config=True
+    )
+
+    max_loop_lag = Float(
+        0.5,
+        help="""
+        Seconds the event loop may fall behind before new connections & sessions are refused.
+
+        A lagging event loop means KubeSSH is overloaded, and taking on more
+        work would slow down sessions already open. 0 disables this check.
+        """,
+        config=True
+    )
+
+    lag_check_interval = Float(
+        0.25,
+        help="""
+        Seconds between measurements of the event loop's lag.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshakes = 0
+        # username -> number of open sessions
+        self.sessions = {}
+        self.total_sessions = 0
+        self.loop_lag = 0
+        self._task = None
+
+        metrics.gauge(
+            'kubessh_handshakes',
+            'Connections handshaking or authenticating',
+            func=lambda: self.handshakes
+        )
+        metrics.gauge(
+            'kubessh_open_sessions',
+            'Open ssh sessions, including ones waiting for their pod',
+            func=lambda: self.total_sessions
+        )
+        metrics.gauge(
+            'kubessh_event_loop_lag_seconds',
+            'How far the event loop was behind at the last measurement',
+            func=lambda: self.loop_lag
+        )
+        for name in ('max_handshakes', 'max_sessions', 'max_sessions_per_user', 'max_loop_lag'):
+            metrics.gauge(
+                f'kubessh_limit_{name}',
+                f'Current value of LoadShedder.{name}',
+                func=lambda name=name: getattr(self, name)
+            )
+        self.shed = {
+            reason: metrics.counter(
+                f'kubessh_shed_{reason}_total',
+                f'Connections or sessions refused for {description}'
+            )
+            for reason, description in [
+                ('handshakes', 'too many connections handshaking at once'),
+                ('sessions', 'too many sessions open in total'),
+                ('user_sessions', 'their user having too many sessions open'),
+                ('loop_lag', 'the event loop lagging behind'),
+            ]
+        }
+
+    def _overloaded(self):
+        return self.max_loop_lag > 0 and self.loop_lag > self.max_loop_lag
+
+    def admit_handshake(self):
+        """
+        Count a new connection's handshake, returning None, or the reason it is refused
+        """
+        if self._overloaded():
+            self.shed['loop_lag'].inc()
+            return 'Server is overloaded, please try again later'
+        if self.max_handshakes > 0 and self.handshakes >= self.max_handshakes:
+            self.shed['handshakes'].inc()
+            return 'Too many connections, please try again later'
+        self.handshakes += 1
+        return None
+
+    def handshake_done(self):
+        self.handshakes -= 1
+
+    def admit_session(self, username):
+        """
+        Count a new session of username, returning None, or the reason it is refused
+        """
+        if self._overloaded():
+            self.shed['loop_lag'].inc()
+            return 'The server is overloaded right now. Please try again in a minute.'
+        if self.max_sessions > 0 and self.total_sessions >= self.max_sessions:
+            self.shed['sessions'].inc()
+            return 'The server has too many open sessions right now. Please try again later.'
+        if self.max_sessions_per_user > 0 and self.sessions.get(username, 0) >= self.max_sessions_per_user:
+            self.shed['user_sessions'].inc()
+            return f'You already have {self.max_sessions_per_user} sessions open. Please close some and try again.'
+        self.sessions[username] = self.sessions.get(username, 0) + 1
+        self.total_sessions += 1
+        return None
+
+    def session_done(self, username):
+        count = self.sessions.get(username, 0) - 1
+        if count > 0:
+            self.sessions[username] = count
+        else:
+            self.sessions.pop(username, None)
+        self.total_sessions -= 1
+
+    def start(self, loop=None):
+        """
+        Start measuring event loop lag in the background
+        """
+        if self._task is not None:
+            return
+        loop = loop or asyncio.get_event_loop()
+        self._task = loop.create_task(self._measure_lag())
+
+    async def _measure_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.lag_check_interval
+            await asyncio.sleep(self.lag_check_interval)
+            self.loop_lag = max(0, loop.time() - expected)
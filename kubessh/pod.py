@@ -6,8 +6,10 @@ import time
 import argparse
 import os
 import sys
+import threading
 from kubernetes import client as k
 import kubernetes.config
+import kubernetes.watch
 import escapism
 import functools
 from enum import Enum
@@ -15,22 +17,135 @@ import shlex
 import string
 from concurrent.futures import ThreadPoolExecutor
 from traitlets.config import LoggingConfigurable
-from traitlets import Dict, Unicode, List, default
+from traitlets import Dict, Unicode, List, Integer, CaselessStrEnum, default
 
+from . import metrics
 from .serialization import make_api_object_from_dict
+from .templates import compile_template
+from .cache import LRUCache
+from .informer import PodInformer, USERNAME_LABEL
+from .pool import WarmPool, claim_name_of
+from .kubeapi import KubeApi
+from .streams import KubeStreams, StdinEOFUnsupported
+from .broker import ExecBroker, BrokerUnavailable
+from .sessions import SessionTracker, stamp_last_active
+from .admission import AdmissionController
 
-try:
-    kubernetes.config.load_incluster_config()
-except kubernetes.config.ConfigException:
-    kubernetes.config.load_kube_config()
 
-# FIXME: Figure out if making this global is a problem
-v1 = k.CoreV1Api()
+# Root filesystem layout ('copy' or 'image') a PVC was created for. PVCs
+# without it were all created for 'copy'.
+ROOT_MODE_ANNOTATION = 'kubessh.yuvi.in/root-mode'
+
+# Seconds each watch for a pod to start lasts, before checking whether it is still wanted
+_WATCH_TIMEOUT = 5
+
+# Rendered pod & PVC specs, shared by all UserPods
+_spec_cache = LRUCache(1024)
+
+_START_PHASE_DURATIONS = {
+    'lookup': metrics.summary(
+        'kubessh_pod_start_lookup_seconds',
+        'Time taken to find out whether a user pod already exists'
+    ),
+    'queue': metrics.summary(
+        'kubessh_pod_start_queue_seconds',
+        'Time taken waiting for admission to create a user pod'
+    ),
+    'claim': metrics.summary(
+        'kubessh_pod_start_claim_seconds',
+        'Time taken to look for a pod in the warm pool & claim it'
+    ),
+    'create': metrics.summary(
+        'kubessh_pod_start_create_seconds',
+        'Time taken to create a user pod & its PVCs, including deleting a completed pod it replaces'
+    ),
+    'wait': metrics.summary(
+        'kubessh_pod_start_wait_seconds',
+        'Time newly created user pods spent waiting to be Running'
+    ),
+    'total': metrics.summary(
+        'kubessh_pod_start_seconds',
+        'Time taken to start user pods that were not already Running'
+    ),
+}
 
 class PodState(Enum):
     UNKNOWN = 0
     STARTING = 1
     RUNNING = 2
+    # Waiting for admission to create the pod, see UserPod.queue_position
+    QUEUED = 3
+
+class PodStartError(Exception):
+    """
+    Raised when a user pod could not be brought to Running state
+    """
+
+
+class PodStartTimeout(PodStartError):
+    """
+    Raised when a user pod did not reach Running state within start_timeout
+    """
+
+
+class _SharedStart:
+    """
+    A single in-progress ensure_running for one pod, shared by every session
+    that asks for that pod while it is starting.
+
+    The first session's UserPod does the actual work in a background task.
+    Every subscriber gets its own copy of the PodState updates, and sees
+    the same exception if starting fails.
+    """
+    def __init__(self, user_pod):
+        self.user_pod = user_pod
+        self.queues = []
+        self.pod = None
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            async for state in self.user_pod._ensure_running():
+                for queue in self.queues:
+                    queue.put_nowait(state)
+            self.pod = self.user_pod.pod
+        finally:
+            for queue in self.queues:
+                queue.put_nowait(None)
+
+    async def subscribe(self):
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        try:
+            while True:
+                state = await queue.get()
+                if state is None:
+                    break
+                yield state
+        finally:
+            self.queues.remove(queue)
+        # Re-raises any exception from starting the pod
+        self.task.result()
+
+
+def username_from_login(login):
+    """
+    Return the username whose pod an ssh login name maps to.
+
+    Logins with dcucode access tokens come in as 'dcucode-{username}'.
+    """
+    parts = login.split('-')
+    if parts and parts[0] == 'dcucode':
+        return '-'.join(parts[1:])
+    return login
+
+
+def _pod_started(pod):
+    """
+    True if pod has gone away or left the Pending phase
+    """
+    return pod is None or (pod.status is not None and pod.status.phase not in (None, 'Pending'))
+
 
 class UserPod(LoggingConfigurable):
     """
@@ -185,6 +300,8 @@ class UserPod(LoggingConfigurable):
         This should be a dict containing a fully specified Kubernetes
         Pod object. Specific components of it may be changed to
         match the configuration of the Shell object requested.
+
+        It is shared by all UserPods, and must not be modified in place.
         """,
         config=True
     )
@@ -219,11 +336,117 @@ class UserPod(LoggingConfigurable):
             unique by including the string '{username}', which is expanded to the
             name of the user that the shell belongs to. In order to use the created
             persistent volumes, they should be referenced in the pod_template's
-            spec.volumes.
+            spec.volumes. Like pod_template, they must not be modified in place.
             """,
         config=True
     )
 
+    root_mode = CaselessStrEnum(
+        ['copy', 'image'],
+        'copy',
+        help="""
+        Where the system directories of the user's shell container come from.
+
+        'copy' uses pod_template as is. With the default template, its
+        init-setup container copies /usr, /lib, /etc & /var from the image
+        into each user's PVC, and they are mounted back over the image's.
+
+        'image' leaves the system directories to the image, which is shared
+        by all pods on a node (on disk & in the page cache). Only
+        persistent_paths are mounted from the user's PVC, and the
+        seed_containers are left out of the pod, so PVCs can be much smaller.
+        Changes users make outside persistent_paths (like installed packages)
+        are lost when their pod is restarted.
+
+        Each PVC is annotated with the mode it was created for, and the pod
+        always uses its PVC's mode. Existing PVCs stay in 'copy' mode until
+        migrated (see the storage docs).
+        """,
+        config=True
+    )
+
+    persistent_paths = List(
+        ['/home'],
+        help="""
+        Paths in the shell container kept on the user's PVC, when root_mode is 'image'.
+
+        Each is mounted from the matching subPath of the PVC ('/usr/local' from
+        'usr/local'), the same place it lives in PVCs made in 'copy' mode.
+        """,
+        config=True
+    )
+
+    seed_containers = List(
+        ['init-setup'],
+        help="""
+        Names of init containers that copy the system directories into the user's PVC.
+
+        Left out of the pod when root_mode is 'image'.
+        """,
+        config=True
+    )
+
+    pvc_data_sources = Dict(
+        {},
+        help="""
+        Golden volumes to clone new user PVCs from, keyed by the shell container's image.
+
+        Values are Kubernetes dataSource references, pointing either at a
+        VolumeSnapshot:
+
+            {'apiGroup': 'snapshot.storage.k8s.io', 'kind': 'VolumeSnapshot', 'name': 'dbuntu-golden'}
+
+        or at a template PVC in the same namespace:
+
+            {'kind': 'PersistentVolumeClaim', 'name': 'dbuntu-golden'}
+
+        The storage class must support restoring snapshots or cloning volumes.
+        init-setup finds the base system already in the cloned volume, and
+        skips copying it. Only PVCs created from now on are affected, and
+        only if their template doesn't set a dataSource itself.
+        """,
+        config=True
+    )
+
+    start_timeout = Integer(
+        300,
+        help="""
+        Seconds to wait for a new user pod to reach Running state.
+
+        If the pod is not Running by then, the user's ssh session is ended
+        with an error message.
+        """,
+        config=True
+    )
+
+    exec_mode = CaselessStrEnum(
+        ['api', 'kubectl'],
+        'api',
+        help="""
+        How commands are run inside the user pod for each ssh session.
+
+        'api' talks to the Kubernetes exec API directly from the ssh server.
+        'kubectl' starts a `kubectl exec` process per session, which needs
+        kubectl installed next to KubeSSH.
+
+        Before Kubernetes 1.30, the exec API can't pass on EOF on stdin, so
+        even with 'api', sessions without a tty (scp, rsync, `ssh host cmd <
+        file`) go through kubectl.
+        """,
+        config=True
+    )
+
+    spec_cache_size = Integer(
+        1024,
+        help="""
+        Number of rendered pod & PVC specs to keep in memory.
+
+        Specs are cached per user, so logins by recently seen users
+        don't need to render the templates again.
+        """,
+        config=True
+    )
+
     username = Unicode(
         None,
         allow_none=True,
@@ -260,15 +483,16 @@ class UserPod(LoggingConfigurable):
     )
 
 
-    def _expand_user_properties(self, template):
+    def _safe_username(self):
         # Make sure username and servername match the restrictions for DNS labels
         # Note: '-' is not in safe_chars, as it is being used as escape character
         safe_chars = set(string.ascii_lowercase + string.digits)
 
-        safe_username = escapism.escape(self.username, safe=safe_chars, escape_char='-').lower()
+        return escapism.escape(self.username, safe=safe_chars, escape_char='-').lower()
 
+    def _expand_user_properties(self, template):
         return template.format(
-            username=safe_username,
+            username=self._safe_username(),
         )
 
     def _expand_all(self, src):
@@ -285,67 +509,256 @@ class UserPod(LoggingConfigurable):
         self.username = username
         self.namespace = namespace
         super().__init__(*args, **kwargs)
+        self._share_templates(kwargs)
 
         self.required_labels = {
             'kubessh.yuvi.in/username': escapism.escape(self.username, escape_char='-'),
             'kubessh': 'userpods'
         }
 
-        # Threads required to perform all activities in this shell
-        # These should probably be a well sized global threadpool, since this is being
-        # used as a sort of queue. We will currently use a threadpool of 1 thread per shell
-        # for simplicity. The number of threads here needs to be the maximum number of threads
-        # this object could possibly use at the same time. Eventually, this needs to be a
-        # global threadpool with well enforced limits #FIXME
-        self.kube_api_threadpool = ThreadPoolExecutor(1)
+        # PVC mounted into the pod. Differs from the default for users whose
+        # pod & PVC were claimed from the warm pool.
+        self.claim_name = self.pod_name + '-pvc'
+        # root_mode of the PVC mounted into the pod
+        self.volume_root_mode = self.root_mode
+        # Logins ahead of this one waiting to create their pod, while PodState.QUEUED
+        self.queue_position = None
+
+        # All Kubernetes API calls go through one shared, bounded threadpool
+        self.kube = KubeApi.instance()
+
+    def _share_templates(self, kwargs):
+        """
+        Use the template objects from config (or the defaults), rather than this UserPod's own deep copies
+
+        Templates are compiled once per object, so sharing them keeps logins from compiling them again.
+        """
+        config = self._find_my_config(self.config)
+        for name in ('pod_template', 'pvc_templates'):
+            if name in kwargs:
+                continue
+            if name in config:
+                source = config[name]
+            else:
+                # Container traits make their default by copying default_args[0]
+                source = self.traits()[name].default_args[0]
+            # LazyConfigValues (c.UserPod.pod_template.update(...)) are left as they are
+            if isinstance(source, (dict, list)):
+                self.set_trait(name, source)
 
     def _run_in_executor(self, func, *args, **kwargs):
-        return asyncio.get_event_loop().run_in_executor(self.kube_api_threadpool, functools.partial(func, *args, **kwargs))
+        return self.kube.run(func, *args, **kwargs)
 
     def _make_labelselector(self, labels):
         return ','.join([f'{k}={v}' for k, v in labels.items()])
 
     def make_pod_spec(self):
-        pod = make_api_object_from_dict(self._expand_all(self.pod_template), k.V1Pod)
-        pod.metadata.name = self.pod_name
-        print(pod)
-        pod.spec.volumes[0].persistent_volume_claim = k.V1PersistentVolumeClaimVolumeSource(claim_name = self.pod_name + '-pvc')
-        if pod.metadata.labels is None:
-            pod.metadata.labels = {}
-        pod.metadata.labels.update(self.required_labels)
+        """
+        Return the V1Pod to create for this user, built from pod_template.
+
+        Specs are cached per user, so the returned object must not be modified.
+        """
+        compiled = compile_template(self.pod_template)
+        cache_key = ('pod', compiled, self.username, self.pod_name, self.claim_name, self._image_root_key())
+        pod = _spec_cache.get(cache_key)
+        if pod is None:
+            pod = make_api_object_from_dict(compiled.render(username=self._safe_username()), k.V1Pod)
+            pod.metadata.name = self.pod_name
+            pod.spec.volumes[0].persistent_volume_claim = k.V1PersistentVolumeClaimVolumeSource(claim_name = self.claim_name)
+            if pod.metadata.labels is None:
+                pod.metadata.labels = {}
+            pod.metadata.labels.update(self.required_labels)
+            if self.volume_root_mode == 'image':
+                self._use_image_root(pod)
+            _spec_cache.maxsize = self.spec_cache_size
+            _spec_cache[cache_key] = pod
 
         return pod
 
+    def _image_root_key(self):
+        if self.volume_root_mode != 'image':
+            return None
+        return (tuple(self.persistent_paths), tuple(self.seed_containers))
+
+    def _use_image_root(self, pod):
+        """
+        Mount only persistent_paths from the user's PVC into the shell container
+        """
+        volume_name = pod.spec.volumes[0].name
+        if pod.spec.init_containers:
+            pod.spec.init_containers = [
+                container for container in pod.spec.init_containers
+                if container.name not in self.seed_containers
+            ] or None
+        for container in pod.spec.containers:
+            if container.name != 'shell':
+                continue
+            container.volume_mounts = [
+                mount for mount in container.volume_mounts or []
+                if mount.name != volume_name
+            ] + [
+                k.V1VolumeMount(name=volume_name, mount_path=path, sub_path=path.strip('/'))
+                for path in self.persistent_paths
+            ]
+
+    def _shell_image(self):
+        for container in self.pod_template.get('spec', {}).get('containers', []):
+            if container.get('name') == 'shell':
+                return container.get('image')
+        return None
+
     def make_pvc_spec(self, template):
-        print('test pvc')
-        print(template)
-        pvc = make_api_object_from_dict(self._expand_all(template), k.V1PersistentVolumeClaim)
-        pvc.metadata.name = self.pod_name + '-pvc'
-        print(pvc)
-        if pvc.metadata.labels is None:
-            pvc.metadata.labels = {}
-        pvc.metadata.labels.update(self.required_labels)
+        """
+        Return the V1PersistentVolumeClaim to create for this user from template.
+
+        Specs are cached per user, so the returned object must not be modified.
+        """
+        compiled = compile_template(template)
+        data_source = self.pvc_data_sources.get(self._shell_image())
+        cache_key = ('pvc', compiled, repr(data_source), self.root_mode, self.username, self.pod_name)
+        pvc = _spec_cache.get(cache_key)
+        if pvc is None:
+            pvc = make_api_object_from_dict(compiled.render(username=self._safe_username()), k.V1PersistentVolumeClaim)
+            pvc.metadata.name = self.pod_name + '-pvc'
+            if data_source is not None and pvc.spec.data_source is None:
+                pvc.spec.data_source = make_api_object_from_dict(data_source, k.V1TypedLocalObjectReference)
+            pvc.metadata.annotations = dict(pvc.metadata.annotations or {}, **{ROOT_MODE_ANNOTATION: self.root_mode})
+            if pvc.metadata.labels is None:
+                pvc.metadata.labels = {}
+            pvc.metadata.labels.update(self.required_labels)
+            _spec_cache.maxsize = self.spec_cache_size
+            _spec_cache[cache_key] = pvc
 
         return pvc
 
-    async def ensure_running(self):
+    async def read_pod(self):
         """
-        Ensure this user pod is running.
+        Return this user's pod, or None if it does not exist.
 
-        1. If pod already exists, and is in running state, just return
-        2. If pod already exists, and has completed, delete it.
-        3. If pod doesn't exist, create new pod & wait for it to be running
+        Answered from the shared pod cache when it is synced, and from
+        the Kubernetes API otherwise. With the warm pool enabled, the user's
+        pod might be a claimed pool pod, so we also look for pods by their
+        username label & switch over to the one we find.
+        """
+        informer = PodInformer.instance_for(self.namespace)
+        look_for_claimed = WarmPool.instance_for(self.namespace).enabled
+        if informer.synced:
+            informer.hits.inc()
+            pod = informer.get(self.pod_name)
+            if pod is None and look_for_claimed:
+                pod = next(iter(informer.get_by_username(self.required_labels[USERNAME_LABEL])), None)
+        else:
+            informer.misses.inc()
+            pod = await self._read_pod_from_api()
+            if pod is None and look_for_claimed:
+                pods = await self._run_in_executor(
+                    self.kube.v1.list_namespaced_pod, self.namespace,
+                    label_selector=self._make_labelselector({USERNAME_LABEL: self.required_labels[USERNAME_LABEL]})
+                )
+                pod = next(iter(pods.items), None)
+
+        if pod is not None and pod.metadata.name != self.pod_name:
+            self._adopt(pod)
+        return pod
+
+    def _adopt(self, pod):
+        """
+        Use pod, found through our username label, as this user's pod
         """
+        self.pod_name = pod.metadata.name
+        self.claim_name = claim_name_of(pod) or self.claim_name
+
+    async def _read_pod_from_api(self):
         try:
-            pod = await self._run_in_executor(
-                v1.read_namespaced_pod,
+            return await self._run_in_executor(
+                self.kube.v1.read_namespaced_pod,
                 self.pod_name, self.namespace
             )
         except kubernetes.client.rest.ApiException as e:
             if e.status == 404:
-                pod = None
-            else:
-                raise
+                return None
+            raise
+
+    # '{namespace}/{pod_name}' -> _SharedStart for pods currently being started
+    _starting = {}
+
+    async def ensure_running(self):
+        """
+        Ensure this user pod is running, yielding PodState updates.
+
+        Concurrent calls for the same pod share a single attempt, so
+        opening many sessions at once creates & waits for the pod only once.
+        """
+        key = f'{self.namespace}/{self.pod_name}'
+        shared = self._starting.get(key)
+        if shared is None or shared.task.done():
+            shared = _SharedStart(self)
+            self._starting[key] = shared
+
+            def _forget(task):
+                if self._starting.get(key) is shared:
+                    del self._starting[key]
+                # Make sure exceptions are retrieved even if every session went away
+                if not task.cancelled():
+                    task.exception()
+            shared.task.add_done_callback(_forget)
+
+        async for state in shared.subscribe():
+            if state == PodState.QUEUED:
+                self.queue_position = shared.user_pod.queue_position
+            yield state
+        self.pod = shared.pod
+        if self.pod.metadata.name != self.pod_name:
+            self._adopt(self.pod)
+
+    async def _ensure_running(self):
+        """
+        Ensure this user pod is running.
+
+        1. If pod already exists, and is in running state, just return
+        2. If pod already exists, and has completed, delete it & create a new one
+        3. If pod doesn't exist, and the user has no PVC yet, claim a pod from the warm pool
+        4. Otherwise wait for admission, create the pod & its PVCs, then wait for it to be running
+
+        How long each phase took is kept in self.start_timings.
+        """
+        self._admission = None
+        try:
+            async for state in self._start():
+                yield state
+        finally:
+            if self._admission is not None:
+                # Started or failed, either way someone else may go now
+                AdmissionController.instance().release(self._admission)
+
+    async def _admit(self, deadline):
+        """
+        Wait for admission to create this pod, yielding while queued
+
+        self.queue_position is kept up to date meanwhile.
+        """
+        admission = AdmissionController.instance()
+        self._admission = admission.request(self.required_labels[USERNAME_LABEL])
+        loop = asyncio.get_event_loop()
+        while not self._admission.admitted.done():
+            self.queue_position = admission.position(self._admission)
+            yield
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise PodStartTimeout(f'Pod {self.pod_name} was not admitted within {self.start_timeout}s')
+            try:
+                await asyncio.wait_for(asyncio.shield(self._admission.admitted), min(1, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _start(self):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.start_timeout
+        self.start_timings = {}
+        started = phase_started = time.perf_counter()
+
+        pod = await self.read_pod()
+        phase_started = self._phase_done('lookup', phase_started)
 
         if pod and pod.status.phase == 'Running':
             # Pod exists, and is running. Nothing to do
@@ -354,58 +767,295 @@ class UserPod(LoggingConfigurable):
             return
 
         # FIXME: Deal with pods in Terminating state
+        replacing = None
         if pod and pod.status.phase in ['Failed', 'Succeeded']:
             # Pod exists, but is in an unusable state.
-            # Delete it, and say there is no pod
-            await self._run_in_executor(
-                v1.delete_namespaced_pod,
-                pod.metadata.name,
-                pod.metadata.namespace, body=k.V1DeleteOptions(grace_period_seconds=0)
-            )
+            # It needs to be deleted, and a new one started
+            replacing = pod
+            # The new pod gets the same volume
+            self.claim_name = claim_name_of(replacing) or self.claim_name
             pod = None
-        print(self.pod_template)
         if not pod:
             # There is no pod, so start one!
             yield PodState.STARTING
+            pool = WarmPool.instance_for(self.namespace)
+            has_claim = None
+            if pool.enabled or self.root_mode != 'copy':
+                # Which PVC the user already has, if any, decides what pod they get
+                has_claim = await self._find_own_claim()
+            if replacing is None and pool.enabled and not has_claim:
+                pod = await pool.claim(self.required_labels[USERNAME_LABEL])
+                phase_started = self._phase_done('claim', phase_started)
+                if pod is not None:
+                    self._adopt(pod)
+            if pod is None:
+                async for _ in self._admit(deadline):
+                    yield PodState.QUEUED
+                phase_started = self._phase_done('queue', phase_started)
+                pod = await self._provision(replacing, deadline)
+                phase_started = self._phase_done('create', phase_started)
 
-            # create persistent volumes, if any
-            for template in self.pvc_templates:
-                pvc_spec = self.make_pvc_spec(template)
+        if pod.status is None or pod.status.phase != 'Running':
+            # By now, a pod exists but is not necessarily in 'Running' state
+            # So we just wait for that to be the case, and return
+            started_future = asyncio.ensure_future(self.wait_for_started(pod))
+            try:
+                while True:
+                    # Keep the user's spinner going while we wait
+                    yield PodState.STARTING
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise PodStartTimeout(f'Pod {self.pod_name} did not start within {self.start_timeout}s')
+                    try:
+                        pod = await asyncio.wait_for(asyncio.shield(started_future), min(1, remaining))
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+            finally:
+                started_future.cancel()
+
+            if pod is None:
+                raise PodStartError(f'Pod {self.pod_name} was deleted while starting')
+            if pod.status.phase != 'Running':
+                raise PodStartError(f'Pod {self.pod_name} is {pod.status.phase}, not Running')
+            self._phase_done('wait', phase_started)
+
+        self._phase_done('total', started)
+        self.log.info(f'Pod {self.pod_name} running after ' + ', '.join(
+            f'{phase} {duration:.3f}s' for phase, duration in self.start_timings.items()
+        ))
+        self.pod = pod
+        yield PodState.RUNNING
+
+    def _phase_done(self, phase, since):
+        now = time.perf_counter()
+        self.start_timings[phase] = now - since
+        _START_PHASE_DURATIONS[phase].observe(now - since)
+        return now
+
+    async def _provision(self, replacing, deadline):
+        """
+        Create this user's PVCs & pod, returning the new pod.
+
+        Everything is sent to Kubernetes at once rather than one after the
+        other - a pod whose claims don't exist yet simply stays Pending
+        until they do. If replacing is set, that old pod is deleted while
+        the PVCs are created, and the new pod is created once it is gone.
+        """
+        # A claim we didn't name was given to the user by the warm pool, & already exists
+        templates = self.pvc_templates if self.claim_name == self.pod_name + '-pvc' else []
+        pvcs = [asyncio.ensure_future(self._create_pvc(template)) for template in templates]
+        try:
+            if replacing is not None:
+                await self._delete_pod(replacing)
+            pod = await self._create_pod(replacing, deadline)
+        except BaseException:
+            for pvc in pvcs:
+                pvc.cancel()
+            raise
+
+        try:
+            await asyncio.gather(*pvcs)
+        except Exception:
+            # Without its volumes the pod would stay Pending forever, and
+            # every later login would wait on it
+            try:
+                await self._delete_pod(pod)
+            except kubernetes.client.rest.ApiException:
+                self.log.exception(f'Could not delete pod {self.pod_name} after failing to create its PVCs')
+            raise
+        return pod
+
+    async def _find_own_claim(self):
+        """
+        Look for an existing PVC labelled as this user's, and use it if found.
+
+        Returns True if there is one.
+        """
+        pvcs = await self._run_in_executor(
+            self.kube.v1.list_namespaced_persistent_volume_claim, self.namespace,
+            label_selector=self._make_labelselector({USERNAME_LABEL: self.required_labels[USERNAME_LABEL]})
+        )
+        if not pvcs.items:
+            return False
+        pvc = next((pvc for pvc in pvcs.items if pvc.metadata.name == self.claim_name), pvcs.items[0])
+        self.claim_name = pvc.metadata.name
+        self.volume_root_mode = (pvc.metadata.annotations or {}).get(ROOT_MODE_ANNOTATION, 'copy')
+        return True
+
+    async def _create_pvc(self, template):
+        pvc_spec = self.make_pvc_spec(template)
+        try:
+            pvc = await self._run_in_executor(self.kube.v1.create_namespaced_persistent_volume_claim, self.namespace, pvc_spec)
+            self.log.info(f"Successfully created PVC {pvc.metadata.name}")
+            self.log.debug(pvc)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 409:
+                self.log.info(f"PVC {pvc_spec.metadata.name} already exists, did not create a new PVC.")
+            elif e.status == 403:
                 try:
-                    pvc = await self._run_in_executor(v1.create_namespaced_persistent_volume_claim, self.namespace, pvc_spec)
-                    self.log.info(f"Successfully created PVC {pvc.metadata.name}")
-                    self.log.debug(pvc)
-                except kubernetes.client.rest.ApiException as e:
-                    if e.status == 409:
-                        self.log.info(f"PVC {pvc_spec.metadata.name} already exists, did not create a new PVC.")
-                    elif e.status == 403:
-                        t, v, tb = sys.exc_info()
-                        try:
-                            pvc = await self._run_in_executor(v1.read_namespaced_persistent_volume_claim, pvc_spec.metadata.name, self.namespace, pvc_spec)
-                        except:
-                            raise v.with_traceback(tb)
-                        self.log.info(f"PVC {pvc_spec.metadata.name} already exists, possibly have reached quota.")
-                    else:
-                        raise
-
-            pod = await self._run_in_executor(
-                v1.create_namespaced_pod,
-                self.namespace, self.make_pod_spec()
+                    await self._run_in_executor(self.kube.v1.read_namespaced_persistent_volume_claim, pvc_spec.metadata.name, self.namespace)
+                except kubernetes.client.rest.ApiException:
+                    raise e
+                self.log.info(f"PVC {pvc_spec.metadata.name} already exists, possibly have reached quota.")
+            else:
+                raise
+
+    async def _delete_pod(self, pod):
+        try:
+            await self._run_in_executor(
+                self.kube.v1.delete_namespaced_pod,
+                pod.metadata.name,
+                pod.metadata.namespace, body=k.V1DeleteOptions(grace_period_seconds=0)
             )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
 
-        while pod.status.phase != 'Running':
-            # By now, a pod exists but is not necessarily in 'Running' state
-            # So we just wait for that to be the case, and return
-            yield PodState.STARTING
-            await asyncio.sleep(1)
-            pod = await self._run_in_executor(
-                v1.read_namespaced_pod,
-                pod.metadata.name, pod.metadata.namespace
+    async def _create_pod(self, replacing, deadline):
+        """
+        Create this user's pod, returning it.
+
+        If the pod already exists, because the pod cache was behind & someone
+        else created it, that pod is returned instead. If it is the pod
+        being replaced, we wait for it to go away & try again.
+        """
+        while True:
+            try:
+                return await self._run_in_executor(
+                    self.kube.v1.create_namespaced_pod,
+                    self.namespace, stamp_last_active(self.make_pod_spec())
+                )
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != 409:
+                    raise
+            pod = await self._read_pod_from_api()
+            if pod is None:
+                # Went away since we tried to create ours
+                continue
+            if replacing is None or pod.metadata.uid != replacing.metadata.uid:
+                return pod
+            await self._wait_until_deleted(replacing, deadline)
+
+    async def _wait_until_deleted(self, pod, deadline):
+        remaining = deadline - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            raise PodStartTimeout(f'Old pod {self.pod_name} was not deleted within {self.start_timeout}s')
+
+        informer = PodInformer.instance_for(self.namespace)
+        if not informer.synced:
+            await asyncio.sleep(min(0.5, remaining))
+            return
+
+        def deleted(cached):
+            return cached is None or cached.metadata.uid != pod.metadata.uid
+
+        if deleted(informer.get(self.pod_name)):
+            return
+        try:
+            await asyncio.wait_for(informer.wait_for(self.pod_name, deleted), remaining)
+        except asyncio.TimeoutError:
+            raise PodStartTimeout(f'Old pod {self.pod_name} was not deleted within {self.start_timeout}s')
+
+    async def wait_for_started(self, pod):
+        """
+        Wait for pod to leave the Pending phase, and return it.
+
+        Other pods of the same name are ignored. Returns None if the pod is deleted. Uses the shared pod cache if
+        available, and a watch on just this pod otherwise.
+        """
+        informer = PodInformer.instance_for(self.namespace)
+        if informer.synced:
+            # The cache may still have the pod this one replaces
+            return await informer.wait_for(self.pod_name, _pod_started, uid=pod.metadata.uid)
+        # Watches block their thread for a long time, so keep them out of the shared threadpool
+        stop = threading.Event()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self._watch_until_started, pod.metadata.resource_version, pod.metadata.uid, stop
             )
-        yield PodState.RUNNING
+        finally:
+            # Cancelling the future doesn't stop the thread, this does
+            stop.set()
+
+    def _watch_until_started(self, resource_version, uid, stop):
+        """
+        Watch for the pod with uid to start, in short watches so stop is checked every _WATCH_TIMEOUT seconds
+        """
+        deadline = time.monotonic() + self.start_timeout
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            w = kubernetes.watch.Watch()
+            try:
+                for event in w.stream(
+                    self.kube.watch_v1.list_namespaced_pod,
+                    self.namespace,
+                    field_selector=f'metadata.name={self.pod_name}',
+                    resource_version=resource_version,
+                    timeout_seconds=max(1, int(min(_WATCH_TIMEOUT, remaining)))
+                ):
+                    if stop.is_set():
+                        w.stop()
+                        return None
+                    resource_version = event['object'].metadata.resource_version
+                    if uid is not None and event['object'].metadata.uid != uid:
+                        # An older (or newer) pod of the same name
+                        continue
+                    pod = None if event['type'] == 'DELETED' else event['object']
+                    if _pod_started(pod):
+                        w.stop()
+                        return pod
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != 410:
+                    raise
+                # Our resourceVersion is too old, start over from the pod's current state
+                resource_version = None
+        if stop.is_set():
+            return None
+        raise PodStartTimeout(f'Pod {self.pod_name} did not start within {self.start_timeout}s')
 
     async def execute(self, ssh_process):
+        """
+        Run ssh_process's command (or a login shell) in this pod, until it exits.
+
+        The pod counts as in use for as long as this runs.
+        """
+        sessions = SessionTracker.instance()
+        sessions.acquire(self.namespace, self.pod_name)
+        try:
+            await self._execute(ssh_process)
+        finally:
+            sessions.release(self.namespace, self.pod_name)
+
+    async def _execute(self, ssh_process):
         command = shlex.split(ssh_process.command) if ssh_process.command else ["/bin/bash", "-l"]
+
+        if self.exec_mode == 'api':
+            broker = ExecBroker.instance()
+            if broker.enabled and ssh_process.command and not ssh_process.get_terminal_type():
+                # Short non-interactive commands are much faster through the pod's broker
+                try:
+                    exit_status = await broker.exec(
+                        ssh_process, self.namespace, self.pod_name, 'shell', command
+                    )
+                    ssh_process.exit(exit_status)
+                    return
+                except BrokerUnavailable:
+                    pass
+
+            try:
+                exit_status = await KubeStreams.instance().exec(
+                    ssh_process, self.namespace, self.pod_name, 'shell', command
+                )
+            except StdinEOFUnsupported:
+                # Commands reading stdin to its end would hang, kubectl can close it
+                pass
+            else:
+                ssh_process.exit(exit_status)
+                return
+
         tty_args = ['--tty'] if ssh_process.get_terminal_type() else []
         kubectl_command = [
             'kubectl',
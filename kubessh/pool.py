@@ -0,0 +1,370 @@
+"""
+Warm pool of pre-started pods & bound PVCs for first-time users.
+
+A user's first login normally waits for their PVC to be bound, the pod to
+be scheduled, the image to be pulled and init-setup to copy the base
+system into the volume - tens of seconds. The pod template has nothing
+user specific in it, so instead we keep a few generic pods (each with its
+own PVC) Running ahead of time. At login, one is claimed by relabelling
+it & its PVC for the user, and the pool is refilled in the background.
+
+Pods & PVCs can't be renamed, so claimed pods keep their 'kubessh-pool-*'
+names, and are found again through their username label. Users who
+already have a PVC always get a regular pod on their own volume.
+"""
+import asyncio
+import datetime
+import secrets
+import time
+
+import kubernetes
+from kubernetes import client as k
+from traitlets.config import LoggingConfigurable
+from traitlets import Bool, Dict, Integer, List, Unicode
+
+from kubessh import metrics
+from kubessh.admission import AdmissionController
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kubeapi import KubeApi
+from kubessh.sessions import last_active_patch
+
+POOL_LABEL = 'kubessh.yuvi.in/pool'
+
+# Username label of pool members. Escaped usernames only have '-' followed
+# by two hex digits, so no real user's label can ever look like this.
+POOL_USERNAME = 'kubessh-pool'
+
+
+def _label_path(label):
+    # JSON patch paths escape '/' as '~1'
+    return '/metadata/labels/' + label.replace('~', '~0').replace('/', '~1')
+
+
+def claim_name_of(pod):
+    """
+    Return name of the first PVC mounted by pod, or None
+    """
+    if pod.spec is None:
+        return None
+    for volume in pod.spec.volumes or []:
+        if volume.persistent_volume_claim is not None:
+            return volume.persistent_volume_claim.claim_name
+    return None
+
+
+class WarmPool(LoggingConfigurable):
+    """
+    Keep a number of generic user pods running, ready to be claimed at login.
+
+    Needs the pod cache (PodInformer) to be enabled.
+    """
+    enabled = Bool(
+        False,
+        help="""
+        Hand out pre-started pods from a warm pool to users logging in for the first time.
+
+        Users keep the pod & PVC they were given from the pool. Once enabled,
+        keep this on (with size 0 if no pool is wanted anymore), so those
+        users' PVCs are still found when their pod has to be recreated.
+        """,
+        config=True
+    )
+
+    size = Integer(
+        0,
+        help="""
+        Number of pods to keep ready in the pool, outside of scheduled windows.
+        """,
+        config=True
+    )
+
+    schedule = List(
+        Dict(),
+        help="""
+        Time windows during which the pool should be a different size.
+
+        Each entry is a dict with 'start' & 'end' times ('HH:MM', local time),
+        the 'size' to keep during that window, and optionally the 'days'
+        ('mon', 'tue', ...) it applies to. For example, to have plenty of
+        pods ready just before morning classes:
+
+            [{'days': ['mon', 'wed'], 'start': '08:30', 'end': '09:15', 'size': 40}]
+
+        If several windows match, the largest size wins.
+        """,
+        config=True
+    )
+
+    refill_interval = Integer(
+        30,
+        help="""
+        Seconds between checks of the pool size, when no pod was claimed in between.
+        """,
+        config=True
+    )
+
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace the pool pods are created in.
+        """,
+    )
+
+    _instances = {}
+
+    @classmethod
+    def instance_for(cls, namespace, **kwargs):
+        """
+        Return the shared pool for namespace, creating it if needed.
+        """
+        if namespace not in cls._instances:
+            cls._instances[namespace] = cls(namespace=namespace, **kwargs)
+        return cls._instances[namespace]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kube = KubeApi.instance()
+        # names of pods we have created, but the pod cache hasn't seen yet -> time created
+        self._created = {}
+        # names of pods currently being claimed
+        self._claiming = set()
+        self._creating = 0
+        self._wakeup = None
+        self._task = None
+
+        self.hits = metrics.counter(
+            'kubessh_warm_pool_hits_total',
+            'First logins that got a pod from the warm pool'
+        )
+        self.misses = metrics.counter(
+            'kubessh_warm_pool_misses_total',
+            'First logins that found the warm pool empty & had to start a new pod'
+        )
+        self.claim_duration = metrics.summary(
+            'kubessh_warm_pool_claim_seconds',
+            'Time taken to claim a pod from the warm pool'
+        )
+        metrics.gauge(
+            'kubessh_warm_pool_ready',
+            'Pods in the warm pool ready to be claimed',
+            func=lambda: len(self.ready_members())
+        )
+        metrics.gauge(
+            'kubessh_warm_pool_target',
+            'Number of pods the warm pool currently tries to keep',
+            func=lambda: self.current_size() if self.enabled else 0
+        )
+
+    def current_size(self, now=None):
+        """
+        Return the number of pods the pool should have at time now
+        """
+        now = now or datetime.datetime.now()
+        day = now.strftime('%a').lower()
+        clock = now.strftime('%H:%M')
+        size = self.size
+        for window in self.schedule:
+            if 'days' in window and day not in [d.lower()[:3] for d in window['days']]:
+                continue
+            if window['start'] <= clock < window['end']:
+                size = max(size, window['size'])
+        return size
+
+    def members(self):
+        """
+        Return pool pods that have not been claimed yet
+        """
+        informer = PodInformer.instance_for(self.namespace)
+        return [
+            pod for pod in informer.get_by_username(POOL_USERNAME)
+            if (pod.metadata.labels or {}).get(POOL_LABEL) == 'available'
+        ]
+
+    def ready_members(self):
+        return [
+            pod for pod in self.members()
+            if pod.metadata.deletion_timestamp is None
+            and pod.status is not None and pod.status.phase == 'Running'
+        ]
+
+    async def claim(self, username_label):
+        """
+        Claim a ready pod from the pool for the user with given username label.
+
+        Returns the claimed pod, or None if there was none to be had.
+        """
+        if not PodInformer.instance_for(self.namespace).synced:
+            self.misses.inc()
+            return None
+
+        start = time.perf_counter()
+        try:
+            for pod in self.ready_members():
+                name = pod.metadata.name
+                if name in self._claiming:
+                    continue
+                self._claiming.add(name)
+                try:
+                    # The test makes sure no one else claimed (or removed) it since we looked
+                    claimed = await self.kube.run(
+                        self.kube.v1.patch_namespaced_pod, name, self.namespace, [
+                            {'op': 'test', 'path': _label_path(POOL_LABEL), 'value': 'available'},
+                            {'op': 'add', 'path': _label_path(POOL_LABEL), 'value': 'claimed'},
+                            {'op': 'add', 'path': _label_path(USERNAME_LABEL), 'value': username_label},
+                            # Idle time starts now, not when the pod joined the pool
+                        ] + last_active_patch(pod)
+                    )
+                except kubernetes.client.rest.ApiException as e:
+                    if e.status in (404, 409, 422):
+                        continue
+                    raise
+                finally:
+                    self._claiming.discard(name)
+
+                # Lets the user's PVC be found again if this pod ever has to be recreated
+                await self.kube.run(
+                    self.kube.v1.patch_namespaced_persistent_volume_claim,
+                    claim_name_of(claimed), self.namespace, [
+                        {'op': 'add', 'path': _label_path(POOL_LABEL), 'value': 'claimed'},
+                        {'op': 'add', 'path': _label_path(USERNAME_LABEL), 'value': username_label},
+                    ]
+                )
+                self.log.info(f'Claimed pool pod {name} for {username_label}')
+                self.hits.inc()
+                self.claim_duration.observe(time.perf_counter() - start)
+                return claimed
+
+            self.misses.inc()
+            return None
+        finally:
+            self.refill_soon()
+
+    def start(self, loop=None):
+        """
+        Start keeping the pool filled in the background
+        """
+        if not self.enabled or self._task is not None:
+            return
+        loop = loop or asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def refill_soon(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception:
+                self.log.exception('Failed to refill warm pool')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def refill(self):
+        """
+        Create or remove pool pods to bring the pool to its current size
+        """
+        informer = PodInformer.instance_for(self.namespace)
+        if not informer.synced:
+            return
+
+        now = time.monotonic()
+        self._created = {
+            name: created for name, created in self._created.items()
+            if informer.get(name) is None and now - created < 60
+        }
+
+        healthy = []
+        for pod in self.members():
+            if pod.metadata.deletion_timestamp is not None:
+                continue
+            if pod.status is not None and pod.status.phase in ('Failed', 'Succeeded'):
+                await self._remove_member(pod)
+                continue
+            healthy.append(pod)
+
+        missing = self.current_size() - len(healthy) - len(self._created) - self._creating
+        if missing > 0:
+            self.log.info(f'Adding {missing} pods to the warm pool')
+            results = await asyncio.gather(*[self._add_member() for _ in range(missing)], return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self.log.error(f'Could not add pod to warm pool: {result}')
+        elif missing < 0:
+            # Members that aren't ready yet are the cheapest to give up
+            healthy.sort(key=lambda pod: pod.status is not None and pod.status.phase == 'Running')
+            for pod in healthy[:-missing]:
+                await self._remove_member(pod)
+
+    async def _add_member(self):
+        # pod.py uses the pool, so import here to avoid a cycle
+        from kubessh.pod import UserPod, _pod_started
+
+        member = UserPod('', self.namespace, pod_name=f'kubessh-pool-{secrets.token_hex(4)}', parent=self)
+        member.required_labels[USERNAME_LABEL] = POOL_USERNAME
+        member.required_labels[POOL_LABEL] = 'available'
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + member.start_timeout
+        admission = AdmissionController.instance()
+        # Counts against the same rate & max_starting as logins, but only goes ahead while no login waits
+        ticket = admission.request(POOL_USERNAME, background=True)
+        try:
+            pod = await self._create_member(member, ticket, deadline)
+            # Starting pods count towards max_starting until they are running
+            try:
+                await asyncio.wait_for(
+                    PodInformer.instance_for(self.namespace).wait_for(member.pod_name, _pod_started, uid=pod.metadata.uid),
+                    max(0, deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                self.log.warning(f'Pool pod {member.pod_name} did not start within {member.start_timeout}s')
+        finally:
+            admission.release(ticket)
+
+    async def _create_member(self, member, ticket, deadline):
+        from kubessh.pod import PodStartTimeout
+
+        self._creating += 1
+        try:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(ticket.admitted), max(0, deadline - asyncio.get_event_loop().time())
+                )
+            except asyncio.TimeoutError:
+                raise PodStartTimeout(f'Pod {member.pod_name} was not admitted within {member.start_timeout}s')
+            pod = await member._provision(None, deadline)
+            self._created[member.pod_name] = time.monotonic()
+            return pod
+        finally:
+            self._creating -= 1
+
+    async def _remove_member(self, pod):
+        if pod.metadata.name in self._claiming:
+            return
+        try:
+            # Fails if the pod was claimed since we looked at it
+            await self.kube.run(
+                self.kube.v1.delete_namespaced_pod, pod.metadata.name, self.namespace,
+                body=k.V1DeleteOptions(
+                    grace_period_seconds=0,
+                    preconditions=k.V1Preconditions(resource_version=pod.metadata.resource_version)
+                )
+            )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in (404, 409):
+                raise
+            return
+        try:
+            await self.kube.run(
+                self.kube.v1.delete_namespaced_persistent_volume_claim, claim_name_of(pod), self.namespace
+            )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+        self.log.info(f'Removed {pod.metadata.name} from the warm pool')
@@ -0,0 +1,71 @@
+"""
+Full duplex relay between two stream connections.
+
+Used to connect forwarded ssh channels to the user's pod. Each direction
+is copied by its own task, so neither waits on the other, and drain()
+gives backpressure: we never read faster than the other side can take.
+"""
+import asyncio
+
+from kubessh import metrics
+
+BYTES_RELAYED = metrics.counter(
+    'kubessh_forwarded_bytes_total',
+    'Bytes copied between forwarded ssh channels and user pods, in both directions'
+)
+ACTIVE_RELAYS = metrics.gauge(
+    'kubessh_forwarded_connections',
+    'Forwarded connections currently open'
+)
+
+
+async def pump(reader, writer, buffer_size):
+    """
+    Copy data from reader to writer until reader is at EOF, then pass the EOF on
+    """
+    while True:
+        data = await reader.read(buffer_size)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+        BYTES_RELAYED.inc(len(data))
+    if writer.can_write_eof():
+        writer.write_eof()
+
+
+async def relay(client_reader, client_writer, upstream_reader, upstream_writer, buffer_size=65536, closed=None):
+    """
+    Copy data both ways until both sides are done, or either side fails.
+
+    If one side sends EOF, it is passed on to the other side (where the
+    transport supports half-close) and the other direction keeps going.
+    closed is an optional awaitable completing when the client goes away
+    entirely, so we don't wait for an idle upstream to notice.
+
+    Does not close either connection - that's up to the caller.
+    """
+    to_upstream = asyncio.ensure_future(pump(client_reader, upstream_writer, buffer_size))
+    to_client = asyncio.ensure_future(pump(upstream_reader, client_writer, buffer_size))
+    waiting = {to_upstream, to_client}
+    if closed is not None:
+        closed = asyncio.ensure_future(closed)
+        waiting.add(closed)
+
+    ACTIVE_RELAYS.inc()
+    try:
+        while to_upstream in waiting or to_client in waiting:
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if closed in done:
+                break
+            for task in done:
+                # A failure in either direction ends the whole connection
+                if task.exception() is not None:
+                    raise task.exception()
+            if to_client in done and not upstream_writer.can_write_eof():
+                # Upstream has closed & can't be half-closed, so nothing more will come through
+                break
+    finally:
+        ACTIVE_RELAYS.dec()
+        for task in waiting:
+            task.cancel()
@@ -1,10 +1,12 @@
 """
 Convenience functions for creating pod templates.
 """
-from collections import namedtuple
 import copy
+import datetime
+
+from dateutil.parser import parse as parse_datetime
 from kubernetes import client
-import json
+from kubernetes.client.rest import ApiException
 
 try:
     import yaml
@@ -30,17 +32,10 @@ def _set_k8s_attribute(obj, attribute, value):
         accepted by the k8s python client
     """
     current_value = None
-    attribute_name = None
-    # All k8s python client objects have an 'attribute_map' property
-    # which has as keys python style attribute names (api_client)
-    # and as values the kubernetes JSON API style attribute names
-    # (apiClient). We want to allow users to use the JSON API style attribute
-    # names only.
-    for python_attribute, json_attribute in obj.attribute_map.items():
-        if json_attribute == attribute:
-            attribute_name = python_attribute
-            break
-    else:
+    # We want to allow users to use the JSON API style attribute names only.
+    try:
+        attribute_name = _python_attributes(type(obj))[attribute]
+    except KeyError:
         raise ValueError('Attribute must be one of {}'.format(obj.attribute_map.values()))
 
     if hasattr(obj, attribute_name):
@@ -92,15 +87,139 @@ def merge_dictionaries(a, b, path=None, update=True):
             a[key] = b[key]
     return a
 
-_FakeResponse = namedtuple('_FakeResponse', ['data'])
+# model class -> {JSON API style attribute name: python style attribute name}
+_python_attribute_maps = {}
 
-def make_api_object_from_dict(dict_, kind=client.V1Pod):
-    # FIXME: We can't use the 'deserialize' function since
-    # that expects a response object!
-    return SERIALIZATION_API_CLIENT.deserialize(
-        _FakeResponse(data=json.dumps(dict_)),
-        kind
+
+def _python_attributes(klass):
+    """
+    Return reverse of klass.attribute_map, computed once per model class.
+
+    All k8s python client objects have an 'attribute_map' property
+    which has as keys python style attribute names (api_client)
+    and as values the kubernetes JSON API style attribute names
+    (apiClient).
+    """
+    try:
+        return _python_attribute_maps[klass]
+    except KeyError:
+        reverse = {json_attribute: python_attribute for python_attribute, json_attribute in klass.attribute_map.items()}
+        _python_attribute_maps[klass] = reverse
+        return reverse
+
+
+# model class or openapi type string -> function building it from JSON style data
+_deserializers = {}
+
+# Models only use their configuration to decide whether to validate attributes.
+# Left alone, each model object constructs its own - the bulk of the cost of
+# building a pod - so objects we build share one with the same settings.
+_MODEL_CONFIGURATION = client.Configuration()
+
+
+def _deserialize_primitive(klass):
+    def deserialize(data):
+        try:
+            return klass(data)
+        except TypeError:
+            return data
+    return deserialize
+
+
+def _deserialize_datetime(data):
+    try:
+        return parse_datetime(data)
+    except ValueError:
+        raise ApiException(status=0, reason="Failed to parse `{0}` as datetime object".format(data))
+
+
+def _deserialize_date(data):
+    try:
+        return parse_datetime(data).date()
+    except ValueError:
+        raise ApiException(status=0, reason="Failed to parse `{0}` as date object".format(data))
+
+
+def _make_model_deserializer(klass):
+    if not klass.openapi_types and not hasattr(klass, 'get_real_child_model'):
+        return lambda data: data
+
+    # (JSON attribute name, python attribute name, deserializer) for each attribute.
+    # Filled in after we're registered, since models can refer to themselves.
+    plan = []
+
+    def deserialize(data):
+        kwargs = {}
+        if isinstance(data, (list, dict)):
+            for json_attribute, attribute, deserialize_attribute in plan:
+                if json_attribute in data:
+                    value = data[json_attribute]
+                    kwargs[attribute] = None if value is None else deserialize_attribute(value)
+        instance = klass(local_vars_configuration=_MODEL_CONFIGURATION, **kwargs)
+        if hasattr(instance, 'get_real_child_model'):
+            klass_name = instance.get_real_child_model(data)
+            if klass_name:
+                instance = _deserializer(klass_name)(data)
+        return instance
+
+    _deserializers[klass] = deserialize
+    plan.extend(
+        (klass.attribute_map[attribute], attribute, _deserializer(attribute_type))
+        for attribute, attribute_type in klass.openapi_types.items()
     )
+    return deserialize
+
+
+def _make_deserializer(klass):
+    if isinstance(klass, str):
+        if klass.startswith('list['):
+            deserialize_item = _deserializer(klass[len('list['):-1])
+            return lambda data: [None if item is None else deserialize_item(item) for item in data]
+        if klass.startswith('dict('):
+            deserialize_value = _deserializer(klass[len('dict('):-1].split(', ', 1)[1])
+            return lambda data: {key: None if value is None else deserialize_value(value) for key, value in data.items()}
+        # Shares the plan with lookups by class, which also breaks cycles of self referencing models
+        return _deserializer(client.ApiClient.NATIVE_TYPES_MAPPING.get(klass) or getattr(client.models, klass))
+
+    if klass in client.ApiClient.PRIMITIVE_TYPES:
+        return _deserialize_primitive(klass)
+    elif klass is object:
+        # Must not share mutable state with the dict we were given
+        return copy.deepcopy
+    elif klass is datetime.date:
+        return _deserialize_date
+    elif klass is datetime.datetime:
+        return _deserialize_datetime
+    else:
+        return _make_model_deserializer(klass)
+
+
+def _deserializer(klass):
+    """
+    Return function building klass from JSON style data, planned once per type.
+
+    klass is a model class, or an openapi type string like
+    'list[V1Container]' as found in the models' openapi_types.
+    """
+    try:
+        return _deserializers[klass]
+    except KeyError:
+        deserialize = _make_deserializer(klass)
+        _deserializers[klass] = deserialize
+        return deserialize
+
+
+def make_api_object_from_dict(dict_, kind=client.V1Pod):
+    """
+    Build a kubernetes client object of type kind from a JSON API style dict.
+
+    Produces the same objects as ApiClient.deserialize would from the JSON
+    encoded dict, but without the JSON round trip & without parsing type
+    strings on every call. Nothing in the result shares mutable state with dict_.
+    """
+    if dict_ is None:
+        return None
+    return _deserializer(kind)(dict_)
 
 
 def clean_pod_template(pod_template):
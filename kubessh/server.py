@@ -1,18 +1,14 @@
 import asyncssh
 import asyncio
-import subprocess
+import time
+import aiohttp
 from traitlets.config import LoggingConfigurable
-from traitlets import Unicode
-from simpervisor import SupervisedProcess
-import socket
-from kubessh.pod import UserPod, PodState
-
-def random_port():
-    sock = socket.socket()
-    sock.bind(('', 0))
-    port = sock.getsockname()[1]
-    sock.close()
-    return port
+from traitlets import Unicode, Integer, Float, CaselessStrEnum
+from kubessh.pod import UserPod, PodState, PodStartError, username_from_login
+from kubessh.streams import KubeStreams
+from kubessh.relay import relay
+from kubessh.sessions import SessionTracker
+from kubessh.overload import LoadShedder
 
 class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
     """
@@ -36,21 +32,120 @@ class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
         """,
     )
 
+    forward_mode = CaselessStrEnum(
+        ['api', 'direct', 'auto'],
+        'api',
+        help="""
+        How forwarded ports are connected to the user's pod.
+
+        'api' tunnels through the Kubernetes API server's portforward endpoint.
+        'direct' connects straight to the pod's IP, which only works if KubeSSH
+        runs inside the cluster & can reach pods over the pod network.
+        'auto' tries a direct connection first, and falls back to the API
+        server if the pod can not be reached directly - for example when
+        a NetworkPolicy blocks it, or the port is only bound to 127.0.0.1
+        inside the pod.
+        """,
+        config=True
+    )
+
+    forward_buffer_size = Integer(
+        64 * 1024,
+        help="""
+        Maximum number of bytes read at a time from either end of a forwarded connection.
+        """,
+        config=True
+    )
+
+    direct_connect_timeout = Float(
+        2,
+        help="""
+        Seconds to wait for a direct connection to a pod IP before giving up.
+        """,
+        config=True
+    )
+
+    direct_retry_interval = Float(
+        300,
+        help="""
+        Seconds to skip direct connections for in 'auto' mode, after the pod
+        network was found to be unreachable.
+        """,
+        config=True
+    )
+
+    # Time until which direct connections are skipped in 'auto' mode. Shared by all
+    # connections, since reachability of the pod network is a property of the cluster.
+    _direct_unreachable_until = 0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.forwarding_processes = {}
+        # Connections to pods opened for forwarded ports
+        self.forwards = set()
+        self.handshaking = False
 
     def connection_made(self, conn):
         self.conn = conn
+        refusal = LoadShedder.instance().admit_handshake()
+        if refusal is not None:
+            # Dropped before the key exchange, the expensive part. Too early
+            # in the protocol to send the client a message.
+            self.log.info(f'Dropping connection from {conn.get_extra_info("peername")}: {refusal}')
+            conn.abort()
+            return
+        self.handshaking = True
+
+    def _handshake_done(self):
+        if self.handshaking:
+            self.handshaking = False
+            LoadShedder.instance().handshake_done()
+
+    def auth_completed(self):
+        self._handshake_done()
 
     def connection_lost(self, exception):
         """
-        Terminate any running port-forward process when done
+        Close any connections to pods still open for forwarded ports
+
+        Their relays then end, releasing their sessions.
+        """
+        self._handshake_done()
+        for upstream in self.forwards:
+            upstream.close()
+
+    async def _open_direct(self, user_pod, dest_port):
+        pod = user_pod.pod or await user_pod.read_pod()
+        if pod is None or not pod.status.pod_ip:
+            raise OSError(f'Pod {user_pod.pod_name} has no IP address')
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(pod.status.pod_ip, dest_port),
+            self.direct_connect_timeout
+        )
+        return reader, writer
+
+    async def open_upstream(self, user_pod, dest_port):
         """
-        for proc in self.forwarding_processes.values():
-            # FIXME: This isn't great, since it doesn't retrieve exceptions
-            # Maybe needs to be a thread?
-            asyncio.create_task(proc.terminate())
+        Open a connection to dest_port inside the user's pod.
+
+        Returns a (reader, writer) pair.
+        """
+        use_direct = self.forward_mode == 'direct' or (
+            self.forward_mode == 'auto' and time.monotonic() >= BaseServer._direct_unreachable_until
+        )
+        if use_direct:
+            try:
+                return await self._open_direct(user_pod, dest_port)
+            except (OSError, asyncio.TimeoutError) as e:
+                if self.forward_mode == 'direct':
+                    raise
+                if isinstance(e, asyncio.TimeoutError):
+                    # No answer at all usually means the pod network is filtered,
+                    # so don't make every forward wait for this timeout
+                    BaseServer._direct_unreachable_until = time.monotonic() + self.direct_retry_interval
+                self.log.info(f'Direct connection to {user_pod.pod_name}:{dest_port} failed ({e!r}), using API server')
+
+        upstream = await KubeStreams.instance().port_forward(user_pod.namespace, user_pod.pod_name, dest_port)
+        return upstream, upstream
 
     def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
         # Only allow localhost connections
@@ -60,78 +155,44 @@ class BaseServer(asyncssh.SSHServer, LoggingConfigurable):
                 "Only localhost connections allowed"
             )
 
-        username = process.channel.get_extra_info('username').split('-')
-        if username and username[0] == 'dcucode':
-            username = '-'.join(username[1:])
-        else:
-            username = '-'.join(username)
-        
-        user_pod = UserPod(username, self.namespace)
-
-        cache_key = f'{user_pod.pod_name}:{dest_port}'
-
-
-        if cache_key in self.forwarding_processes:
-            proc = self.forwarding_processes[cache_key]
-
-            port = proc.port
-        else:
-            port = random_port()
-            command = [
-                'kubectl',
-                'port-forward',
-                user_pod.pod_name,
-                f'{port}:{dest_port}'
-            ]
-            async def _socket_ready(proc):
-                try:
-                    sock = socket.create_connection(('127.0.0.1', port))
-                    sock.close()
-                    return True
-                except:
-                    # FIXME: Be more specific in errors we are catching?
-                    return False
-
-
-            proc = SupervisedProcess(
-                'kubectl', *command,
-                always_restart=True,
-                ready_func=_socket_ready
-            )
-            self.forwarding_processes[cache_key] = proc
-            proc.port = port
+        username = username_from_login(self.conn.get_extra_info('username'))
+        user_pod = UserPod(parent=self, username=username, namespace=self.namespace)
 
         async def transfer_data(reader, writer):
             # Make sure our pod is running
-            async for status in user_pod.ensure_running():
-                if status == PodState.RUNNING:
-                    break
-            # Make sure our kubectl port-forward is running
-            await proc.start()
-            await proc.ready()
-
-            # Connect to the local end of the kubectl port-forward
-            (upstream_reader, upstream_writer) = await asyncio.open_connection('127.0.0.1', port)
-
-            # FIXME: This should be as fully bidirectional as possible, with minimal buffering / timeouts
-            while not reader.at_eof():
-                try:
-                    data = await asyncio.wait_for(reader.read(8092), timeout=0.1)
-                except asyncio.TimeoutError:
-                    data = None
-                if data:
-                    upstream_writer.write(data)
-                    await upstream_writer.drain()
-
-                try:
-                    in_data = await asyncio.wait_for(upstream_reader.read(8092), timeout=0.1)
-                except asyncio.TimeoutError:
-                    in_data = None
-                if in_data:
-                    writer.write(in_data)
-                    await writer.drain()
-                if upstream_reader.at_eof():
-                    break
+            try:
+                async for status in user_pod.ensure_running():
+                    pass
+            except PodStartError as e:
+                self.log.error(f'Could not start pod for {username}: {e}')
+                writer.close()
+                return
+
+            try:
+                upstream_reader, upstream_writer = await self.open_upstream(user_pod, dest_port)
+            except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                self.log.error(f'Could not connect to {user_pod.pod_name}:{dest_port}: {e!r}')
+                writer.close()
+                return
+            self.forwards.add(upstream_writer)
+            # Keeps the pod from being reaped as idle while the forward is open
+            sessions = SessionTracker.instance()
+            sessions.acquire(user_pod.namespace, user_pod.pod_name)
+
+            # Only stop early for the client going away if we can tell when that happens
+            channel = getattr(writer, 'channel', None)
+            try:
+                await relay(
+                    reader, writer, upstream_reader, upstream_writer,
+                    buffer_size=self.forward_buffer_size,
+                    closed=channel.wait_closed() if channel is not None else None
+                )
+            except (ConnectionError, asyncssh.Error) as e:
+                self.log.debug(f'Forwarded connection to {user_pod.pod_name}:{dest_port} ended: {e!r}')
+            finally:
+                self.forwards.discard(upstream_writer)
+                upstream_writer.close()
+                sessions.release(user_pod.namespace, user_pod.pod_name)
             writer.close()
 
         return transfer_data
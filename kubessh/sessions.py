@@ -0,0 +1,169 @@
+"""
+Track live ssh sessions per user pod, & publish when each pod was last used.
+
+User pods keep running after their last session closes, holding on to
+their CPU & memory requests. Every shell or forwarded connection holds a
+reference to its pod here. While a pod has references, its
+'kubessh.yuvi.in/last-active' annotation is refreshed every
+heartbeat_interval, and once more when the last one is released. Pods
+are also marked when they are created or claimed from the warm pool, so
+pods nobody ever opens a session to still count as idle.
+kubessh.cleanup deletes pods whose annotation is older than its
+idle_timeout, keeping their PVCs.
+
+A heartbeat rather than an 'idle' flag keeps this correct with several
+KubeSSH replicas, and when KubeSSH itself goes away with its sessions.
+"""
+import asyncio
+import copy
+import datetime
+
+import kubernetes
+from traitlets.config import SingletonConfigurable
+from traitlets import Float
+
+from kubessh import metrics
+from kubessh.kubeapi import KubeApi
+
+LAST_ACTIVE_ANNOTATION = 'kubessh.yuvi.in/last-active'
+
+# JSON patch paths escape '/' as '~1'
+_ANNOTATION_PATH = '/metadata/annotations/' + LAST_ACTIVE_ANNOTATION.replace('/', '~1')
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def format_time(when):
+    return when.astimezone(datetime.timezone.utc).strftime(_TIME_FORMAT)
+
+
+def stamp_last_active(pod):
+    """
+    Return a copy of pod (a V1Pod about to be created) marked as active now
+
+    pod itself is left alone, since rendered specs are shared. Pods
+    nobody ever opens a session to are then still reaped once idle.
+    """
+    stamped = copy.copy(pod)
+    stamped.metadata = copy.copy(pod.metadata)
+    stamped.metadata.annotations = dict(
+        pod.metadata.annotations or {},
+        **{LAST_ACTIVE_ANNOTATION: format_time(datetime.datetime.now(datetime.timezone.utc))}
+    )
+    return stamped
+
+
+def last_active_patch(pod):
+    """
+    Return JSON patch operations marking pod as active now
+    """
+    when = format_time(datetime.datetime.now(datetime.timezone.utc))
+    if pod.metadata.annotations:
+        return [{'op': 'add', 'path': _ANNOTATION_PATH, 'value': when}]
+    return [{'op': 'add', 'path': '/metadata/annotations', 'value': {LAST_ACTIVE_ANNOTATION: when}}]
+
+
+def last_active(pod):
+    """
+    Return when pod was last used (as an aware datetime), or None if it doesn't say
+    """
+    value = (pod.metadata.annotations or {}).get(LAST_ACTIVE_ANNOTATION)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, _TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+class SessionTracker(SingletonConfigurable):
+    """
+    Reference counts of live sessions per user pod.
+    """
+    heartbeat_interval = Float(
+        60,
+        help="""
+        Seconds between refreshes of the last-active annotation of pods with live sessions.
+
+        kubessh.cleanup's idle_timeout must be comfortably longer than this.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kube = KubeApi.instance()
+        # (namespace, pod name) -> number of live sessions
+        self.sessions = {}
+        self._task = None
+
+        metrics.gauge(
+            'kubessh_sessions',
+            'Live shells & forwarded connections',
+            func=lambda: sum(self.sessions.values())
+        )
+        metrics.gauge(
+            'kubessh_pods_with_sessions',
+            'User pods with at least one live shell or forwarded connection',
+            func=lambda: len(self.sessions)
+        )
+        self.heartbeat_failures = metrics.counter(
+            'kubessh_session_heartbeat_failures_total',
+            'Failed updates of the last-active annotation of user pods'
+        )
+
+    def acquire(self, namespace, pod_name):
+        """
+        Record a new session to pod_name
+        """
+        key = (namespace, pod_name)
+        self.sessions[key] = self.sessions.get(key, 0) + 1
+        if self.sessions[key] == 1:
+            self._publish(key)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._heartbeat())
+
+    def release(self, namespace, pod_name):
+        """
+        Record a session to pod_name has ended
+        """
+        key = (namespace, pod_name)
+        count = self.sessions.get(key, 0) - 1
+        if count > 0:
+            self.sessions[key] = count
+            return
+        self.sessions.pop(key, None)
+        # Idle time starts now, not at the last heartbeat
+        self._publish(key)
+
+    def _publish(self, key):
+        return asyncio.ensure_future(self._annotate(key, format_time(datetime.datetime.now(datetime.timezone.utc))))
+
+    async def _annotate(self, key, when):
+        namespace, pod_name = key
+        try:
+            try:
+                await self.kube.run(
+                    self.kube.v1.patch_namespaced_pod, pod_name, namespace,
+                    [{'op': 'add', 'path': _ANNOTATION_PATH, 'value': when}]
+                )
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != 422:
+                    raise
+                # The pod has no annotations at all yet
+                await self.kube.run(
+                    self.kube.v1.patch_namespaced_pod, pod_name, namespace,
+                    [{'op': 'add', 'path': '/metadata/annotations', 'value': {LAST_ACTIVE_ANNOTATION: when}}]
+                )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                self.heartbeat_failures.inc()
+                self.log.warning(f'Could not mark {namespace}/{pod_name} as active: {e.status} {e.reason}')
+        except Exception as e:
+            self.heartbeat_failures.inc()
+            self.log.warning(f'Could not mark {namespace}/{pod_name} as active: {e!r}')
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await asyncio.gather(*[self._publish(key) for key in list(self.sessions)])
@@ -0,0 +1,437 @@
+"""
+Storage accounting & garbage collection of user PVCs, for kubessh.cleanup.
+
+Every user who ever logged in keeps their PVC, whether or not they ever
+come back, slowly eating into the namespace's storage quota. Every
+sweep_interval, all user PVCs are listed and indexed by user & by when
+they were last used. PVCs mounted by a pod are in use, and get their
+'kubessh.yuvi.in/last-used' annotation refreshed. PVCs no pod has
+mounted for max_unused_days are deleted - or first snapshotted, with
+action 'snapshot' - a few at a time.
+
+PVCs seen for the first time without the annotation get it set to the
+current time, so existing PVCs are only ever collected max_unused_days
+after this started watching them.
+"""
+import asyncio
+import datetime
+
+import kubernetes
+from kubernetes import client as k
+from kubernetes.utils import parse_quantity
+from traitlets.config import LoggingConfigurable
+from traitlets import Bool, CaselessStrEnum, Float, Integer, Unicode
+
+from kubessh import metrics
+from kubessh.informer import USERNAME_LABEL
+from kubessh.kubeapi import KubeApi
+from kubessh.pool import POOL_LABEL
+
+LAST_USED_ANNOTATION = 'kubessh.yuvi.in/last-used'
+
+# JSON patch paths escape '/' as '~1'
+_ANNOTATION_PATH = '/metadata/annotations/' + LAST_USED_ANNOTATION.replace('/', '~1')
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+PVC_DELETIONS = metrics.counter(
+    'kubessh_pvc_gc_deletions_total',
+    'Unused user PVCs deleted'
+)
+PVC_SNAPSHOTS = metrics.counter(
+    'kubessh_pvc_gc_snapshots_total',
+    'Unused user PVCs snapshotted before being deleted'
+)
+PVC_GC_DEFERRED = metrics.counter(
+    'kubessh_pvc_gc_deferred_total',
+    'Unused user PVCs left for a later sweep, because they changed while being removed'
+)
+PVC_GC_FAILURES = metrics.counter(
+    'kubessh_pvc_gc_failures_total',
+    'Unused user PVCs that could not be snapshotted or deleted'
+)
+
+
+def _pvc_capacity(pvc):
+    """
+    Return size of pvc in bytes - as provisioned if bound, as requested otherwise
+    """
+    capacity = (pvc.status.capacity if pvc.status is not None else None) or {}
+    if 'storage' not in capacity and pvc.spec.resources is not None:
+        capacity = pvc.spec.resources.requests or {}
+    return int(parse_quantity(capacity.get('storage', 0)))
+
+
+def _last_used_annotation(pvc):
+    return (pvc.metadata.annotations or {}).get(LAST_USED_ANNOTATION)
+
+
+def _pod_claims(pod):
+    if pod.spec is None:
+        return []
+    return [
+        volume.persistent_volume_claim.claim_name
+        for volume in pod.spec.volumes or []
+        if volume.persistent_volume_claim is not None
+    ]
+
+
+class StorageCollector(LoggingConfigurable):
+    """
+    Index user PVCs by user & last use, and remove the ones that went unused for too long.
+    """
+    sweep_interval = Float(
+        600,
+        help="""
+        Seconds between sweeps over all user PVCs.
+        """,
+        config=True
+    )
+
+    label_selector = Unicode(
+        'kubessh=userpods',
+        help="""
+        Label selector matching user PVCs.
+        """,
+        config=True
+    )
+
+    max_unused_days = Float(
+        0,
+        help="""
+        Days a PVC may go without being mounted by any pod before it is removed.
+
+        0 (the default) never removes PVCs, only accounts for them.
+        """,
+        config=True
+    )
+
+    dry_run = Bool(
+        False,
+        help="""
+        Only log which PVCs would be removed, without removing them.
+        """,
+        config=True
+    )
+
+    action = CaselessStrEnum(
+        ['delete', 'snapshot'],
+        'delete',
+        help="""
+        What to do with PVCs unused for max_unused_days.
+
+        'delete' deletes them, along with their data. 'snapshot' first
+        creates a VolumeSnapshot named '{pvc name}-archive' of each, using
+        snapshot_class, and only deletes the PVC once the snapshot is
+        ready to use. PVCs whose snapshot isn't ready within
+        snapshot_timeout are left for the next sweep.
+        """,
+        config=True
+    )
+
+    snapshot_timeout = Float(
+        300,
+        help="""
+        Seconds to wait for a PVC's snapshot to be ready, before leaving the PVC for the next sweep.
+        """,
+        config=True
+    )
+
+    snapshot_poll_interval = Float(
+        5,
+        help="""
+        Seconds between checks of whether a PVC's snapshot is ready.
+        """,
+        config=True
+    )
+
+    snapshot_class = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        VolumeSnapshotClass to archive PVCs with, when action is 'snapshot'.
+
+        If None, the cluster's default class is used.
+        """,
+        config=True
+    )
+
+    max_concurrent_deletes = Integer(
+        4,
+        help="""
+        Maximum number of PVCs being removed at the same time.
+        """,
+        config=True
+    )
+
+    max_deletes_per_sweep = Integer(
+        50,
+        help="""
+        Maximum number of PVCs removed per sweep. The rest wait for the next sweep.
+        """,
+        config=True
+    )
+
+    namespace = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Kubernetes Namespace to collect PVCs in.
+        """,
+    )
+
+    def __init__(self, informer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.informer = informer
+        self.kube = KubeApi.instance()
+        # escaped username -> list of that user's PVCs
+        self.pvcs_by_user = {}
+        # PVC name -> when it was last used, as an aware datetime
+        self.last_used = {}
+        self.total_bytes = 0
+
+        metrics.gauge(
+            'kubessh_pvcs',
+            'User PVCs in the namespace',
+            func=lambda: len(self.last_used)
+        )
+        metrics.gauge(
+            'kubessh_pvc_capacity_bytes',
+            'Total size of all user PVCs',
+            func=lambda: self.total_bytes
+        )
+        metrics.gauge(
+            'kubessh_pvc_users',
+            'Users with at least one PVC',
+            func=lambda: len(self.pvcs_by_user)
+        )
+
+    def report(self):
+        """
+        Return per-user storage use, as a JSON serializable dict
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        users = {}
+        for username, pvcs in self.pvcs_by_user.items():
+            users[username] = {
+                'capacity_bytes': sum(_pvc_capacity(pvc) for pvc in pvcs),
+                'pvcs': {
+                    pvc.metadata.name: {
+                        'capacity_bytes': _pvc_capacity(pvc),
+                        'unused_days': round((now - self.last_used[pvc.metadata.name]).total_seconds() / 86400, 2),
+                    }
+                    for pvc in pvcs
+                },
+            }
+        return {'total_capacity_bytes': self.total_bytes, 'users': users}
+
+    async def _set_last_used(self, pvc, when):
+        if pvc.metadata.annotations:
+            patch = [{'op': 'add', 'path': _ANNOTATION_PATH, 'value': when}]
+        else:
+            patch = [{'op': 'add', 'path': '/metadata/annotations', 'value': {LAST_USED_ANNOTATION: when}}]
+        try:
+            await self.kube.run(self.kube.v1.patch_namespaced_persistent_volume_claim, pvc.metadata.name, self.namespace, patch)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in (404, 422):
+                raise
+
+    def _refresh_after(self):
+        # Mounted PVCs' annotation is only refreshed this often, since removal is measured in days
+        return datetime.timedelta(seconds=max(self.sweep_interval, 3600))
+
+    def _in_use(self, name):
+        return any(name in _pod_claims(pod) for pod in list(self.informer.pods.values()))
+
+    async def sweep(self, now=None):
+        """
+        Index all user PVCs, & remove those unused for longer than max_unused_days
+
+        Returns names of PVCs that were (or, in dry run mode, would have been) removed.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        stamp = now.strftime(_TIME_FORMAT)
+        pvcs = (await self.kube.run(
+            self.kube.v1.list_namespaced_persistent_volume_claim, self.namespace, label_selector=self.label_selector
+        )).items
+        in_use = {claim for pod in list(self.informer.pods.values()) for claim in _pod_claims(pod)}
+        refresh_after = self._refresh_after()
+
+        pvcs_by_user = {}
+        last_used = {}
+        updates = []
+        for pvc in pvcs:
+            name = pvc.metadata.name
+            pvcs_by_user.setdefault((pvc.metadata.labels or {}).get(USERNAME_LABEL, ''), []).append(pvc)
+            annotation = _last_used_annotation(pvc)
+            used = None
+            if annotation is not None:
+                try:
+                    used = datetime.datetime.strptime(annotation, _TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+                except ValueError:
+                    pass
+            if used is None or (name in in_use and now - used > refresh_after):
+                updates.append(self._set_last_used(pvc, stamp))
+                used = now
+            if name in in_use:
+                used = now
+            last_used[name] = used
+        results = await asyncio.gather(*updates, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.error(f'Could not mark PVC as used: {result}')
+
+        self.pvcs_by_user = pvcs_by_user
+        self.last_used = last_used
+        self.total_bytes = sum(_pvc_capacity(pvc) for pvc in pvcs)
+        self.log.info(f'{len(pvcs)} user PVCs of {len(pvcs_by_user)} users, {self.total_bytes / 2**30:.1f}GiB in total')
+
+        if self.max_unused_days <= 0:
+            return []
+        max_unused = datetime.timedelta(days=self.max_unused_days)
+        expired = sorted(
+            (
+                pvc for pvc in pvcs
+                if now - last_used[pvc.metadata.name] > max_unused
+                and pvc.metadata.deletion_timestamp is None
+                # The warm pool removes its own PVCs
+                and (pvc.metadata.labels or {}).get(POOL_LABEL) != 'available'
+            ),
+            key=lambda pvc: last_used[pvc.metadata.name]
+        )[:self.max_deletes_per_sweep]
+
+        if self.dry_run:
+            for pvc in expired:
+                self.log.info(f'Would remove PVC {pvc.metadata.name}, unused since {last_used[pvc.metadata.name]}')
+            return [pvc.metadata.name for pvc in expired]
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_deletes)
+
+        async def remove(pvc):
+            async with semaphore:
+                return await self.remove(pvc)
+
+        removed = await asyncio.gather(*[remove(pvc) for pvc in expired])
+        return [pvc.metadata.name for pvc, ok in zip(expired, removed) if ok]
+
+    async def remove(self, pvc):
+        """
+        Snapshot (if configured) & delete pvc, returning True if it was deleted
+        """
+        name = pvc.metadata.name
+        if self._in_use(name):
+            # Someone logged in since the sweep started
+            return False
+        preconditions = k.V1Preconditions(resource_version=pvc.metadata.resource_version)
+        try:
+            if self.action == 'snapshot':
+                if not await self._snapshot(pvc):
+                    self._defer(name, 'its snapshot is not ready')
+                    return False
+                # Waiting for the snapshot took a while
+                if self._in_use(name):
+                    self._defer(name, 'it was mounted while being snapshotted')
+                    return False
+                # The snapshot controller adds a finalizer to the PVC, changing its
+                # resourceVersion, so only make sure it is still the same PVC
+                current = await self.kube.run(self.kube.v1.read_namespaced_persistent_volume_claim, name, self.namespace)
+                preconditions = k.V1Preconditions(uid=current.metadata.uid)
+            # Fails if the PVC changed since we looked at it
+            await self.kube.run(
+                self.kube.v1.delete_namespaced_persistent_volume_claim, name, self.namespace,
+                body=k.V1DeleteOptions(preconditions=preconditions)
+            )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 404:
+                return False
+            if e.status == 409:
+                self._defer(name, 'it changed since it was listed')
+                return False
+            PVC_GC_FAILURES.inc()
+            self.log.error(f'Could not remove unused PVC {name}: {e.status} {e.reason}')
+            return False
+        self.log.info(f'Removed PVC {name}, unused since {self.last_used.get(name)}')
+        PVC_DELETIONS.inc()
+        return True
+
+    def _defer(self, name, reason):
+        self.log.info(f'Not removing PVC {name} yet, {reason}')
+        PVC_GC_DEFERRED.inc()
+
+    async def _snapshot(self, pvc):
+        """
+        Snapshot pvc, returning True once the snapshot is ready to use, False if it isn't in time
+        """
+        snapshots = k.CustomObjectsApi(self.kube.api_client)
+        snapshot_name = pvc.metadata.name + '-archive'
+        snapshot = {
+            'apiVersion': 'snapshot.storage.k8s.io/v1',
+            'kind': 'VolumeSnapshot',
+            'metadata': {
+                'name': snapshot_name,
+                'labels': dict(pvc.metadata.labels or {}),
+            },
+            'spec': {'source': {'persistentVolumeClaimName': pvc.metadata.name}},
+        }
+        if self.snapshot_class is not None:
+            snapshot['spec']['volumeSnapshotClassName'] = self.snapshot_class
+        try:
+            await self.kube.run(
+                snapshots.create_namespaced_custom_object,
+                'snapshot.storage.k8s.io', 'v1', self.namespace, 'volumesnapshots', snapshot
+            )
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 409:
+                raise
+            # Left by an earlier attempt, which may predate the PVC's last use
+            existing = await self.kube.run(
+                snapshots.get_namespaced_custom_object,
+                'snapshot.storage.k8s.io', 'v1', self.namespace, 'volumesnapshots', snapshot_name
+            )
+            if not self._snapshot_is_recent(pvc, existing):
+                self.log.info(f'Deleting outdated snapshot {snapshot_name}, to snapshot {pvc.metadata.name} again')
+                await self.kube.run(
+                    snapshots.delete_namespaced_custom_object,
+                    'snapshot.storage.k8s.io', 'v1', self.namespace, 'volumesnapshots', snapshot_name
+                )
+                return False
+        else:
+            PVC_SNAPSHOTS.inc()
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.snapshot_timeout
+        while True:
+            snapshot = await self.kube.run(
+                snapshots.get_namespaced_custom_object,
+                'snapshot.storage.k8s.io', 'v1', self.namespace, 'volumesnapshots', snapshot_name
+            )
+            status = snapshot.get('status') or {}
+            if status.get('boundVolumeSnapshotContentName') and status.get('readyToUse'):
+                return True
+            if loop.time() + self.snapshot_poll_interval > deadline:
+                return False
+            await asyncio.sleep(self.snapshot_poll_interval)
+
+    def _snapshot_is_recent(self, pvc, snapshot):
+        """
+        True if snapshot was taken after pvc was last used
+        """
+        created = (snapshot.get('metadata') or {}).get('creationTimestamp')
+        last_used = self.last_used.get(pvc.metadata.name)
+        if created is None or last_used is None:
+            return False
+        try:
+            created = datetime.datetime.strptime(created, _TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            return False
+        # The PVC may have been mounted for up to a refresh & a sweep past its last-used annotation
+        return created > last_used + self._refresh_after() + datetime.timedelta(seconds=self.sweep_interval)
+
+    async def run(self):
+        while True:
+            if self.informer.synced:
+                try:
+                    await self.sweep()
+                except Exception:
+                    self.log.exception('Failed to sweep user PVCs')
+            await asyncio.sleep(self.sweep_interval)
@@ -0,0 +1,308 @@
+"""
+Kubernetes streaming APIs (exec, portforward) spoken directly from asyncio.
+
+Instead of starting a `kubectl` process for every ssh session or forwarded
+port, we open the exec & portforward websockets ourselves, using the same
+credentials & TLS settings as the rest of our Kubernetes API calls. Data on
+the websocket is framed with the channel.k8s.io protocol: each binary message
+starts with one byte naming the stream (stdin, stdout, stderr, error, resize)
+it belongs to.
+"""
+import asyncio
+import json
+import ssl
+from urllib.parse import urlencode
+
+import aiohttp
+import asyncssh
+from traitlets.config import SingletonConfigurable
+from traitlets import Integer
+
+from kubessh.kubeapi import KubeApi
+
+STDIN_CHANNEL = 0
+STDOUT_CHANNEL = 1
+STDERR_CHANNEL = 2
+ERROR_CHANNEL = 3
+RESIZE_CHANNEL = 4
+# Only in v5.channel.k8s.io - lets us signal EOF on stdin
+CLOSE_CHANNEL = 255
+
+V5_CHANNEL_PROTOCOL = 'v5.channel.k8s.io'
+V4_CHANNEL_PROTOCOL = 'v4.channel.k8s.io'
+
+
+# Port forwarding uses two channels per port - data & error
+PORTFORWARD_DATA_CHANNEL = 0
+PORTFORWARD_ERROR_CHANNEL = 1
+
+
+class StdinEOFUnsupported(Exception):
+    """
+    Raised by KubeStreams.exec for sessions without a tty, when the API
+    server can't pass EOF on stdin on to the command - it doesn't speak
+    v5.channel.k8s.io (Kubernetes before 1.30). Commands reading their
+    stdin to the end would never finish.
+    """
+
+
+def _exit_status_from_error(payload):
+    """
+    Return exit status from the metav1.Status sent on the error channel
+    """
+    status = json.loads(payload)
+    if status.get('status') == 'Success':
+        return 0
+    for cause in status.get('details', {}).get('causes', []):
+        if cause.get('reason') == 'ExitCode':
+            return int(cause['message'])
+    return 1
+
+
+class PortForwardStream:
+    """
+    One TCP connection to a port inside a pod, over a portforward websocket.
+
+    Mimics the parts of asyncio's StreamReader / StreamWriter we need, so
+    it can be used anywhere a connection opened with asyncio.open_connection
+    could be.
+    """
+    def __init__(self, ws, port):
+        self.ws = ws
+        self.port = port
+        self.error = None
+        self._eof = False
+        self._leftover = b''
+        self._pending = []
+        # The first frame on each channel just carries the port number
+        self._initialized = set()
+
+    def at_eof(self):
+        return self._eof and not self._leftover
+
+    async def read(self, n=-1):
+        if self._leftover:
+            data = self._leftover if n < 0 else self._leftover[:n]
+            self._leftover = self._leftover[len(data):]
+            return data
+        while not self._eof:
+            msg = await self.ws.receive()
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                                aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    self._eof = True
+                continue
+            channel, payload = msg.data[0], msg.data[1:]
+            if channel not in self._initialized:
+                self._initialized.add(channel)
+                continue
+            if channel == PORTFORWARD_ERROR_CHANNEL:
+                # Usually 'connection refused' - nothing is listening on the port
+                self.error = payload.decode('utf-8', 'replace')
+                self._eof = True
+            elif payload:
+                data = payload if n < 0 else payload[:n]
+                self._leftover = payload[len(data):]
+                return data
+        return b''
+
+    def write(self, data):
+        self._pending.append(data)
+
+    async def drain(self):
+        pending, self._pending = self._pending, []
+        for data in pending:
+            await self.ws.send_bytes(bytes([PORTFORWARD_DATA_CHANNEL]) + data)
+
+    def can_write_eof(self):
+        # The websocket portforward protocol can not half-close a connection
+        return False
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        asyncio.ensure_future(self.ws.close())
+
+    async def wait_closed(self):
+        await self.ws.close()
+
+
+class KubeStreams(SingletonConfigurable):
+    """
+    Open Kubernetes exec & portforward streams from the asyncio event loop.
+    """
+    # Subprotocols we speak, in order of preference
+    protocols = [V5_CHANNEL_PROTOCOL, V4_CHANNEL_PROTOCOL]
+
+    buffer_size = Integer(
+        64 * 1024,
+        help="""
+        Maximum number of bytes read from the ssh client at a time.
+        """,
+        config=True
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.configuration = KubeApi.instance().api_client.configuration
+        self.ssl_context = self._make_ssl_context()
+        self._session = None
+        # Whether the API server speaks v5.channel.k8s.io, None until we have asked
+        self.stdin_eof_supported = None
+
+    def _make_ssl_context(self):
+        configuration = self.configuration
+        if not configuration.host.startswith('https'):
+            return None
+        context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+        if configuration.cert_file:
+            context.load_cert_chain(configuration.cert_file, configuration.key_file)
+        if not configuration.verify_ssl:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    @property
+    def session(self):
+        # Created lazily, since it must be created from inside the event loop.
+        # Shared by all streams, so DNS lookups & TLS setup are reused.
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=self.ssl_context if self.ssl_context else False)
+            )
+        return self._session
+
+    def _headers(self):
+        headers = {}
+        # Also refreshes expiring tokens, via configuration.refresh_api_key_hook
+        token = self.configuration.get_api_key_with_prefix('authorization')
+        if token:
+            headers['Authorization'] = token
+        return headers
+
+    def _url(self, namespace, pod_name, subresource, params):
+        host = self.configuration.host.replace('http', 'ws', 1)
+        return f'{host}/api/v1/namespaces/{namespace}/pods/{pod_name}/{subresource}?{urlencode(params, doseq=True)}'
+
+    async def connect(self, namespace, pod_name, subresource, params, protocols):
+        return await self.session.ws_connect(
+            self._url(namespace, pod_name, subresource, params),
+            protocols=protocols,
+            headers=self._headers(),
+            proxy=self.configuration.proxy,
+            max_msg_size=0,
+        )
+
+    async def check_stdin_eof(self, namespace, pod_name, container):
+        """
+        Return True if the API server can pass EOF on stdin on to commands
+
+        Finds out once, by offering only v5.channel.k8s.io when opening an
+        exec stream that never gets to read stdin.
+        """
+        if self.stdin_eof_supported is None:
+            params = {'container': container, 'command': ['true'], 'stdout': 'true'}
+            try:
+                ws = await self.connect(namespace, pod_name, 'exec', params, [V5_CHANNEL_PROTOCOL])
+            except aiohttp.WSServerHandshakeError as e:
+                if e.status != 400:
+                    raise
+                supported = False
+            else:
+                supported = ws.protocol == V5_CHANNEL_PROTOCOL
+                await ws.close()
+            if not supported:
+                self.log.warning(
+                    f'Kubernetes API does not speak {V5_CHANNEL_PROTOCOL}, '
+                    'so sessions without a tty can not be run through the exec API'
+                )
+            self.stdin_eof_supported = supported
+        return self.stdin_eof_supported
+
+    async def exec(self, ssh_process, namespace, pod_name, container, command):
+        """
+        Run command in container, connected to ssh_process. Returns exit status.
+
+        Raises StdinEOFUnsupported for sessions without a tty, if the API
+        server can't tell the command its stdin has ended.
+        """
+        tty = bool(ssh_process.get_terminal_type())
+        if not tty and not await self.check_stdin_eof(namespace, pod_name, container):
+            raise StdinEOFUnsupported()
+        params = {
+            'container': container,
+            'command': command,
+            'stdin': 'true',
+            'stdout': 'true',
+            # With a tty, stderr is merged into stdout & may not be requested
+            'stderr': 'false' if tty else 'true',
+            'tty': 'true' if tty else 'false',
+        }
+        ws = await self.connect(namespace, pod_name, 'exec', params, self.protocols)
+        try:
+            if tty:
+                width, height = ssh_process.get_terminal_size()[:2]
+                await self._send_resize(ws, width, height)
+            send_stdin = asyncio.ensure_future(self._send_stdin(ws, ssh_process, tty))
+            try:
+                return await self._receive_output(ws, ssh_process)
+            finally:
+                send_stdin.cancel()
+        finally:
+            await ws.close()
+
+    async def port_forward(self, namespace, pod_name, port):
+        """
+        Open a new TCP connection to port in the pod, returning a PortForwardStream
+        """
+        ws = await self.connect(namespace, pod_name, 'portforward', {'ports': port}, [V4_CHANNEL_PROTOCOL])
+        return PortForwardStream(ws, port)
+
+    async def _send_resize(self, ws, width, height):
+        await ws.send_bytes(bytes([RESIZE_CHANNEL]) + json.dumps({'Width': width, 'Height': height}).encode())
+
+    async def _send_stdin(self, ws, ssh_process, tty):
+        while True:
+            try:
+                data = await ssh_process.stdin.read(self.buffer_size)
+            except asyncssh.TerminalSizeChanged as exc:
+                await self._send_resize(ws, exc.width, exc.height)
+                continue
+            except (asyncssh.BreakReceived, asyncssh.SignalReceived):
+                continue
+            if not data:
+                break
+            await ws.send_bytes(bytes([STDIN_CHANNEL]) + data)
+
+        if tty:
+            # Interactive ssh client is gone, so end the shell
+            await ws.close()
+        elif ws.protocol == V5_CHANNEL_PROTOCOL:
+            # Let the command see EOF on its stdin, but keep reading its output
+            await ws.send_bytes(bytes([CLOSE_CHANNEL, STDIN_CHANNEL]))
+
+    async def _receive_output(self, ws, ssh_process):
+        exit_status = None
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                if msg.type == aiohttp.WSMsgType.ERROR:
+                    break
+                continue
+            if len(msg.data) < 2:
+                # Empty frames are sent when a stream is first opened
+                continue
+            channel, payload = msg.data[0], msg.data[1:]
+            if channel == STDOUT_CHANNEL:
+                ssh_process.stdout.write(payload)
+                await ssh_process.stdout.drain()
+            elif channel == STDERR_CHANNEL:
+                ssh_process.stderr.write(payload)
+                await ssh_process.stderr.drain()
+            elif channel == ERROR_CHANNEL:
+                exit_status = _exit_status_from_error(payload)
+        if exit_status is None:
+            # Stream was closed without telling us how the command ended
+            self.log.info(f'Exec stream closed without exit status, close code {ws.close_code}')
+            exit_status = 255 if ws.close_code not in (None, 1000) else 0
+        return exit_status
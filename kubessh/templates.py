@@ -0,0 +1,92 @@
+"""
+Pre-compiled pod & PVC templates.
+
+Templates from config are plain dicts with '{username}' style placeholders
+somewhere in their strings. Rather than walking the whole template and
+formatting every string on each login, we find the placeholders once, and
+rendering only copies the dicts & lists on the path to a placeholder. All
+other parts of the rendered template are shared with the compiled one, so
+rendered templates must be treated as read-only.
+"""
+import string
+
+from kubessh.cache import LRUCache
+
+_formatter = string.Formatter()
+
+
+def _has_fields(s):
+    return any(field is not None for _, field, _, _ in _formatter.parse(s))
+
+
+def _compile(src):
+    """
+    Return (static, plan) for src.
+
+    static is src with all placeholder free strings already formatted.
+    plan is None if there are no placeholders under src, the format string
+    if src is a string with placeholders, and otherwise a dict of
+    key (or list index) -> plan for children that contain placeholders.
+    """
+    if isinstance(src, dict):
+        items = [(key, _compile(value)) for key, value in src.items()]
+        static = {key: value for key, (value, _) in items}
+        plan = {key: child_plan for key, (_, child_plan) in items if child_plan is not None}
+        return static, (plan or None)
+    elif isinstance(src, list):
+        items = [_compile(value) for value in src]
+        static = [value for value, _ in items]
+        plan = {index: child_plan for index, (_, child_plan) in enumerate(items) if child_plan is not None}
+        return static, (plan or None)
+    elif isinstance(src, str):
+        if _has_fields(src):
+            return src, src
+        # Still turns '{{' into '{', just like formatting would
+        return src.format(), None
+    else:
+        return src, None
+
+
+def _render(static, plan, values):
+    if plan is None:
+        return static
+    if isinstance(plan, str):
+        return plan.format(**values)
+    rendered = static.copy()
+    for key, child_plan in plan.items():
+        rendered[key] = _render(static[key], child_plan, values)
+    return rendered
+
+
+class CompiledTemplate:
+    """
+    A template with the location of all its placeholders precomputed.
+    """
+    def __init__(self, template):
+        self.static, self.plan = _compile(template)
+
+    def render(self, **values):
+        """
+        Return template with placeholders filled in from values.
+
+        Equivalent to formatting every string in the template with values.
+        """
+        return _render(self.static, self.plan, values)
+
+
+# id of template -> (template, CompiledTemplate). Templates come from config, so there are only ever a few.
+# Holding on to each template keeps its id from being reused by another object.
+_compiled = LRUCache(64)
+
+
+def compile_template(template):
+    """
+    Return a CompiledTemplate for template, compiling each template object only once.
+
+    Templates are looked up by identity, so must not be modified once compiled.
+    """
+    entry = _compiled.get(id(template))
+    if entry is None or entry[0] is not template:
+        entry = (template, CompiledTemplate(template))
+        _compiled[id(template)] = entry
+    return entry[1]
@@ -16,8 +16,7 @@ setuptools.setup(
         'aiohttp',
         'traitlets',
         'escapism',
-        'ruamel.yaml',
-        'simpervisor'
+        'ruamel.yaml'
     ],
     entry_points = {
         'console_scripts': [
@@ -0,0 +1,117 @@
+"""
+Benchmark latency of short non-interactive commands.
+
+Compares starting a new exec per command with sending the command through
+an already running kubessh.brokerd.
+
+By default runs locally, with no cluster needed: 'per-command' starts a new
+process for each command (the floor for any exec, before any Kubernetes
+overhead) and 'broker' runs brokerd as a local subprocess.
+
+With --pod, runs against a real user pod: 'per-command' runs
+`kubectl exec` for every command, and 'broker' goes through ExecBroker.
+
+Usage:
+    python tests/benchmarks/bench_exec_broker.py [--count 50] [--pod ssh-someone --namespace default]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+class NullStream:
+    async def read(self, n):
+        return b''
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class NullSSHProcess:
+    stdin = stdout = stderr = NullStream()
+
+    def get_terminal_type(self):
+        return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(name, count, run):
+    # Warm up, so broker startup isn't counted
+    await run()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        await run()
+        latencies.append(time.perf_counter() - start)
+    print(
+        f'{name:>12}: p50 {percentile(latencies, 0.5) * 1000:8.2f}ms  '
+        f'p99 {percentile(latencies, 0.99) * 1000:8.2f}ms'
+    )
+
+
+async def local(count, command):
+    from test_broker import start_local_broker
+
+    async def per_command():
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL)
+        await process.wait()
+
+    broker_process, connection = await start_local_broker()
+
+    async def broker():
+        await connection.exec(NullSSHProcess(), command)
+
+    await measure('per-command', count, per_command)
+    await measure('broker', count, broker)
+    broker_process.stdin.close()
+    await broker_process.wait()
+
+
+async def cluster(count, command, namespace, pod_name):
+    from kubessh.broker import ExecBroker
+
+    async def per_command():
+        process = await asyncio.create_subprocess_exec(
+            'kubectl', '--namespace', namespace, 'exec', '-c', 'shell', pod_name, '--', *command,
+            stdout=asyncio.subprocess.DEVNULL
+        )
+        await process.wait()
+
+    exec_broker = ExecBroker.instance(enabled=True)
+
+    async def broker():
+        await exec_broker.exec(NullSSHProcess(), namespace, pod_name, 'shell', command)
+
+    await measure('per-command', count, per_command)
+    await measure('broker', count, broker)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--count', type=int, default=50)
+    argparser.add_argument('--pod', help='Run against this user pod instead of locally')
+    argparser.add_argument('--namespace', default='default')
+    argparser.add_argument('command', nargs='*', default=['uname', '-a'])
+    args = argparser.parse_args()
+
+    print(f'{args.count} x {" ".join(args.command)}')
+    loop = asyncio.get_event_loop()
+    if args.pod:
+        loop.run_until_complete(cluster(args.count, args.command, args.namespace, args.pod))
+    else:
+        loop.run_until_complete(local(args.count, args.command))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Benchmark Kubernetes API calls made by many concurrent logins.
+
+Runs a stub Kubernetes API server in a subprocess (answering pod reads
+after a fixed delay), then simulates N concurrent logins each reading
+their pod, comparing:
+
+  per-pod   - the old behavior, a new ThreadPoolExecutor(1) per UserPod
+              sharing one CoreV1Api with the client's default pool size
+  shared    - UserPod.read_pod going through the shared, bounded KubeApi
+
+Reports peak thread count and p50 / p99 latency of each login's API call.
+
+Usage:
+    python tests/benchmarks/bench_kube_api.py [--logins 1000] [--delay 0.01]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def serve_stub_api(port, delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(delay)
+            name = self.path.rstrip('/').split('/')[-1]
+            body = json.dumps({
+                'apiVersion': 'v1', 'kind': 'Pod',
+                'metadata': {'name': name, 'namespace': 'default'},
+                'status': {'phase': 'Running'}
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.request_queue_size = 4096
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_kubeconfig(port):
+    f = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    json.dump({
+        'apiVersion': 'v1', 'kind': 'Config',
+        'clusters': [{'name': 'stub', 'cluster': {'server': f'http://127.0.0.1:{port}'}}],
+        'users': [{'name': 'stub', 'user': {'token': 'stub'}}],
+        'contexts': [{'name': 'stub', 'context': {'cluster': 'stub', 'user': 'stub'}}],
+        'current-context': 'stub',
+    }, f)
+    f.close()
+    return f.name
+
+
+class ThreadSampler:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(0.005)
+
+    def stop(self):
+        self._stop = True
+        self._thread.join()
+        return self.peak
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_logins(n, login):
+    latencies = []
+
+    async def timed(i):
+        start = time.perf_counter()
+        await login(i)
+        latencies.append(time.perf_counter() - start)
+
+    sampler = ThreadSampler()
+    start = time.perf_counter()
+    await asyncio.gather(*[timed(i) for i in range(n)])
+    total = time.perf_counter() - start
+    return sampler.stop(), latencies, total
+
+
+def report(name, peak_threads, latencies, total):
+    print(
+        f'{name:>8}: peak threads {peak_threads:5d}  '
+        f'p50 {percentile(latencies, 0.5) * 1000:8.1f}ms  '
+        f'p99 {percentile(latencies, 0.99) * 1000:8.1f}ms  '
+        f'total {total:6.2f}s'
+    )
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--logins', type=int, default=1000)
+    argparser.add_argument('--delay', type=float, default=0.01, help='Stub API response time in seconds')
+    argparser.add_argument('--max-concurrency', type=int, default=32)
+    args = argparser.parse_args()
+
+    port = free_port()
+    server = multiprocessing.Process(target=serve_stub_api, args=(port, args.delay), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    os.environ['KUBECONFIG'] = write_kubeconfig(port)
+    # urllib3 is very noisy about discarded connections in the per-pod case
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    from kubernetes import client as k
+    from kubessh.kubeapi import KubeApi
+    from kubessh.pod import UserPod
+
+    loop = asyncio.get_event_loop()
+
+    old_v1 = k.CoreV1Api()
+
+    async def per_pod_login(i):
+        executor = ThreadPoolExecutor(1)
+        await loop.run_in_executor(executor, old_v1.read_namespaced_pod, f'ssh-user{i}', 'default')
+
+    KubeApi.instance(max_concurrency=args.max_concurrency)
+
+    async def shared_login(i):
+        # The pod cache isn't running, so this always goes to the API
+        await UserPod(f'user{i}', 'default').read_pod()
+
+    print(f'{args.logins} concurrent logins, stub API latency {args.delay * 1000:.0f}ms')
+    report('per-pod', *loop.run_until_complete(run_logins(args.logins, per_pod_login)))
+    report('shared', *loop.run_until_complete(run_logins(args.logins, shared_login)))
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
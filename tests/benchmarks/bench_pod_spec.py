@@ -0,0 +1,61 @@
+"""
+Microbenchmark building pod & PVC specs for a login.
+
+  uncompiled - what make_pod_spec / make_pvc_spec used to do: expand the
+               whole template, then deserialize it into a V1Pod
+  compiled   - render the pre-compiled template & deserialize, as happens
+               the first time a user is seen
+  cached     - specs for a user seen recently, served from the LRU
+
+Usage:
+    python tests/benchmarks/bench_pod_spec.py [--count 2000]
+"""
+import argparse
+import itertools
+import time
+
+from kubernetes import client as k
+from kubessh.pod import UserPod
+from kubessh.serialization import make_api_object_from_dict
+
+
+def uncompiled(user_pod):
+    pod = make_api_object_from_dict(user_pod._expand_all(user_pod.pod_template), k.V1Pod)
+    pod.metadata.name = user_pod.pod_name
+    pod.spec.volumes[0].persistent_volume_claim = k.V1PersistentVolumeClaimVolumeSource(claim_name=user_pod.pod_name + '-pvc')
+    pod.metadata.labels = dict(user_pod.required_labels)
+    for template in user_pod.pvc_templates:
+        pvc = make_api_object_from_dict(user_pod._expand_all(template), k.V1PersistentVolumeClaim)
+        pvc.metadata.name = user_pod.pod_name + '-pvc'
+
+
+def compiled(user_pod):
+    user_pod.make_pod_spec()
+    for template in user_pod.pvc_templates:
+        user_pod.make_pvc_spec(template)
+
+
+def measure(name, count, build, usernames):
+    user_pods = [UserPod(next(usernames), 'default') for _ in range(count)]
+    start = time.perf_counter()
+    for user_pod in user_pods:
+        build(user_pod)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {count / elapsed:10.0f} specs/sec  ({elapsed / count * 1e6:8.1f}us each)')
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--count', type=int, default=2000)
+    args = argparser.parse_args()
+
+    ids = itertools.count()
+    measure('uncompiled', args.count, uncompiled, (f'user{i}' for i in ids))
+    # Every user new, so each spec is rendered & deserialized once
+    measure('compiled', args.count, compiled, (f'new{i}' for i in ids))
+    # Same few users logging in again & again
+    measure('cached', args.count, compiled, (f'user{i % 100}' for i in ids))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark forwarded connection relaying over loopback.
+
+Compares the old relay loop (alternating 100ms read timeouts between the
+two directions) with kubessh.relay. Measures:
+
+  interactive - round trip time of small request / response messages,
+                like keystrokes echoed back by a shell
+  push        - delay of messages the upstream sends without being asked,
+                like output pushed over a Jupyter websocket
+  bulk        - throughput of a large download from the upstream, over
+                a fixed amount of time
+
+Usage:
+    python tests/benchmarks/bench_relay.py [--messages 50] [--seconds 3]
+"""
+import argparse
+import asyncio
+import time
+
+from kubessh.relay import relay
+
+
+async def polling_relay(reader, writer, upstream_reader, upstream_writer):
+    # The relay loop BaseServer.connection_requested used to have
+    while not reader.at_eof():
+        try:
+            data = await asyncio.wait_for(reader.read(8092), timeout=0.1)
+        except asyncio.TimeoutError:
+            data = None
+        if data:
+            upstream_writer.write(data)
+            await upstream_writer.drain()
+
+        try:
+            in_data = await asyncio.wait_for(upstream_reader.read(8092), timeout=0.1)
+        except asyncio.TimeoutError:
+            in_data = None
+        if in_data:
+            writer.write(in_data)
+            await writer.drain()
+        if upstream_reader.at_eof():
+            break
+
+
+async def upstream_server(reader, writer):
+    command = await reader.readline()
+    if command.startswith(b'bulk'):
+        chunk = b'x' * 65536
+        try:
+            while True:
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            pass
+    elif command.startswith(b'push'):
+        count = int(command.split()[1])
+        for _ in range(count):
+            await asyncio.sleep(0.013)
+            writer.write(f'{time.perf_counter()}\n'.encode())
+            await writer.drain()
+    else:
+        # Echo lines back
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write(line)
+            await writer.drain()
+    writer.close()
+
+
+async def start_relay(upstream_port, relay_func):
+    async def handle(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', upstream_port)
+        await relay_func(reader, writer, upstream_reader, upstream_writer)
+        upstream_writer.close()
+        writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def interactive(port, messages):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'echo\n')
+    rtts = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        writer.write(b'x' * 63 + b'\n')
+        await writer.drain()
+        await reader.readline()
+        rtts.append(time.perf_counter() - start)
+    writer.close()
+    rtts.sort()
+    return rtts[len(rtts) // 2], rtts[min(len(rtts) - 1, int(len(rtts) * 0.99))]
+
+
+async def push(port, messages):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'push {messages}\n'.encode())
+    delays = []
+    for _ in range(messages):
+        sent = float(await reader.readline())
+        delays.append(time.perf_counter() - sent)
+    writer.close()
+    delays.sort()
+    return delays[len(delays) // 2], delays[min(len(delays) - 1, int(len(delays) * 0.99))]
+
+
+async def bulk(port, seconds):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    start = time.perf_counter()
+    writer.write(b'bulk\n')
+    received = 0
+    while time.perf_counter() - start < seconds:
+        data = await reader.read(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    return received / (time.perf_counter() - start) / 1024 / 1024
+
+
+async def main(messages, seconds):
+    upstream = await asyncio.start_server(upstream_server, '127.0.0.1', 0)
+    upstream_port = upstream.sockets[0].getsockname()[1]
+    for name, relay_func in [('polling', polling_relay), ('relay', relay)]:
+        server, port = await start_relay(upstream_port, relay_func)
+        rtt_p50, rtt_p99 = await interactive(port, messages)
+        push_p50, push_p99 = await push(port, messages)
+        throughput = await bulk(port, seconds)
+        print(
+            f'{name:>8}: rtt p50 {rtt_p50 * 1000:7.2f}ms  p99 {rtt_p99 * 1000:7.2f}ms  '
+            f'push p50 {push_p50 * 1000:7.2f}ms  p99 {push_p99 * 1000:7.2f}ms  '
+            f'bulk {throughput:8.1f} MB/s'
+        )
+        server.close()
+    upstream.close()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--messages', type=int, default=50)
+    argparser.add_argument('--seconds', type=float, default=3)
+    args = argparser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.messages, args.seconds))
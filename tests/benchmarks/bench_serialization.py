@@ -0,0 +1,61 @@
+"""
+Microbenchmark building kubernetes client objects from dicts.
+
+  json-round-trip - what make_api_object_from_dict used to do: json.dumps
+                    the dict & run it through ApiClient.deserialize
+  planned         - make_api_object_from_dict, with attribute maps & type
+                    strings resolved once per model class
+
+Usage:
+    python tests/benchmarks/bench_serialization.py [--count 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+
+from kubernetes import client
+
+from kubessh.pod import UserPod
+from kubessh.serialization import SERIALIZATION_API_CLIENT, make_api_object_from_dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from test_serialization import FULL_POD  # noqa: E402
+
+_Response = namedtuple('_Response', ['data'])
+
+
+def json_round_trip(dict_, kind):
+    return SERIALIZATION_API_CLIENT.deserialize(_Response(data=json.dumps(dict_)), kind)
+
+
+def measure(name, count, build, dict_, kind):
+    build(dict_, kind)
+    start = time.perf_counter()
+    for _ in range(count):
+        build(dict_, kind)
+    elapsed = time.perf_counter() - start
+    print(f'  {name:>15}: {count / elapsed:10.0f} objects/sec  ({elapsed / count * 1e6:8.1f}us each)')
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--count', type=int, default=2000)
+    args = argparser.parse_args()
+
+    user_pod = UserPod('someone', 'default')
+    cases = [
+        ('default pod template', user_pod._expand_all(user_pod.pod_template), client.V1Pod),
+        ('default pvc template', user_pod._expand_all(user_pod.pvc_templates[0]), client.V1PersistentVolumeClaim),
+        ('running pod with status', FULL_POD, client.V1Pod),
+    ]
+    for title, dict_, kind in cases:
+        print(title)
+        measure('json-round-trip', args.count, json_round_trip, dict_, kind)
+        measure('planned', args.count, make_api_object_from_dict, dict_, kind)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+from kubessh.admission import AdmissionController
+
+
+def test_fair_queue():
+    """
+    Waiting users are served round robin, at most max_starting at a time
+    """
+    async def main():
+        admission = AdmissionController(rate=0, max_starting=1)
+        first = admission.request('alice')
+        assert first.admitted.done()
+        tickets = [admission.request(user) for user in ['alice', 'alice', 'alice', 'bob', 'carol']]
+        assert [admission.position(ticket) for ticket in tickets] == [0, 3, 4, 1, 2]
+
+        order = []
+        admission.release(first)
+        while admission._queues or admission.starting:
+            admitted = next(ticket for ticket in tickets if ticket.admitted.done() and not ticket.released)
+            order.append(tickets.index(admitted))
+            admission.release(admitted)
+        return order
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(main()) == [0, 3, 4, 1, 2]
+    loop.close()
+
+
+def test_rate_limit():
+    """
+    After the burst, creates are admitted at rate, and tickets given up leave the queue
+    """
+    async def main():
+        admission = AdmissionController(rate=20, burst=2, max_starting=0)
+        start = time.perf_counter()
+        tickets = [admission.request(f'user{i}') for i in range(6)]
+        assert [ticket.admitted.done() for ticket in tickets] == [True, True, False, False, False, False]
+        admission.release(tickets[3])
+        assert admission.position(tickets[5]) == 2
+        await asyncio.gather(tickets[2].admitted, tickets[4].admitted, tickets[5].admitted)
+        elapsed = time.perf_counter() - start
+        assert tickets[3].admitted.cancelled()
+        for ticket in tickets:
+            admission.release(ticket)
+        assert admission.starting == 0
+        return elapsed
+
+    loop = asyncio.new_event_loop()
+    elapsed = loop.run_until_complete(main())
+    loop.close()
+    assert 0.12 < elapsed < 0.5
+
+
+def test_disabled():
+    async def main():
+        admission = AdmissionController(enabled=False, max_starting=1)
+        tickets = [admission.request('alice') for _ in range(3)]
+        assert all(ticket.admitted.done() for ticket in tickets)
+        for ticket in tickets:
+            admission.release(ticket)
+        assert admission.starting == 0
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
+
+
+def test_background_after_logins():
+    """
+    Background tickets are only admitted once no login is waiting
+    """
+    async def main():
+        admission = AdmissionController(rate=0, max_starting=1)
+        first = admission.request('alice')
+        pool = [admission.request('kubessh-pool', background=True) for _ in range(2)]
+        bob = admission.request('bob')
+        assert admission.position(bob) == 0
+        assert [admission.position(ticket) for ticket in pool] == [1, 2]
+
+        admission.release(first)
+        assert bob.admitted.done() and not pool[0].admitted.done()
+        admission.release(bob)
+        assert pool[0].admitted.done()
+        admission.release(pool[1])
+        admission.release(pool[0])
+        assert admission.starting == 0 and not admission._background
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
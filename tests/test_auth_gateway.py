@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+from kubessh.authentication.gateway import AuthGateway, BackendError, BackendUnavailable
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_concurrency_limit_and_deadline():
+    """
+    Requests beyond the limit wait for a slot, and fail once their deadline passes
+    """
+    in_flight = []
+    most = []
+
+    async def request():
+        in_flight.append(1)
+        most.append(len(in_flight))
+        await asyncio.sleep(0.1)
+        in_flight.pop()
+        return 'ok'
+
+    async def main():
+        gateway = AuthGateway(name='limited', max_concurrency=2, timeout=0.35)
+        return await asyncio.gather(*[gateway.call(request) for _ in range(8)], return_exceptions=True)
+
+    results = run(main())
+    assert max(most) == 2
+    # Two at a time, 0.1s each: three rounds fit in the deadline, the fourth doesn't
+    assert results[:6] == ['ok'] * 6
+    assert all(isinstance(r, BackendUnavailable) for r in results[6:])
+
+
+def test_circuit_breaker():
+    """
+    Repeated failures make later requests fail fast, until a trial request succeeds
+    """
+    calls = []
+
+    async def failing():
+        calls.append('failing')
+        raise BackendError('500')
+
+    async def working():
+        calls.append('working')
+        return 'ok'
+
+    async def main():
+        gateway = AuthGateway(name='breaker', failure_threshold=3, reset_timeout=0.2)
+        for _ in range(3):
+            with pytest.raises(BackendUnavailable):
+                await gateway.call(failing)
+        assert gateway.open_until is not None
+        # Fails without asking the backend
+        with pytest.raises(BackendUnavailable):
+            await gateway.call(working)
+        assert calls == ['failing'] * 3
+
+        await asyncio.sleep(0.2)
+        assert await gateway.call(working) == 'ok'
+        assert gateway.open_until is None
+        assert gateway.short_circuited.value >= 1
+
+    run(main())
+
+
+def test_hedging():
+    """
+    A slow idempotent request gets a second copy, and the faster answer is used
+    """
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        # First copy hangs, second answers right away
+        await asyncio.sleep(5 if len(attempts) == 1 else 0)
+        return len(attempts)
+
+    async def main():
+        gateway = AuthGateway(name='hedged', hedge_delay=0.05)
+        start = time.perf_counter()
+        result = await gateway.call(request, hedge=True)
+        return result, time.perf_counter() - start
+
+    result, elapsed = run(main())
+    assert result == 2
+    assert elapsed < 1
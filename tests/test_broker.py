@@ -0,0 +1,62 @@
+import asyncio
+import sys
+from kubessh import brokerd
+from kubessh.broker import BrokerConnection
+from test_streams import FakeSSHProcess
+
+
+async def start_local_broker():
+    """
+    Run brokerd as a local subprocess, talking to it over pipes
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-u', brokerd.__file__,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+
+    async def write(data):
+        process.stdin.write(data)
+        await process.stdin.drain()
+
+    connection = BrokerConnection(write)
+
+    async def read():
+        while True:
+            data = await process.stdout.read(65536)
+            if not data:
+                break
+            connection.feed(data)
+        connection.connection_lost()
+
+    asyncio.ensure_future(read())
+    await connection.ready
+    return process, connection
+
+
+def test_concurrent_commands():
+    """
+    Many commands run concurrently over one broker, each with its own stdio & exit status
+    """
+    async def main():
+        process, connection = await start_local_broker()
+        commands = [
+            (FakeSSHProcess([]), ['echo', 'hello']),
+            (FakeSSHProcess([b'from ', b'stdin']), ['sh', '-c', 'cat; echo oops >&2; exit 4']),
+            (FakeSSHProcess([]), ['does-not-exist']),
+        ]
+        statuses = await asyncio.gather(*[
+            connection.exec(ssh_process, command) for ssh_process, command in commands
+        ])
+        process.stdin.close()
+        await process.wait()
+        return statuses, [ssh_process for ssh_process, _ in commands]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    statuses, processes = loop.run_until_complete(main())
+    loop.close()
+
+    assert statuses == [0, 4, 127]
+    assert processes[0].stdout.written == b'hello\n'
+    assert processes[1].stdout.written == b'from stdin'
+    assert processes[1].stderr.written == b'oops\n'
@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+import time
+
+from kubernetes import client as k
+from kubessh.cleanup import KubeSanitation
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kubeapi import KubeApi
+from kubessh.pool import POOL_LABEL
+from kubessh.sessions import LAST_ACTIVE_ANNOTATION, format_time
+
+
+def make_pod(name, phase, labels=None, deletion_timestamp=None, annotations=None, creation_timestamp=None):
+    return k.V1Pod(
+        metadata=k.V1ObjectMeta(
+            name=name, uid=name + '-uid', deletion_timestamp=deletion_timestamp, annotations=annotations,
+            creation_timestamp=creation_timestamp,
+            labels=dict({'kubessh': 'userpods', USERNAME_LABEL: name}, **(labels or {}))
+        ),
+        status=k.V1PodStatus(phase=phase)
+    )
+
+
+class FakeApi:
+    def __init__(self, informer, failures):
+        self.informer = informer
+        # pod name -> number of deletes of it to fail
+        self.failures = failures
+        self.deleted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pvc_listings = 0
+
+    def delete_namespaced_pod(self, name, namespace, body):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.05)
+            if self.failures.get(name):
+                self.failures[name] -= 1
+                raise k.rest.ApiException(status=500)
+            self.deleted.append((name, body.grace_period_seconds))
+            self.informer.loop.call_soon_threadsafe(self.informer._apply, 'DELETED', self.informer.get(name))
+        finally:
+            self.in_flight -= 1
+
+    def list_namespaced_persistent_volume_claim(self, namespace, label_selector):
+        # For the StorageCollector started along with cleanup
+        self.pvc_listings += 1
+        return k.V1PersistentVolumeClaimList(items=[])
+
+
+def test_cleanup(monkeypatch):
+    """
+    Finished & stuck pods are deleted concurrently, failed deletes are retried, others are left alone
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer.instance_for('cleanup')
+    informer.loop = loop
+    monkeypatch.setattr(informer, 'start', lambda: None)
+    api = FakeApi(informer, failures={'failed-1': 2})
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+
+    app = KubeSanitation(namespace='cleanup', max_concurrent_deletes=4, retry_delay=0.05, resync_interval=0.1)
+    app.kube = KubeApi.instance()
+    long_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    just_now = datetime.datetime.now(datetime.timezone.utc)
+
+    async def main():
+        task = asyncio.ensure_future(app.start())
+        await asyncio.sleep(0)
+        informer._replace(
+            [make_pod(f'done-{i}', 'Succeeded') for i in range(8)] + [
+                make_pod('running', 'Running'),
+                make_pod('failed-1', 'Failed'),
+                make_pod('pool', 'Failed', labels={POOL_LABEL: 'available'}),
+                make_pod('claimed', 'Succeeded', labels={POOL_LABEL: 'claimed'}),
+                make_pod('stuck', 'Running', deletion_timestamp=long_ago),
+                make_pod('terminating', 'Running', deletion_timestamp=just_now),
+            ]
+        )
+        await asyncio.sleep(0.3)
+        # Pods finishing later are picked up from the watch
+        informer._apply('MODIFIED', make_pod('running', 'Failed'))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(main())
+    loop.close()
+
+    deleted = dict(api.deleted)
+    assert set(deleted) == {f'done-{i}' for i in range(8)} | {'failed-1', 'claimed', 'stuck', 'running'}
+    assert len(api.deleted) == len(deleted)
+    assert deleted['stuck'] == 0 and deleted['done-0'] is None
+    assert api.failures['failed-1'] == 0
+    assert api.max_in_flight == 4
+    assert app.pending == {}
+    # PVCs were swept once, with nothing to do
+    assert api.pvc_listings == 1 and app.storage.last_used == {}
+
+
+def test_idle_pods(monkeypatch):
+    """
+    Pods without ssh sessions for longer than idle_timeout are deleted, unless they were used since
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer.instance_for('idle')
+    informer.loop = loop
+    monkeypatch.setattr(informer, 'start', lambda: None)
+    api = FakeApi(informer, failures={})
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+
+    app = KubeSanitation(namespace='idle', idle_timeout=600, resync_interval=0.1)
+    app.kube = KubeApi.instance()
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def active(minutes_ago):
+        return {LAST_ACTIVE_ANNOTATION: format_time(now - datetime.timedelta(minutes=minutes_ago))}
+
+    async def main():
+        task = asyncio.ensure_future(app.start())
+        await asyncio.sleep(0)
+        informer._replace([
+            make_pod('idle', 'Running', annotations=active(30)),
+            make_pod('recent', 'Running', annotations=active(5)),
+            # Created before sessions were tracked
+            make_pod('untracked-old', 'Running', creation_timestamp=now - datetime.timedelta(minutes=30)),
+            make_pod('untracked-new', 'Running', creation_timestamp=now - datetime.timedelta(minutes=5)),
+            make_pod('pool', 'Running', labels={POOL_LABEL: 'available'}, annotations=active(30)),
+        ])
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(main())
+    loop.close()
+
+    assert sorted(name for name, _ in api.deleted) == ['idle', 'untracked-old']
+    assert app.idle_for(make_pod('recent', 'Running', annotations=active(5))) < 600
+    assert app.idle_for(make_pod('done', 'Succeeded', annotations=active(30))) is None
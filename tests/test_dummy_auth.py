@@ -0,0 +1,153 @@
+import asyncio
+import base64
+import time
+
+from aiohttp import web
+from Crypto.Cipher import PKCS1_v1_5
+from Crypto.PublicKey import RSA
+
+from kubessh.authentication.dummy import DummyAuthenticator
+
+KEY = RSA.generate(1024)
+
+
+class FakeBackend:
+    """
+    Stand-in for the dcucode backend, answering slowly
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.key_requests = 0
+        self.logins = []
+
+    async def get_public_key(self, request):
+        self.key_requests += 1
+        return web.json_response({'data': {'public_key': KEY.publickey().export_key().decode()}, 'error': None})
+
+    async def login(self, request):
+        data = await request.json()
+        await asyncio.sleep(self.delay)
+        password = PKCS1_v1_5.new(KEY).decrypt(base64.b64decode(data['password']), None).decode()
+        self.logins.append(data['username'])
+        if password == data['username']:
+            return web.json_response({'data': 'ok', 'error': None})
+        return web.json_response({'data': None, 'error': 'wrong password'})
+
+    async def token_auth(self, request):
+        data = await request.json()
+        if data == {'token': 'secret', 'username': 'someone'}:
+            return web.json_response({'data': 'ok', 'error': None})
+        return web.json_response({'data': None, 'error': 'bad token'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/get_public_key', self.get_public_key)
+        app.router.add_post('/api/login', self.login)
+        app.router.add_post('/api/token_auth', self.token_auth)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api'
+        return dict(public_key_url=f'{url}/get_public_key', login_url=f'{url}/login', token_auth_url=f'{url}/token_auth')
+
+
+def test_concurrent_logins():
+    """
+    Logins wait on the backend concurrently, sharing one fetch of the public key
+    """
+    backend = FakeBackend(delay=0.2)
+
+    async def main():
+        urls = await backend.start()
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                DummyAuthenticator(**urls).validate_password(f'user{i}', f'user{i}' if i % 2 else 'wrong')
+                for i in range(10)
+            ])
+            elapsed = time.perf_counter() - start
+            token_ok = await DummyAuthenticator(**urls).validate_password('dcucode-someone', 'secret')
+            token_bad = await DummyAuthenticator(**urls).validate_password('dcucode-someone', 'guess')
+        finally:
+            await DummyAuthenticator._session.close()
+            await backend.runner.cleanup()
+        return results, elapsed, token_ok, token_bad
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results, elapsed, token_ok, token_bad = loop.run_until_complete(main())
+    loop.close()
+    DummyAuthenticator._session = None
+    DummyAuthenticator._public_key = None
+    DummyAuthenticator._public_key_lock = None
+
+    assert results == [bool(i % 2) for i in range(10)]
+    assert len(backend.logins) == 10
+    # Ten logins taking 0.2s each would take 2s if they were serialized
+    assert elapsed < 1
+    assert backend.key_requests == 1
+    assert token_ok and not token_bad
+
+
+def test_backend_timeout():
+    """
+    A backend that doesn't answer fails the login, instead of hanging it
+    """
+    backend = FakeBackend(delay=1)
+
+    async def main():
+        urls = await backend.start()
+        try:
+            start = time.perf_counter()
+            result = await DummyAuthenticator(request_timeout=0.3, **urls).validate_password('user', 'user')
+            return result, time.perf_counter() - start
+        finally:
+            await DummyAuthenticator._session.close()
+            await backend.runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    result, elapsed = loop.run_until_complete(main())
+    loop.close()
+    DummyAuthenticator._session = None
+    DummyAuthenticator._public_key = None
+    DummyAuthenticator._public_key_lock = None
+
+    assert result is False
+    assert elapsed < 1
+
+
+def test_verdict_cache():
+    """
+    Repeated logins are answered from the cache, until a login fails
+    """
+    backend = FakeBackend(delay=0)
+
+    async def main():
+        urls = await backend.start()
+
+        async def login(password):
+            return await DummyAuthenticator(verdict_cache_ttl=60, **urls).validate_password('user', password)
+
+        try:
+            results = [await login('user') for _ in range(5)]
+            results.append(await login('wrong'))
+            results.append(await login('user'))
+        finally:
+            await DummyAuthenticator._session.close()
+            await backend.runner.cleanup()
+        return results
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(main())
+    loop.close()
+    DummyAuthenticator._session = None
+    DummyAuthenticator._public_key = None
+    DummyAuthenticator._public_key_lock = None
+    DummyAuthenticator._verdicts = None
+
+    assert results == [True] * 5 + [False, True]
+    # First login, the failed one, and the one after it had to ask the backend
+    assert len(backend.logins) == 3
@@ -0,0 +1,67 @@
+import asyncio
+from kubernetes import client as k
+from kubessh.informer import PodInformer
+
+
+def make_pod(name, username, phase='Running'):
+    return k.V1Pod(
+        metadata=k.V1ObjectMeta(name=name, labels={'kubessh': 'userpods', 'kubessh.yuvi.in/username': username}),
+        status=k.V1PodStatus(phase=phase)
+    )
+
+
+def test_index_events():
+    """
+    Pods are indexed by name & username, and watch events keep the index current
+    """
+    informer = PodInformer(namespace='default')
+    assert not informer.synced
+
+    informer._replace([make_pod('ssh-a', 'a'), make_pod('ssh-b', 'b')])
+    assert informer.synced
+    assert informer.get('ssh-a').metadata.name == 'ssh-a'
+    assert [p.metadata.name for p in informer.get_by_username('b')] == ['ssh-b']
+
+    informer._apply('MODIFIED', make_pod('ssh-a', 'a', phase='Succeeded'))
+    assert informer.get('ssh-a').status.phase == 'Succeeded'
+
+    informer._apply('DELETED', make_pod('ssh-a', 'a'))
+    assert informer.get('ssh-a') is None
+    assert informer.get_by_username('a') == []
+
+    # A relist drops anything we missed DELETED events for, telling listeners & waiters
+    changes = []
+    informer.add_listener(lambda pod_name, pod: changes.append((pod_name, pod)))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    deleted = informer.wait_for('ssh-b', lambda pod: pod is None)
+    not_created = informer.wait_for('ssh-d', lambda pod: pod is None)
+    informer._replace([make_pod('ssh-c', 'c')])
+    assert deleted.result() is None and not not_created.done()
+    assert ('ssh-b', None) in changes
+    loop.close()
+    assert informer.get('ssh-b') is None
+    assert informer.get_by_username('c')[0].metadata.name == 'ssh-c'
+
+
+def test_wait_for():
+    """
+    Waiters are woken up by watch events, not by polling
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer(namespace='default')
+    informer._replace([make_pod('ssh-a', 'a', phase='Pending')])
+
+    started = informer.wait_for('ssh-a', lambda pod: pod is None or pod.status.phase == 'Running')
+    assert not started.done()
+    informer._apply('MODIFIED', make_pod('ssh-a', 'a', phase='Running'))
+    assert started.result().status.phase == 'Running'
+
+    # Already satisfied predicates resolve immediately
+    assert informer.wait_for('ssh-a', lambda pod: True).done()
+
+    deleted = informer.wait_for('ssh-a', lambda pod: pod is None)
+    informer._apply('DELETED', make_pod('ssh-a', 'a'))
+    assert deleted.result() is None
+    loop.close()
@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import asyncssh
+from aiohttp import web
+
+from kubessh.authentication.gateway import AuthGateway
+from kubessh.authentication.github import GitHubAuthenticator
+from kubessh.authentication.gitlab import GitLabAuthenticator
+
+KEYS = [asyncssh.generate_private_key('ssh-ed25519').export_public_key().decode().strip() for _ in range(2)]
+
+
+class FakeKeyServer:
+    """
+    Stand-in for github.com/{username}.keys, supporting ETags
+    """
+    def __init__(self):
+        self.keys = {'someone': KEYS[0] + ' someone@laptop\n'}
+        self.requests = []
+        self.down = False
+        self.status = None
+
+    async def get_keys(self, request):
+        username = request.match_info['username']
+        self.requests.append((username, request.headers.get('If-None-Match')))
+        if self.down:
+            return web.Response(status=503)
+        if self.status is not None:
+            return web.Response(status=self.status)
+        if username not in self.keys:
+            return web.Response(status=404, text='Not Found')
+        etag = f'"{hash(self.keys[username])}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=self.keys[username], headers={'ETag': etag})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{username}.keys', self.get_keys)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+
+def _accepts(keys, key):
+    return keys.validate(asyncssh.import_public_key(key), '127.0.0.1', '127.0.0.1') is not None
+
+
+def test_keys_cached_and_revalidated():
+    """
+    Keys are fetched once, revalidated with If-None-Match after the TTL, and kept while the server is down
+    """
+    server = FakeKeyServer()
+    GitLabAuthenticator._caches.clear()
+    AuthGateway._instances.pop('gitlab', None)
+
+    async def main():
+        url = await server.start()
+        auth = GitLabAuthenticator(instance_url=url, allowed_users=['someone'], keys_cache_ttl=0.2)
+        try:
+            first = await auth.get_authorized_keys('someone')
+            start = time.perf_counter()
+            second = await auth.get_authorized_keys('someone')
+            cached_time = time.perf_counter() - start
+            assert len(server.requests) == 1
+            assert second is first
+            assert _accepts(first, KEYS[0]) and not _accepts(first, KEYS[1])
+
+            await asyncio.sleep(0.25)
+            assert await auth.get_authorized_keys('someone') is first
+            assert server.requests[-1][1] is not None
+            assert len(server.requests) == 2
+
+            server.keys['someone'] = KEYS[1] + '\n'
+            await asyncio.sleep(0.25)
+            changed = await auth.get_authorized_keys('someone')
+            assert _accepts(changed, KEYS[1]) and not _accepts(changed, KEYS[0])
+
+            server.down = True
+            await asyncio.sleep(0.25)
+            assert await auth.get_authorized_keys('someone') is changed
+            # Nobody to fall back on
+            assert await auth.get_authorized_keys('nobody') is None
+            server.down = False
+            # Users without keys are remembered too
+            assert await auth.get_authorized_keys('nobody') is None
+            requests = len(server.requests)
+            assert await auth.get_authorized_keys('nobody') is None
+            assert len(server.requests) == requests
+        finally:
+            await GitLabAuthenticator._sessions.pop(GitLabAuthenticator).close()
+            await server.runner.cleanup()
+        return cached_time
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cached_time = loop.run_until_complete(main())
+    loop.close()
+    assert cached_time < 0.001
+
+
+def test_rate_limits_serve_stale_keys():
+    """
+    Rate limit answers keep the last good keys, & unparseable keys aren't revalidated with their ETag
+    """
+    server = FakeKeyServer()
+    GitLabAuthenticator._caches.clear()
+    AuthGateway._instances.pop('gitlab', None)
+
+    async def main():
+        url = await server.start()
+        auth = GitLabAuthenticator(instance_url=url, allowed_users=['someone'], keys_cache_ttl=0)
+        try:
+            good = await auth.get_authorized_keys('someone')
+            for status in (403, 429):
+                server.status = status
+                assert await auth.get_authorized_keys('someone') is good
+            server.status = None
+            assert await auth.get_authorized_keys('someone') is good
+
+            server.keys['someone'] = 'ssh-ed25519 not-a-key\n'
+            assert await auth.get_authorized_keys('someone') is None
+            assert await auth.get_authorized_keys('someone') is None
+            assert server.requests[-1][1] is None
+        finally:
+            await GitLabAuthenticator._sessions.pop(GitLabAuthenticator).close()
+            await server.runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
+
+
+def test_sessions_per_class():
+    """
+    Each authenticator class keeps its own session & cache
+    """
+    async def main():
+        github, gitlab = GitHubAuthenticator(), GitLabAuthenticator()
+        try:
+            assert github.session is GitHubAuthenticator().session
+            assert github.session is not gitlab.session
+            assert github.keys_cache is not gitlab.keys_cache
+        finally:
+            await GitHubAuthenticator._sessions.pop(GitHubAuthenticator).close()
+            await GitLabAuthenticator._sessions.pop(GitLabAuthenticator).close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
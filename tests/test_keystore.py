@@ -0,0 +1,151 @@
+import asyncio
+
+import asyncssh
+from aiohttp import web
+
+from kubessh.authentication.gateway import AuthGateway, BackendError
+from kubessh.authentication.keystore import KeyStore, KeyStoreAuthenticator
+
+KEYS = [asyncssh.generate_private_key('ssh-ed25519').export_public_key().decode().strip() for _ in range(3)]
+
+
+class FakeBackend:
+    """
+    Stand-in for the dcucode backend's public key changes feed, two users per page
+    """
+    def __init__(self):
+        # list of (username, public_keys) changes, the cursor is an index into it
+        self.changes = [('alice', KEYS[0]), ('bob', KEYS[1]), ('carol', KEYS[2])]
+        self.requests = []
+
+    async def public_keys(self, request):
+        since = int(request.query['since'] or 0)
+        self.requests.append(since)
+        page = self.changes[since:since + 2]
+        return web.json_response({'data': {
+            'users': [{'username': username, 'public_keys': keys} for username, keys in page],
+            'cursor': str(since + len(page)),
+            'more': since + len(page) < len(self.changes),
+        }, 'error': None})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/public_keys', self.public_keys)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/public_keys'
+
+
+class FakeConnection:
+    authorized_keys = None
+
+    def set_authorized_keys(self, keys):
+        self.authorized_keys = keys
+
+
+def _accepts(keys, key):
+    return keys.validate(asyncssh.import_public_key(key), '127.0.0.1', '127.0.0.1') is not None
+
+
+def test_incremental_sync(tmp_path):
+    """
+    Keys are synced page by page, survive restarts, and later syncs only fetch changes
+    """
+    backend = FakeBackend()
+    AuthGateway._instances.pop('dcucode-keys', None)
+    db_path = str(tmp_path / 'keys.sqlite')
+
+    async def main():
+        url = await backend.start()
+        try:
+            store = KeyStore(db_path=db_path, sync_url=url)
+            store.load()
+            await store.sync()
+            assert backend.requests == [0, 2]
+            assert set(store.keys) == {'alice', 'bob', 'carol'}
+            assert _accepts(store.get('alice'), KEYS[0])
+            assert store.get('alice') is store.get('alice')
+            assert store.get('nobody') is None
+
+            # Restarting picks up where the last sync left off
+            backend.changes += [('alice', KEYS[1]), ('bob', None)]
+            store = KeyStore(db_path=db_path, sync_url=url)
+            store.load()
+            assert set(store.keys) == {'alice', 'bob', 'carol'}
+            await store.sync()
+            assert backend.requests[2:] == [3]
+            assert set(store.keys) == {'alice', 'carol'}
+            assert _accepts(store.get('alice'), KEYS[1]) and not _accepts(store.get('alice'), KEYS[0])
+            assert store.get('bob') is None
+            await store._session.close()
+        finally:
+            await backend.runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
+
+
+def test_sync_errors_spare_logins(tmp_path):
+    """
+    Syncs answered with a 4xx fail without tripping any circuit breaker, & no sync_url means no syncing
+    """
+    backend = FakeBackend()
+    for name in ('dcucode', 'dcucode-keys'):
+        AuthGateway._instances.pop(name, None)
+
+    async def main():
+        url = await backend.start()
+        try:
+            store = KeyStore(db_path=str(tmp_path / 'keys.sqlite'), sync_url=url.replace('public_keys', 'missing'))
+            store.load()
+            for _ in range(store.gateway.failure_threshold + 1):
+                try:
+                    await store.sync()
+                except BackendError:
+                    pass
+                else:
+                    assert False, 'sync should have failed'
+            assert store.gateway.name == 'dcucode-keys'
+            assert store.gateway.open_until is None
+            assert 'dcucode' not in AuthGateway._instances
+            await store._session.close()
+        finally:
+            await backend.runner.cleanup()
+
+        store = KeyStore(db_path=str(tmp_path / 'keys.sqlite'))
+        store.start()
+        assert store._task is None
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
+
+
+def test_authenticator_uses_store(tmp_path):
+    """
+    Users with keys in the store have them checked, others fall back to passwords
+    """
+    KeyStore.clear_instance()
+    store = KeyStore.instance(db_path=str(tmp_path / 'keys.sqlite'))
+    store.load()
+    store.keys['alice'] = KEYS[0] + ' alice@laptop'
+    try:
+        auth = KeyStoreAuthenticator()
+        loop = asyncio.new_event_loop()
+        assert auth.public_key_auth_supported() and auth.password_auth_supported()
+        for username in ('alice', 'bob'):
+            conn = FakeConnection()
+            auth.connection_made(conn)
+            assert loop.run_until_complete(auth.begin_auth(username))
+            if username == 'alice':
+                assert _accepts(conn.authorized_keys, KEYS[0])
+            else:
+                assert conn.authorized_keys is None
+        loop.close()
+    finally:
+        KeyStore.clear_instance()
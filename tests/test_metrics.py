@@ -0,0 +1,34 @@
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp import web
+
+from kubessh import metrics
+
+
+def test_serve():
+    """
+    The registry is served at /metrics, next to any extra routes
+    """
+    metrics.counter('kubessh_test_served_total', 'Counter only registered by this test').inc()
+
+    async def extra(request):
+        return web.json_response({'ok': True})
+
+    async def main():
+        runner = await metrics.serve(0, logging.getLogger('test'), {'/extra': extra})
+        # Port 0 gives IPv4 and IPv6 different ports, so use the IPv4 one
+        port = next(address[1] for address in runner.addresses if len(address) == 2)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{port}/metrics') as resp:
+                assert resp.status == 200
+                assert 'kubessh_test_served_total 1\n' in await resp.text()
+            async with session.get(f'http://127.0.0.1:{port}/extra') as resp:
+                assert await resp.json() == {'ok': True}
+        await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import asyncssh
+import pytest
+
+from kubessh.app import KubeSSH
+from kubessh.overload import LoadShedder
+from kubessh.server import BaseServer
+
+
+def test_session_limits():
+    shedder = LoadShedder(max_sessions=3, max_sessions_per_user=2)
+    assert shedder.admit_session('alice') is None
+    assert shedder.admit_session('alice') is None
+    assert 'You already have 2 sessions open' in shedder.admit_session('alice')
+    assert shedder.admit_session('bob') is None
+    assert 'too many open sessions' in shedder.admit_session('carol')
+    shedder.session_done('alice')
+    assert shedder.admit_session('carol') is None
+    assert shedder.sessions == {'alice': 1, 'bob': 1, 'carol': 1}
+
+    shedder.loop_lag = 1
+    assert 'overloaded' in shedder.admit_session('dave')
+    assert 'overloaded' in shedder.admit_handshake()
+    shedder.max_loop_lag = 0
+    assert shedder.admit_handshake() is None
+
+
+def test_loop_lag():
+    """
+    Lag is measured while something hogs the event loop
+    """
+    shedder = LoadShedder(lag_check_interval=0.01)
+
+    async def main():
+        shedder.start()
+        await asyncio.sleep(0.05)
+        assert shedder.loop_lag < 0.05
+        time.sleep(0.2)
+        # Let the measurement catch up
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert shedder.loop_lag > 0.1
+        shedder._task.cancel()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
+
+
+def test_handshake_limit():
+    """
+    Connections beyond max_handshakes are disconnected while others are still authenticating
+    """
+    LoadShedder.clear_instance()
+    LoadShedder.instance(max_handshakes=1)
+    release = None
+
+    class SlowServer(BaseServer):
+        async def begin_auth(self, username):
+            await release
+            return False
+
+    async def main():
+        nonlocal release
+        release = asyncio.get_event_loop().create_future()
+        server = await asyncssh.listen(
+            '127.0.0.1', 0, server_factory=SlowServer,
+            server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')]
+        )
+        port = server.sockets[0].getsockname()[1]
+        options = dict(known_hosts=None, username='someone', client_keys=None)
+        first = asyncio.ensure_future(asyncssh.connect('127.0.0.1', port, **options))
+        while LoadShedder.instance().handshakes == 0:
+            await asyncio.sleep(0.01)
+        with pytest.raises((OSError, asyncssh.Error)):
+            await asyncssh.connect('127.0.0.1', port, **options)
+
+        release.set_result(None)
+        conn = await first
+        assert LoadShedder.instance().handshakes == 0
+        conn.close()
+        await conn.wait_closed()
+        server.close()
+        await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+        LoadShedder.clear_instance()
+
+
+def test_reload_config(tmp_path):
+    config_file = tmp_path / 'kubessh_config.py'
+    config_file.write_text('c.LoadShedder.max_sessions_per_user = 20\n')
+    LoadShedder.clear_instance()
+    try:
+        app = KubeSSH(config_file=str(config_file))
+        shedder = LoadShedder.instance(parent=app)
+        config_file.write_text('c.LoadShedder.max_sessions_per_user = 3\n')
+        app.reload_config()
+        assert shedder.max_sessions_per_user == 3
+    finally:
+        LoadShedder.clear_instance()
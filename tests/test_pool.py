@@ -0,0 +1,181 @@
+import asyncio
+import datetime
+
+from kubernetes import client as k
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kubeapi import KubeApi
+from kubessh.pod import UserPod, PodState
+from kubessh.pool import WarmPool, POOL_LABEL
+from kubessh.sessions import LAST_ACTIVE_ANNOTATION
+from kubessh.admission import AdmissionController
+
+
+def make_pool_pod(name, phase='Running'):
+    return k.V1Pod(
+        metadata=k.V1ObjectMeta(
+            name=name, uid=name, resource_version='1',
+            labels={'kubessh': 'userpods', USERNAME_LABEL: 'kubessh-pool', POOL_LABEL: 'available'}
+        ),
+        spec=k.V1PodSpec(containers=[], volumes=[
+            k.V1Volume(name='poddata', persistent_volume_claim=k.V1PersistentVolumeClaimVolumeSource(claim_name=name + '-pvc'))
+        ]),
+        status=k.V1PodStatus(phase=phase)
+    )
+
+
+class FakeApi:
+    def __init__(self, informer, loop):
+        self.informer = informer
+        self.loop = loop
+        self.created = []
+        self.patched_pvcs = {}
+        self.patched_annotations = {}
+
+    def list_namespaced_persistent_volume_claim(self, namespace, label_selector):
+        return k.V1PersistentVolumeClaimList(items=[])
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        pod = self.informer.get(name)
+        labels = dict(pod.metadata.labels)
+        for op in body:
+            if not op['path'].startswith('/metadata/labels/'):
+                self.patched_annotations[name] = op['value']
+                continue
+            label = op['path'].split('/')[-1].replace('~1', '/')
+            if op['op'] == 'test' and labels.get(label) != op['value']:
+                raise k.rest.ApiException(status=422)
+            elif op['op'] == 'add':
+                labels[label] = op['value']
+        claimed = k.V1Pod(metadata=k.V1ObjectMeta(name=name, labels=labels), spec=pod.spec, status=pod.status)
+        # Apply right away, like the watch would shortly after
+        self.informer._apply('MODIFIED', claimed)
+        return claimed
+
+    def patch_namespaced_persistent_volume_claim(self, name, namespace, body):
+        self.patched_pvcs[name] = body
+
+    def create_namespaced_persistent_volume_claim(self, namespace, body):
+        self.created.append(body)
+        return body
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body)
+        pod = k.V1Pod(metadata=body.metadata, spec=body.spec, status=k.V1PodStatus(phase='Running'))
+        self.loop.call_soon_threadsafe(self.informer._apply, 'ADDED', pod)
+        return pod
+
+
+def test_schedule():
+    pool = WarmPool(size=2, schedule=[
+        {'days': ['mon', 'wed'], 'start': '08:30', 'end': '09:15', 'size': 40},
+        {'start': '09:00', 'end': '10:00', 'size': 10},
+    ])
+    monday = datetime.datetime(2024, 1, 1)
+    assert pool.current_size(monday.replace(hour=8, minute=29)) == 2
+    assert pool.current_size(monday.replace(hour=8, minute=30)) == 40
+    assert pool.current_size(monday.replace(hour=9, minute=15)) == 10
+    assert pool.current_size(monday.replace(day=2, hour=8, minute=45)) == 2
+
+
+def test_claim_from_pool(monkeypatch):
+    """
+    First logins get ready pool pods until there are none left
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer.instance_for('pool')
+    informer._replace([make_pool_pod('kubessh-pool-1'), make_pool_pod('kubessh-pool-2', phase='Pending')])
+    pool = WarmPool.instance_for('pool')
+    monkeypatch.setattr(pool, 'enabled', True)
+    api = FakeApi(informer, loop)
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+
+    async def login(username):
+        user_pod = UserPod(username, 'pool')
+        states = [state async for state in user_pod.ensure_running()]
+        assert states[-1] == PodState.RUNNING
+        return user_pod
+
+    alice = loop.run_until_complete(login('alice'))
+    assert alice.pod_name == 'kubessh-pool-1'
+    assert alice.claim_name == 'kubessh-pool-1-pvc'
+    assert alice.pod.metadata.labels[POOL_LABEL] == 'claimed'
+    assert {'op': 'add', 'path': '/metadata/labels/kubessh.yuvi.in~1username', 'value': 'alice'} in api.patched_pvcs['kubessh-pool-1-pvc']
+    assert LAST_ACTIVE_ANNOTATION in api.patched_annotations['kubessh-pool-1']
+    assert api.created == []
+
+    # The only other pool pod isn't ready yet, so bob gets a new pod
+    bob = loop.run_until_complete(login('bob'))
+    assert bob.pod_name == 'ssh-bob'
+    assert sorted(obj.metadata.name for obj in api.created) == ['ssh-bob', 'ssh-bob-pvc']
+
+    # alice's pod is found again by her username label
+    again = loop.run_until_complete(login('alice'))
+    assert again.pod_name == 'kubessh-pool-1'
+    loop.close()
+
+
+def test_refill(monkeypatch):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer.instance_for('refill')
+    informer._replace([make_pool_pod('kubessh-pool-1')])
+    pool = WarmPool.instance_for('refill', size=3)
+    api = FakeApi(informer, loop)
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+
+    loop.run_until_complete(pool.refill())
+    pods = [obj for obj in api.created if isinstance(obj, k.V1Pod)]
+    assert len(pods) == 2
+    for pod in pods:
+        assert pod.metadata.name.startswith('kubessh-pool-')
+        assert pod.metadata.labels[POOL_LABEL] == 'available'
+        assert pod.metadata.labels[USERNAME_LABEL] == 'kubessh-pool'
+
+    # Pods just created aren't created again before the cache sees them
+    loop.run_until_complete(pool.refill())
+    assert len([obj for obj in api.created if isinstance(obj, k.V1Pod)]) == 2
+    loop.close()
+
+
+def test_refill_admission(monkeypatch):
+    """
+    Refills wait for admission, so no more than max_starting pool pods start at once
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    informer = PodInformer.instance_for('refill-admission')
+    informer._replace([])
+    pool = WarmPool.instance_for('refill-admission', size=3)
+    api = FakeApi(informer, loop)
+
+    def create_pending_pod(namespace, body):
+        api.created.append(body)
+        pod = k.V1Pod(metadata=body.metadata, spec=body.spec, status=k.V1PodStatus(phase='Pending'))
+        loop.call_soon_threadsafe(informer._apply, 'ADDED', pod)
+        return pod
+
+    api.create_namespaced_pod = create_pending_pod
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+    AdmissionController.clear_instance()
+    admission = AdmissionController.instance(rate=0, max_starting=1)
+
+    def created_pods():
+        return [obj for obj in api.created if isinstance(obj, k.V1Pod)]
+
+    async def main():
+        refill = asyncio.ensure_future(pool.refill())
+        for expected in (1, 2, 3):
+            await asyncio.sleep(0.1)
+            assert len(created_pods()) == expected
+            assert admission.starting == 1
+            pod = informer.get(created_pods()[-1].metadata.name)
+            informer._apply('MODIFIED', k.V1Pod(metadata=pod.metadata, spec=pod.spec, status=k.V1PodStatus(phase='Running')))
+        await refill
+        assert admission.starting == 0
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        AdmissionController.clear_instance()
+        loop.close()
@@ -0,0 +1,40 @@
+import asyncio
+from kubessh.relay import relay
+
+
+def test_relay_half_close():
+    """
+    Data flows both ways at once, and EOF from the client reaches upstream
+    """
+    async def upstream_server(reader, writer):
+        # Reply only once the client has finished sending, like `wc -c` would
+        data = await reader.read()
+        writer.write(str(len(data)).encode())
+        await writer.drain()
+        writer.close()
+
+    async def relay_server(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', upstream_port)
+        await relay(reader, writer, upstream_reader, upstream_writer, buffer_size=1024)
+        upstream_writer.close()
+        writer.close()
+
+    async def main():
+        nonlocal upstream_port
+        upstream = await asyncio.start_server(upstream_server, '127.0.0.1', 0)
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        server = await asyncio.start_server(relay_server, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(b'x' * 100000)
+        writer.write_eof()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.close()
+        upstream.close()
+        return reply
+
+    upstream_port = None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    assert loop.run_until_complete(main()) == b'100000'
+    loop.close()
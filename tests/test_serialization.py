@@ -0,0 +1,100 @@
+import json
+from collections import namedtuple
+
+import pytest
+from kubernetes import client
+
+from kubessh.pod import UserPod
+from kubessh.serialization import SERIALIZATION_API_CLIENT, make_api_object_from_dict, _set_k8s_attribute
+
+_Response = namedtuple('_Response', ['data'])
+
+
+def deserialize_via_json(dict_, kind):
+    return SERIALIZATION_API_CLIENT.deserialize(_Response(data=json.dumps(dict_)), kind)
+
+
+FULL_POD = {
+    'apiVersion': 'v1',
+    'kind': 'Pod',
+    'metadata': {
+        'name': 'ssh-someone',
+        'namespace': 'default',
+        'labels': {'kubessh': 'userpods'},
+        'annotations': {'a': 'b'},
+        'creationTimestamp': '2020-01-02T03:04:05Z',
+        'ownerReferences': [{'apiVersion': 'v1', 'kind': 'Node', 'name': 'n', 'uid': 'u'}],
+        'managedFields': [{'manager': 'kubectl', 'fieldsType': 'FieldsV1', 'fieldsV1': {'f:spec': {'f:x': {}}}}],
+    },
+    'spec': {
+        'containers': [{
+            'name': 'shell',
+            'image': 'ubuntu',
+            'command': ['/bin/sh'],
+            'env': [{'name': 'A', 'value': '1'}, {'name': 'B', 'valueFrom': {'fieldRef': {'fieldPath': 'metadata.name'}}}],
+            'ports': [{'containerPort': 22, 'protocol': 'TCP'}],
+            'resources': {'limits': {'cpu': '1', 'memory': '1Gi'}, 'requests': {'cpu': 0.5}},
+            'securityContext': {'runAsUser': 1000, 'privileged': False},
+            'livenessProbe': {'tcpSocket': {'port': 'ssh'}, 'periodSeconds': 10},
+        }],
+        'volumes': [{'name': 'home', 'persistentVolumeClaim': {'claimName': 'ssh-someone-pvc'}}, {'name': 'none', 'emptyDir': None}],
+        'nodeSelector': {'disk': 'ssd'},
+        'tolerations': [],
+    },
+    'status': {
+        'phase': 'Running',
+        'podIP': '10.0.0.1',
+        'startTime': '2020-01-02T03:04:06Z',
+        'conditions': [{'type': 'Ready', 'status': 'True', 'lastTransitionTime': '2020-01-02T03:04:07Z'}],
+    },
+}
+
+CRD = {
+    'metadata': {'name': 'things.example.com'},
+    'spec': {
+        'group': 'example.com',
+        'names': {'kind': 'Thing', 'plural': 'things'},
+        'scope': 'Namespaced',
+        'versions': [{
+            'name': 'v1', 'served': True, 'storage': True,
+            'schema': {'openAPIV3Schema': {
+                'type': 'object',
+                'default': {'nested': [1, 2]},
+                'properties': {'spec': {'type': 'object', 'properties': {'size': {'type': 'integer'}}}},
+            }},
+        }],
+    },
+}
+
+
+@pytest.mark.parametrize('dict_, kind', [
+    (UserPod('someone', 'default').pod_template, client.V1Pod),
+    (UserPod('someone', 'default').pvc_templates[0], client.V1PersistentVolumeClaim),
+    (FULL_POD, client.V1Pod),
+    (CRD, client.V1CustomResourceDefinition),
+])
+def test_same_as_json_round_trip(dict_, kind):
+    expected = deserialize_via_json(dict_, kind)
+    built = make_api_object_from_dict(dict_, kind)
+    assert built == expected
+    assert repr(built) == repr(expected)
+
+
+def test_no_shared_state():
+    pod = make_api_object_from_dict(FULL_POD, client.V1Pod)
+    pod.metadata.labels['new'] = 'label'
+    pod.metadata.managed_fields[0].fields_v1['f:spec']['f:y'] = {}
+    pod.spec.containers[0].command.append('-c')
+    assert 'new' not in FULL_POD['metadata']['labels']
+    assert 'f:y' not in FULL_POD['metadata']['managedFields'][0]['fieldsV1']['f:spec']
+    assert FULL_POD['spec']['containers'][0]['command'] == ['/bin/sh']
+
+
+def test_set_k8s_attribute():
+    meta = client.V1ObjectMeta(labels={'a': 'b'})
+    _set_k8s_attribute(meta, 'labels', {'c': 'd'})
+    _set_k8s_attribute(meta, 'generateName', 'x-')
+    assert meta.labels == {'a': 'b', 'c': 'd'}
+    assert meta.generate_name == 'x-'
+    with pytest.raises(ValueError):
+        _set_k8s_attribute(meta, 'generate_name', 'x-')
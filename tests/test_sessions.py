@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+
+from kubernetes import client as k
+from kubessh.kubeapi import KubeApi
+from kubessh.sessions import SessionTracker, LAST_ACTIVE_ANNOTATION, last_active, stamp_last_active
+
+
+class FakeApi:
+    def __init__(self):
+        # pod name -> annotations, None for pods without any
+        self.annotations = {'ssh-alice': None, 'ssh-bob': {'other': 'x'}}
+        self.patches = []
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        self.patches.append(name)
+        op = body[0]
+        if op['path'] == '/metadata/annotations':
+            self.annotations[name] = dict(op['value'])
+        elif self.annotations[name] is None:
+            raise k.rest.ApiException(status=422)
+        else:
+            self.annotations[name][op['path'].split('/')[-1].replace('~1', '/')] = op['value']
+
+
+def test_session_refcounts(monkeypatch):
+    """
+    Pods are marked active when their first session starts, on every heartbeat, and when the last one ends
+    """
+    api = FakeApi()
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+    tracker = SessionTracker(heartbeat_interval=0.1)
+
+    async def main():
+        tracker.acquire('ns', 'ssh-alice')
+        tracker.acquire('ns', 'ssh-alice')
+        tracker.acquire('ns', 'ssh-bob')
+        await asyncio.sleep(0.05)
+        assert sorted(api.patches) == ['ssh-alice', 'ssh-alice', 'ssh-bob']
+        assert tracker.sessions == {('ns', 'ssh-alice'): 2, ('ns', 'ssh-bob'): 1}
+
+        tracker.release('ns', 'ssh-bob')
+        tracker.release('ns', 'ssh-alice')
+        await asyncio.sleep(0.01)
+        assert tracker.sessions == {('ns', 'ssh-alice'): 1}
+        assert api.patches.count('ssh-bob') == 2
+
+        # Only pods with live sessions get heartbeats
+        await asyncio.sleep(0.1)
+        assert api.patches.count('ssh-bob') == 2
+        assert api.patches.count('ssh-alice') >= 3
+        tracker.release('ns', 'ssh-alice')
+        await asyncio.sleep(0.01)
+        assert tracker.sessions == {}
+        tracker._task.cancel()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    loop.close()
+
+    # The escaped patch path lands on the real annotation key, next to existing ones
+    assert set(api.annotations['ssh-alice']) == {LAST_ACTIVE_ANNOTATION}
+    assert set(api.annotations['ssh-bob']) == {'other', LAST_ACTIVE_ANNOTATION}
+    assert api.annotations['ssh-bob']['other'] == 'x'
+    for name in ('ssh-alice', 'ssh-bob'):
+        pod = k.V1Pod(metadata=k.V1ObjectMeta(annotations=api.annotations[name]))
+        assert abs((datetime.datetime.now(datetime.timezone.utc) - last_active(pod)).total_seconds()) < 5
+
+
+def test_stamp_new_pods():
+    """
+    Pods are created marked active, without touching the shared spec they came from
+    """
+    spec = k.V1Pod(metadata=k.V1ObjectMeta(name='ssh-carol', annotations={'other': 'x'}))
+    stamped = stamp_last_active(spec)
+    assert spec.metadata.annotations == {'other': 'x'}
+    assert stamped.metadata.annotations['other'] == 'x' and stamped.metadata.name == 'ssh-carol'
+    assert abs((datetime.datetime.now(datetime.timezone.utc) - last_active(stamped)).total_seconds()) < 5
@@ -0,0 +1,157 @@
+import asyncio
+import datetime
+
+from kubernetes import client as k
+from kubessh.informer import PodInformer, USERNAME_LABEL
+from kubessh.kubeapi import KubeApi
+from kubessh.pool import POOL_LABEL
+from kubessh.storage import StorageCollector, LAST_USED_ANNOTATION
+
+NOW = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_pvc(name, user, days_unused=None, labels=None):
+    annotations = {'kubessh.yuvi.in/root-mode': 'copy'}
+    if days_unused is not None:
+        annotations[LAST_USED_ANNOTATION] = (NOW - datetime.timedelta(days=days_unused)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return k.V1PersistentVolumeClaim(
+        metadata=k.V1ObjectMeta(
+            name=name, resource_version='1', annotations=annotations,
+            labels=dict({'kubessh': 'userpods', USERNAME_LABEL: user}, **(labels or {}))
+        ),
+        spec=k.V1PersistentVolumeClaimSpec(resources=k.V1ResourceRequirements(requests={'storage': '5Gi'})),
+        status=k.V1PersistentVolumeClaimStatus(capacity={'storage': '5Gi'})
+    )
+
+
+def make_pod(name, claim_name):
+    return k.V1Pod(
+        metadata=k.V1ObjectMeta(name=name),
+        spec=k.V1PodSpec(containers=[], volumes=[
+            k.V1Volume(name='poddata', persistent_volume_claim=k.V1PersistentVolumeClaimVolumeSource(claim_name=claim_name))
+        ])
+    )
+
+
+class FakeApi:
+    def __init__(self, pvcs):
+        self.pvcs = pvcs
+        self.patched = []
+        self.deleted = []
+
+    def list_namespaced_persistent_volume_claim(self, namespace, label_selector):
+        return k.V1PersistentVolumeClaimList(items=self.pvcs)
+
+    def patch_namespaced_persistent_volume_claim(self, name, namespace, body):
+        self.patched.append(name)
+
+    def delete_namespaced_persistent_volume_claim(self, name, namespace, body):
+        self.deleted.append(name)
+
+
+def test_pvc_collection(monkeypatch):
+    """
+    PVCs unused for too long are removed, the oldest first, sparing mounted, new & pool PVCs
+    """
+    api = FakeApi([
+        make_pvc('ssh-alice-pvc', 'alice', days_unused=100),
+        make_pvc('ssh-bob-pvc', 'bob', days_unused=90),
+        make_pvc('ssh-carol-pvc', 'carol', days_unused=60),
+        make_pvc('ssh-dave-pvc', 'dave', days_unused=5),
+        make_pvc('ssh-erin-pvc', 'erin'),
+        make_pvc('kubessh-pool-1-pvc', 'kubessh-pool', days_unused=100, labels={POOL_LABEL: 'available'}),
+        make_pvc('kubessh-pool-2-pvc', 'frank', days_unused=100, labels={POOL_LABEL: 'claimed'}),
+    ])
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+    informer = PodInformer(namespace='storage')
+    informer._replace([make_pod('ssh-bob', 'ssh-bob-pvc')])
+
+    collector = StorageCollector(informer, namespace='storage', max_unused_days=30, max_deletes_per_sweep=2, dry_run=True)
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(collector.sweep(NOW)) == ['ssh-alice-pvc', 'kubessh-pool-2-pvc']
+    assert api.deleted == []
+    # Mounted & unannotated PVCs are marked as used now
+    assert sorted(api.patched) == ['ssh-bob-pvc', 'ssh-erin-pvc']
+
+    report = collector.report()
+    assert report['total_capacity_bytes'] == 7 * 5 * 2**30
+    assert report['users']['alice']['capacity_bytes'] == 5 * 2**30
+
+    collector.dry_run = False
+    collector.max_deletes_per_sweep = 10
+    assert loop.run_until_complete(collector.sweep(NOW)) == ['ssh-alice-pvc', 'kubessh-pool-2-pvc', 'ssh-carol-pvc']
+    assert sorted(api.deleted) == ['kubessh-pool-2-pvc', 'ssh-alice-pvc', 'ssh-carol-pvc']
+    loop.close()
+
+
+def test_snapshot_then_delete(monkeypatch):
+    """
+    PVCs are only deleted once a snapshot taken after their last use is ready, & while unmounted
+    """
+    api = FakeApi([
+        make_pvc('ssh-alice-pvc', 'alice', days_unused=100),
+        make_pvc('ssh-bob-pvc', 'bob', days_unused=100),
+        make_pvc('ssh-carol-pvc', 'carol', days_unused=100),
+        make_pvc('ssh-dave-pvc', 'dave', days_unused=100),
+    ])
+    informer = PodInformer(namespace='storage-snapshot')
+    informer._replace([])
+    polls = {}
+
+    def read_namespaced_persistent_volume_claim(name, namespace):
+        pvc = next(pvc for pvc in api.pvcs if pvc.metadata.name == name)
+        return k.V1PersistentVolumeClaim(metadata=k.V1ObjectMeta(
+            name=name, uid=name + '-uid', resource_version='2', annotations=pvc.metadata.annotations,
+            finalizers=['snapshot.storage.kubernetes.io/pvc-as-source-protection']
+        ))
+
+    def delete_namespaced_persistent_volume_claim(name, namespace, body):
+        assert body.preconditions.uid == name + '-uid'
+        api.deleted.append(name)
+
+    class FakeCustomObjectsApi:
+        # name -> VolumeSnapshot. carol's is left over from an attempt before her last login.
+        snapshots = {'ssh-carol-pvc-archive': {'metadata': {
+            'name': 'ssh-carol-pvc-archive',
+            'creationTimestamp': (NOW - datetime.timedelta(days=200)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }}}
+        deleted = []
+
+        def __init__(self, api_client):
+            pass
+
+        def create_namespaced_custom_object(self, group, version, namespace, plural, body):
+            name = body['metadata']['name']
+            if name in self.snapshots:
+                raise k.rest.ApiException(status=409)
+            self.snapshots[name] = dict(body, metadata=dict(body['metadata'], creationTimestamp=NOW.strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+        def get_namespaced_custom_object(self, group, version, namespace, plural, name):
+            polls[name] = polls.get(name, 0) + 1
+            snapshot = self.snapshots[name]
+            # Ready on the third look, except for dave's which never is
+            if polls[name] >= 3 and name != 'ssh-dave-pvc-archive':
+                snapshot['status'] = {'boundVolumeSnapshotContentName': 'content-' + name, 'readyToUse': True}
+            elif name == 'ssh-bob-pvc-archive':
+                # bob logs in while his PVC is being snapshotted
+                informer._apply('ADDED', make_pod('ssh-bob', 'ssh-bob-pvc'))
+            return snapshot
+
+        def delete_namespaced_custom_object(self, group, version, namespace, plural, name):
+            self.deleted.append(name)
+
+    api.read_namespaced_persistent_volume_claim = read_namespaced_persistent_volume_claim
+    api.delete_namespaced_persistent_volume_claim = delete_namespaced_persistent_volume_claim
+    monkeypatch.setattr(KubeApi.instance(), 'v1', api)
+    monkeypatch.setattr(k, 'CustomObjectsApi', FakeCustomObjectsApi)
+
+    collector = StorageCollector(
+        informer, namespace='storage-snapshot', max_unused_days=30, action='snapshot',
+        snapshot_timeout=0.1, snapshot_poll_interval=0.01
+    )
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(collector.sweep(NOW)) == ['ssh-alice-pvc']
+    loop.close()
+    assert api.deleted == ['ssh-alice-pvc']
+    assert FakeCustomObjectsApi.deleted == ['ssh-carol-pvc-archive']
+    assert polls['ssh-alice-pvc-archive'] == 3
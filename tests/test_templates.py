@@ -0,0 +1,63 @@
+from kubessh.pod import UserPod
+from kubessh.templates import CompiledTemplate
+
+
+def test_render_matches_expand_all():
+    """
+    Compiled templates render exactly like formatting every string would
+    """
+    pod = UserPod('some-user', 'default')
+    template = dict(pod.pod_template, metadata={'annotations': {'owner': '{username}', 'braces': '{{literal}}'}})
+    assert CompiledTemplate(template).render(username=pod._safe_username()) == pod._expand_all(template)
+    for pvc_template in pod.pvc_templates:
+        assert CompiledTemplate(pvc_template).render(username='x') == UserPod('x', 'default')._expand_all(pvc_template)
+
+
+def test_render_copies_only_placeholder_paths():
+    template = {'a': {'b': '{username}'}, 'c': {'d': 'static'}}
+    compiled = CompiledTemplate(template)
+    first, second = compiled.render(username='one'), compiled.render(username='two')
+    assert first['a']['b'] == 'one' and second['a']['b'] == 'two'
+    assert first['c'] is second['c']
+
+
+def test_specs_cached_per_user():
+    pod = UserPod('cached', 'default')
+    assert pod.make_pod_spec() is UserPod('cached', 'default').make_pod_spec()
+    assert pod.make_pod_spec() is not UserPod('other', 'default').make_pod_spec()
+    pvc = pod.make_pvc_spec(pod.pvc_templates[0])
+    assert pvc.metadata.name == 'ssh-cached-pvc'
+    assert pvc.metadata.labels['kubessh'] == 'userpods'
+
+
+def test_templates_compiled_once(monkeypatch):
+    """
+    Logins share the configured templates, so they are only compiled once
+    """
+    import kubessh.templates
+    from traitlets.config import Config
+
+    compiled = []
+    original = kubessh.templates.CompiledTemplate
+
+    def counting(template):
+        compiled.append(template)
+        return original(template)
+
+    monkeypatch.setattr(kubessh.templates, 'CompiledTemplate', counting)
+    monkeypatch.setattr(kubessh.templates, '_compiled', kubessh.templates.LRUCache(64))
+
+    config = Config()
+    config.UserPod.pod_template = dict(UserPod('x', 'default').pod_template, metadata={'labels': {'from': 'config'}})
+    for username in ('one', 'two', 'three'):
+        pod = UserPod(username, 'default', config=config)
+        assert pod.pod_template is config.UserPod.pod_template
+        assert pod.make_pod_spec().metadata.labels['from'] == 'config'
+        pod.make_pvc_spec(pod.pvc_templates[0])
+    assert len(compiled) == 2
+
+    # Templates given directly are used as they are
+    template = dict(config.UserPod.pod_template, metadata={'labels': {'from': 'kwargs'}})
+    pod = UserPod('one', 'default', config=config, pod_template=template)
+    assert pod.make_pod_spec().metadata.labels['from'] == 'kwargs'
+    assert len(compiled) == 3
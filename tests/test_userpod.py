@@ -1,5 +1,11 @@
+import asyncio
+import time
 import pytest
-from kubessh.pod import UserPod
+from kubernetes import client as k
+from kubessh.kubeapi import KubeApi
+from kubessh.pod import UserPod, PodState
+from kubessh.informer import PodInformer
+from kubessh.admission import AdmissionController
 
 def test_pod_name():
     """
@@ -7,3 +13,332 @@ def test_pod_name():
     """
     assert UserPod('test-name', 'default').pod_name == 'ssh-test-2dname'
 
+
+def test_concurrent_ensure_running(monkeypatch):
+    """
+    Many sessions starting at once for the same user create the pod only once
+    """
+    created = []
+    informer = PodInformer.instance_for('single-flight')
+    informer._replace([])
+
+    class FakeApi:
+        def create_namespaced_pod(self, namespace, body):
+            created.append(body.metadata.name)
+            body.status = k.V1PodStatus(phase='Pending')
+            return body
+
+    monkeypatch.setattr(KubeApi.instance(), 'v1', FakeApi())
+    monkeypatch.setattr(UserPod, 'make_pod_spec', lambda self: k.V1Pod(metadata=k.V1ObjectMeta(name=self.pod_name)))
+
+    async def session():
+        pod = UserPod('test', 'single-flight', pvc_templates=[])
+        return [state async for state in pod.ensure_running()]
+
+    async def start_pod():
+        await asyncio.sleep(0.1)
+        informer._apply('ADDED', k.V1Pod(
+            metadata=k.V1ObjectMeta(name='ssh-test'),
+            status=k.V1PodStatus(phase='Running')
+        ))
+
+    async def main():
+        asyncio.ensure_future(start_pod())
+        return await asyncio.gather(*[session() for _ in range(10)])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(main())
+    loop.close()
+
+    assert created == ['ssh-test']
+    assert all(states[-1] == PodState.RUNNING for states in results)
+
+
+def test_replace_completed_pod(monkeypatch):
+    """
+    A Failed pod is deleted while PVCs are created, and replaced once it is gone
+    """
+    calls = []
+    informer = PodInformer.instance_for('replace')
+    old_pod = k.V1Pod(
+        metadata=k.V1ObjectMeta(name='ssh-test', namespace='replace', uid='old'),
+        status=k.V1PodStatus(phase='Failed')
+    )
+    informer._replace([old_pod])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    class FakeApi:
+        def create_namespaced_persistent_volume_claim(self, namespace, body):
+            calls.append(('create-pvc', body.metadata.name))
+            time.sleep(0.2)
+            raise k.rest.ApiException(status=409)
+
+        def delete_namespaced_pod(self, name, namespace, body):
+            calls.append(('delete-pod', name))
+            # Pod goes away a little later, like it would with finalizers
+            loop.call_soon_threadsafe(loop.call_later, 0.1, informer._apply, 'DELETED', old_pod)
+
+        def create_namespaced_pod(self, namespace, body):
+            if informer.get(body.metadata.name) is not None:
+                calls.append(('create-pod-conflict', body.metadata.name))
+                raise k.rest.ApiException(status=409)
+            calls.append(('create-pod', body.metadata.name))
+            pod = k.V1Pod(metadata=k.V1ObjectMeta(name=body.metadata.name, uid='new'), status=k.V1PodStatus(phase='Running'))
+            loop.call_soon_threadsafe(informer._apply, 'ADDED', pod)
+            return pod
+
+        def read_namespaced_pod(self, name, namespace):
+            return informer.get(name)
+
+    monkeypatch.setattr(KubeApi.instance(), 'v1', FakeApi())
+    monkeypatch.setattr(UserPod, 'make_pod_spec', lambda self: k.V1Pod(metadata=k.V1ObjectMeta(name=self.pod_name)))
+
+    async def session():
+        pod = UserPod('test', 'replace')
+        states = [state async for state in pod.ensure_running()]
+        return pod, states
+
+    user_pod, states = loop.run_until_complete(session())
+    loop.close()
+
+    assert states[-1] == PodState.RUNNING
+    assert user_pod.pod.metadata.uid == 'new'
+    assert set(calls[:2]) == {('create-pvc', 'ssh-test-pvc'), ('delete-pod', 'ssh-test')}
+    assert calls[-1] == ('create-pod', 'ssh-test')
+    # The PVC create overlapped with replacing the pod, rather than coming before it
+    assert user_pod.start_timings['create'] < 0.35
+
+
+def test_replace_with_stale_cache(monkeypatch):
+    """
+    Waiting for a replacement pod ignores the old pod the cache still holds, & its deletion
+    """
+    informer = PodInformer.instance_for('replace-stale')
+    old_pod = k.V1Pod(
+        metadata=k.V1ObjectMeta(name='ssh-test', namespace='replace-stale', uid='old'),
+        status=k.V1PodStatus(phase='Failed')
+    )
+    informer._replace([old_pod])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def new_pod(phase):
+        return k.V1Pod(metadata=k.V1ObjectMeta(name='ssh-test', uid='new'), status=k.V1PodStatus(phase=phase))
+
+    class FakeApi:
+        def create_namespaced_persistent_volume_claim(self, namespace, body):
+            raise k.rest.ApiException(status=409)
+
+        def delete_namespaced_pod(self, name, namespace, body):
+            pass
+
+        def create_namespaced_pod(self, namespace, body):
+            # The API server already let go of the old pod, but the watch hasn't told us yet
+            def events():
+                loop.call_later(0.2, informer._apply, 'DELETED', old_pod)
+                loop.call_later(0.3, informer._apply, 'ADDED', new_pod('Pending'))
+                loop.call_later(0.4, informer._apply, 'MODIFIED', new_pod('Running'))
+            loop.call_soon_threadsafe(events)
+            return new_pod('Pending')
+
+    monkeypatch.setattr(KubeApi.instance(), 'v1', FakeApi())
+    monkeypatch.setattr(UserPod, 'make_pod_spec', lambda self: k.V1Pod(metadata=k.V1ObjectMeta(name=self.pod_name)))
+
+    async def session():
+        pod = UserPod('test', 'replace-stale')
+        states = [state async for state in pod.ensure_running()]
+        return pod, states
+
+    user_pod, states = loop.run_until_complete(session())
+    loop.close()
+
+    assert states[-1] == PodState.RUNNING
+    assert user_pod.pod.metadata.uid == 'new' and user_pod.pod.status.phase == 'Running'
+
+
+def test_pvc_data_source():
+    """
+    New PVCs are cloned from the golden volume for the shell image
+    """
+    pod = UserPod('seeded', 'default')
+    assert pod.make_pvc_spec(pod.pvc_templates[0]).spec.data_source is None
+
+    image = pod.pod_template['spec']['containers'][0]['image']
+    pod = UserPod('seeded', 'default', pvc_data_sources={
+        image: {'apiGroup': 'snapshot.storage.k8s.io', 'kind': 'VolumeSnapshot', 'name': 'golden'},
+        'other:latest': {'kind': 'PersistentVolumeClaim', 'name': 'other'},
+    })
+    data_source = pod.make_pvc_spec(pod.pvc_templates[0]).spec.data_source
+    assert (data_source.kind, data_source.name) == ('VolumeSnapshot', 'golden')
+
+
+def test_image_root_mode(monkeypatch):
+    """
+    In image mode only persistent paths come from the PVC, unless the user's PVC predates it
+    """
+    pod = UserPod('imageroot', 'default', root_mode='image', persistent_paths=['/home', '/usr/local'])
+    spec = pod.make_pod_spec()
+    assert spec.spec.init_containers is None
+    shell = spec.spec.containers[0]
+    assert [(m.mount_path, m.sub_path) for m in shell.volume_mounts] == [('/home', 'home'), ('/usr/local', 'usr/local')]
+    pvc = pod.make_pvc_spec(pod.pvc_templates[0])
+    assert pvc.metadata.annotations['kubessh.yuvi.in/root-mode'] == 'image'
+
+    class FakeApi:
+        def list_namespaced_persistent_volume_claim(self, namespace, label_selector):
+            assert label_selector == 'kubessh.yuvi.in/username=imageroot'
+            return k.V1PersistentVolumeClaimList(items=[
+                k.V1PersistentVolumeClaim(metadata=k.V1ObjectMeta(name='ssh-imageroot-pvc'))
+            ])
+
+    monkeypatch.setattr(KubeApi.instance(), 'v1', FakeApi())
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(pod._find_own_claim())
+    loop.close()
+    # PVC without annotation was made for copy mode, so the pod is too
+    assert pod.volume_root_mode == 'copy'
+    spec = pod.make_pod_spec()
+    assert spec.spec.init_containers[0].name == 'init-setup'
+    assert len(spec.spec.containers[0].volume_mounts) == 5
+
+
+def test_admission_queue(monkeypatch):
+    """
+    Cold starts beyond max_starting wait their turn, warm logins don't
+    """
+    created = []
+    informer = PodInformer.instance_for('admission')
+    informer._replace([k.V1Pod(
+        metadata=k.V1ObjectMeta(name='ssh-warm', labels={'kubessh.yuvi.in/username': 'warm'}),
+        status=k.V1PodStatus(phase='Running')
+    )])
+
+    class FakeApi:
+        def create_namespaced_pod(self, namespace, body):
+            created.append(body.metadata.name)
+            body.status = k.V1PodStatus(phase='Pending')
+            return body
+
+    monkeypatch.setattr(KubeApi.instance(), 'v1', FakeApi())
+    monkeypatch.setattr(UserPod, 'make_pod_spec', lambda self: k.V1Pod(metadata=k.V1ObjectMeta(name=self.pod_name)))
+    admission = AdmissionController.instance()
+    monkeypatch.setattr(admission, 'max_starting', 1)
+    monkeypatch.setattr(admission, 'rate', 0)
+
+    async def session(username):
+        pod = UserPod(username, 'admission', pvc_templates=[])
+        states = []
+        async for state in pod.ensure_running():
+            states.append((state, pod.queue_position) if state == PodState.QUEUED else state)
+        return states
+
+    async def start_pods():
+        for name in ['ssh-first', 'ssh-second']:
+            while name not in created:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.2)
+            informer._apply('ADDED', k.V1Pod(metadata=k.V1ObjectMeta(name=name), status=k.V1PodStatus(phase='Running')))
+
+    async def main():
+        asyncio.ensure_future(start_pods())
+        first = asyncio.ensure_future(session('first'))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(session('second'))
+        await asyncio.sleep(0.05)
+        assert created == ['ssh-first']
+        warm = await session('warm')
+        return await first, await second, warm
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    first, second, warm = loop.run_until_complete(main())
+    loop.close()
+
+    assert PodState.QUEUED not in first
+    assert second[1] == (PodState.QUEUED, 0)
+    assert second[-1] == PodState.RUNNING
+    assert warm == [PodState.RUNNING]
+    assert admission.starting == 0
+
+
+def test_watch_stops_when_cancelled(monkeypatch):
+    """
+    Without a synced pod cache, abandoning the wait for a pod ends its watch thread
+    """
+    import kubessh.pod
+    watches = []
+
+    class FakeWatch:
+        def stream(self, func, namespace, **kwargs):
+            watches.append(kwargs['timeout_seconds'])
+            # Nothing happens to the pod within the watch's timeout
+            time.sleep(0.05)
+            return iter([])
+
+        def stop(self):
+            pass
+
+    monkeypatch.setattr(kubessh.pod.kubernetes.watch, 'Watch', FakeWatch)
+    monkeypatch.setattr(kubessh.pod, '_WATCH_TIMEOUT', 1)
+    informer = PodInformer.instance_for('unsynced-watch')
+    informer.synced = False
+    pod = UserPod('test', 'unsynced-watch', pvc_templates=[])
+
+    async def main():
+        waiting = asyncio.ensure_future(pod.wait_for_started(
+            k.V1Pod(metadata=k.V1ObjectMeta(name=pod.pod_name, resource_version='1'))
+        ))
+        await asyncio.sleep(0.2)
+        waiting.cancel()
+        await asyncio.sleep(0.2)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
+    count = len(watches)
+    time.sleep(0.2)
+    loop.close()
+
+    assert count >= 2 and watches[0] == 1
+    # No new watches once the wait was abandoned
+    assert len(watches) == count
+
+
+def test_watch_ignores_other_pods(monkeypatch):
+    """
+    Without a synced pod cache, the watch only resolves on the pod with the uid that was created
+    """
+    import kubessh.pod
+
+    def event(event_type, uid, phase):
+        return {'type': event_type, 'object': k.V1Pod(
+            metadata=k.V1ObjectMeta(name='ssh-test', uid=uid, resource_version=uid + phase),
+            status=k.V1PodStatus(phase=phase)
+        )}
+
+    class FakeWatch:
+        def stream(self, func, namespace, **kwargs):
+            return iter([
+                event('MODIFIED', 'old', 'Failed'),
+                event('DELETED', 'old', 'Failed'),
+                event('ADDED', 'new', 'Pending'),
+                event('MODIFIED', 'new', 'Running'),
+            ])
+
+        def stop(self):
+            pass
+
+    monkeypatch.setattr(kubessh.pod.kubernetes.watch, 'Watch', FakeWatch)
+    informer = PodInformer.instance_for('unsynced-uid')
+    informer.synced = False
+    pod = UserPod('test', 'unsynced-uid', pvc_templates=[])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    started = loop.run_until_complete(pod.wait_for_started(
+        k.V1Pod(metadata=k.V1ObjectMeta(name=pod.pod_name, uid='new', resource_version='1'))
+    ))
+    loop.close()
+    assert started.metadata.uid == 'new' and started.status.phase == 'Running'